@@ -104,6 +104,21 @@ DATABASES = {
 }
 
 
+# Cache
+# https://docs.djangoproject.com/en/5.2/topics/cache/
+# Kit availability, barcode scans and item units are cached here. When
+# running several worker processes, point this at a backend they share
+# (such as django.core.cache.backends.redis.RedisCache) so a change made
+# by one worker is seen by all of them at once.
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'OPTIONS': {'MAX_ENTRIES': 100000},
+    }
+}
+
+
 # Password validation
 # https://docs.djangoproject.com/en/3.2/ref/settings/#auth-password-validators
 
@@ -0,0 +1,113 @@
+"""
+Shared Caches
+
+This module keeps values loaded from the database in Django's cache
+framework, for the kit, barcode and unit caches.
+
+A SharedCache is a namespace of keys in one cache backend. Discarding keys
+deletes them from the backend, so with a backend every worker talks to
+(see CACHES in the settings) a change made by one process reaches all of
+them at once instead of after the entries expire. Discards are repeated
+when the transaction commits, so a read made in between does not keep the
+old value, and a load that started before a discard is not stored.
+"""
+
+import hashlib
+import time
+
+from django.core.cache import DEFAULT_CACHE_ALIAS, caches
+from django.db import transaction
+
+
+class SharedCache:
+    """Values loaded in bulk and kept under the keys of a namespace.
+
+    Entries expire after ttl seconds. clear() drops the whole namespace by
+    moving it to a new version.
+    """
+
+    def __init__(self, namespace, ttl=300, alias=DEFAULT_CACHE_ALIAS):
+        self.namespace = namespace
+        self.ttl = ttl
+        self.alias = alias
+        self._version_key = f'{namespace}:version'
+        # Bumped by every discard so loads racing it are not stored
+        self._generation_key = f'{namespace}:generation'
+
+    @property
+    def cache(self):
+        return caches[self.alias]
+
+    def _bump(self, counter):
+        try:
+            self.cache.incr(counter)
+        except ValueError:
+            # A lost counter starts from the clock so it never returns to an old value
+            self.cache.add(counter, time.time_ns(), timeout=None)
+
+    def _names(self, keys, version):
+        """Maps backend keys to keys; hashing keeps any key valid for every backend."""
+        return {
+            f'{self.namespace}:{version}:{hashlib.md5(str(key).encode()).hexdigest()}': key
+            for key in keys
+        }
+
+    def _counters(self):
+        counters = self.cache.get_many([self._version_key, self._generation_key])
+        version = counters.get(self._version_key)
+        if version is None:
+            self._bump(self._version_key)
+            version = self.cache.get(self._version_key)
+        return version, counters.get(self._generation_key)
+
+    def get_many(self, keys, load):
+        """Returns {key: value} for the keys, loading the missing ones with one load(missing) call.
+
+        load returns a dict; keys it leaves out are not cached.
+        """
+        keys = set(keys)
+        if not keys:
+            return {}
+        version, generation = self._counters()
+        names = self._names(keys, version)
+        result = {names[name]: value for name, value in self.cache.get_many(list(names)).items()}
+
+        missing = keys - set(result)
+        if missing:
+            loaded = load(missing)
+            if self.cache.get(self._generation_key) == generation:
+                self.set_many(loaded, version)
+            result.update(loaded)
+        return result
+
+    def set_many(self, values, version=None):
+        """Stores {key: value} in the namespace."""
+        if not values:
+            return
+        if version is None:
+            version, _ = self._counters()
+        names = {key: name for name, key in self._names(values, version).items()}
+        self.cache.set_many({names[key]: value for key, value in values.items()}, timeout=self.ttl)
+
+    def discard(self, keys):
+        """Drops the keys, now and again when the transaction commits."""
+        keys = list(keys)
+        if not keys:
+            return
+
+        def discard():
+            self._bump(self._generation_key)
+            version, _ = self._counters()
+            self.cache.delete_many(list(self._names(keys, version)))
+
+        discard()
+        transaction.on_commit(discard)
+
+    def clear(self):
+        """Drops every key of the namespace, now and again when the transaction commits."""
+        def clear():
+            self._bump(self._generation_key)
+            self._bump(self._version_key)
+
+        clear()
+        transaction.on_commit(clear)
@@ -0,0 +1,147 @@
+"""
+Cycle Counts
+
+This module runs count sessions for stores and sale points.
+
+Opening a session copies the balances of its location into CountLines as
+the expected quantities, with one read and bulk inserts. Counts arrive in
+batches from any number of devices and are added to the lines with one
+UPDATE per batch, so devices counting the same item on different shelves
+add up instead of overwriting each other. Posting writes one Adjustment per
+variance with a bulk insert and moves all the stock in a single
+post_document call, however many lines were counted.
+"""
+
+from django.core.exceptions import ValidationError
+from django.db import transaction
+from django.db.models import Case, F, IntegerField, Value, When
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from .models import Adjustment, CountLine, CountSession, Item, SalePointItem, StoreItem
+from .stock import StockLine, post_document, retry_on_deadlock
+
+
+@transaction.atomic
+def open_session(employee, store=None, sale_point=None, notes=None, batch_size=1000):
+    """Opens a count session and freezes the expected quantities of its location."""
+    if (store is None) == (sale_point is None):
+        raise ValidationError("A count session needs either a store or a sale point")
+    location = store or sale_point
+    if location.status != 'active':
+        raise ValidationError(f"Cannot count an inactive {location._meta.verbose_name.lower()}")
+
+    session = CountSession.objects.create(store=store, sale_point=sale_point, opened_by=employee, notes=notes)
+    if store is not None:
+        balances = StoreItem.objects.filter(store=store)
+    else:
+        balances = SalePointItem.objects.filter(sale_point=sale_point)
+    CountLine.objects.bulk_create(
+        (
+            CountLine(session=session, item_id=item_id, expected=quantity)
+            for item_id, quantity in balances.values_list('item_id', 'quantity').iterator(chunk_size=batch_size)
+        ),
+        batch_size=batch_size,
+    )
+    return session
+
+
+@transaction.atomic
+def record_counts(session, counts, replace=False):
+    """Adds counted quantities to the lines of an open session.
+
+    counts maps item ids to quantities. Items the location had no balance
+    for get a line expecting zero. With replace=True the quantities replace
+    earlier counts, for recounts. Returns the number of lines updated.
+    Raises ValidationError with code 'unknown_item' if an item does not exist.
+    """
+    counts = {item_id: quantity for item_id, quantity in counts.items() if quantity or replace}
+    if not counts:
+        return 0
+    if not CountSession.objects.filter(pk=session.pk, status='open').exists():
+        raise ValidationError("Counts can only be recorded while the session is open")
+    unknown = set(counts) - set(Item.objects.filter(pk__in=counts).values_list('pk', flat=True))
+    if unknown:
+        raise ValidationError(
+            f"Unknown items: {', '.join(map(str, sorted(unknown)))}", code='unknown_item'
+        )
+
+    CountLine.objects.bulk_create(
+        [CountLine(session_id=session.pk, item_id=item_id) for item_id in sorted(counts)],
+        ignore_conflicts=True,
+    )
+    whens = [When(item_id=item_id, then=Value(quantity)) for item_id, quantity in counts.items()]
+    quantity = Case(*whens, output_field=IntegerField())
+    # The status check is repeated in the UPDATE so counts racing a post are not applied after it
+    return CountLine.objects.filter(session_id=session.pk, session__status='open', item_id__in=counts).update(
+        counted=quantity if replace else Coalesce(F('counted'), 0) + quantity,
+        counted_at=timezone.now(),
+    )
+
+
+def variance_lines(session):
+    """Returns (item id, variance) for every counted line that differs from expected."""
+    return list(
+        session.lines.filter(counted__isnull=False).exclude(counted=F('expected')).annotate(
+            variance=F('counted') - F('expected')
+        ).order_by('item_id').values_list('item_id', 'variance')
+    )
+
+
+def post_session(session, employee, reason=None):
+    """Posts the variances of an open session as Adjustments in one transaction.
+
+    Items that were never counted are left alone. The variance is applied
+    on top of the current stock, so movements made while counting are kept.
+    Returns the number of adjustments, or None if the session was not open.
+    """
+    posted_at = timezone.now()
+    reason = reason or f"Cycle count #{session.pk}"
+
+    @retry_on_deadlock
+    @transaction.atomic
+    def post():
+        # Claiming the session first makes concurrent posts apply it only once
+        claimed = CountSession.objects.filter(pk=session.pk, status='open').update(
+            status='posted', posted_by=employee, posted_at=posted_at
+        )
+        if not claimed:
+            return None
+        variances = variance_lines(session)
+        Adjustment.objects.bulk_create([
+            Adjustment(
+                item_id=item_id,
+                quantity=variance,
+                reason=reason,
+                user_responsible=employee,
+                in_store=session.store_id is not None,
+                store_id=session.store_id,
+                sale_point_id=session.sale_point_id,
+                count_session=session,
+            )
+            for item_id, variance in variances
+        ], batch_size=1000)
+        post_document(
+            [
+                StockLine(item_id, variance, store_id=session.store_id, sale_point_id=session.sale_point_id)
+                for item_id, variance in variances
+            ],
+            source=session,
+            lock_rows=True,
+        )
+        return len(variances)
+
+    posted = post()
+    if posted is not None:
+        session.status = 'posted'
+        session.posted_by = employee
+        session.posted_at = posted_at
+    return posted
+
+
+def cancel_session(session):
+    """Cancels an open session without posting anything. Returns True if it was open."""
+    cancelled = CountSession.objects.filter(pk=session.pk, status='open').update(status='cancelled')
+    if cancelled:
+        session.status = 'cancelled'
+    return bool(cancelled)
@@ -0,0 +1,200 @@
+"""
+Demand Forecasting
+
+This module suggests reorder points and optimum stock levels from sales
+history.
+
+Daily sales of every item at every sale point are loaded into NumPy arrays,
+one row per (item, sale point) series, and forecast with simple exponential
+smoothing, or with Croston's method for intermittent series. The recursions
+step through the days once and update every series at the same time, so the
+cost grows with the number of days rather than with Python work per item.
+The per sale point forecasts are added up per item and turned into a
+reorder point (lead time demand plus safety stock) and an optimum stock
+(reorder point plus one review period of demand).
+"""
+
+from datetime import timedelta
+
+import numpy as np
+from django.db.models import F
+from django.db.models.functions import TruncDate
+from django.utils import timezone
+
+from sales.models import SaleItem, SaleKit
+from .models import Item
+from .reorder import refresh_reorder_queue
+
+# Series with demand on fewer days than this share are treated as intermittent
+INTERMITTENT_SHARE = 1 / 1.32
+
+
+def load_demand(start, days):
+    """Loads units sold per day and series since start.
+
+    Returns (series keys, series index, day index, quantities) where series
+    keys are the (item id, sale point id) pairs and the other arrays hold one
+    entry per series and day with sales, sorted by series. Kit sales count
+    towards the items the kits are made of. Cancelled sales are ignored.
+    """
+    sales = {
+        'sale__date__date__gte': start,
+        'sale__date__date__lt': start + timedelta(days=days),
+    }
+    item_rows = SaleItem.objects.filter(**sales).exclude(
+        sale__payment_status='cancelled'
+    ).values_list(
+        'item_id', 'sale__sale_point_id', TruncDate('sale__date'), 'quantity'
+    )
+    kit_rows = SaleKit.objects.filter(**sales).exclude(
+        sale__payment_status='cancelled'
+    ).values_list(
+        'kit__itemkititem__item_id', 'sale__sale_point_id', TruncDate('sale__date'),
+        F('quantity') * F('kit__itemkititem__quantity'),
+    )
+
+    columns = [[], [], [], []]
+    for rows in (item_rows, kit_rows):
+        for item_id, sale_point_id, day, quantity in rows.iterator(chunk_size=10000):
+            if item_id is None:
+                continue
+            columns[0].append(item_id)
+            columns[1].append(sale_point_id)
+            columns[2].append((day - start).days)
+            columns[3].append(quantity)
+    item_ids, sale_point_ids, day_index, quantities = (
+        np.asarray(column, dtype=np.int64) for column in columns
+    )
+
+    keys, series_index = np.unique(
+        np.stack([item_ids, sale_point_ids], axis=1).reshape(-1, 2), axis=0, return_inverse=True
+    )
+    series_index = series_index.ravel()
+    order = np.argsort(series_index, kind='stable')
+    return keys, series_index[order], day_index[order], quantities[order]
+
+
+def demand_matrix(days, first, last, series_index, day_index, quantities):
+    """Returns the days x series matrix of demand for the series first to last - 1."""
+    low, high = np.searchsorted(series_index, [first, last])
+    matrix = np.zeros((days, last - first))
+    np.add.at(matrix, (day_index[low:high], series_index[low:high] - first), quantities[low:high])
+    return matrix
+
+
+def smooth(demand, alpha):
+    """Runs exponential smoothing and Croston's method over every column at once.
+
+    Returns the forecast daily demand of each series and the standard
+    deviation of its one step ahead errors.
+    """
+    days, series = demand.shape
+    level = demand[0].copy()
+    squared_error = np.zeros(series)
+
+    # Croston: smoothed size of non-zero demand and interval between them.
+    # The interval starts from the gap between the first two demands.
+    size = np.zeros(series)
+    interval = np.zeros(series)
+    since_demand = np.zeros(series)
+    demands_seen = np.zeros(series, dtype=np.int64)
+
+    for day in range(days):
+        observed = demand[day]
+        if day:
+            squared_error += (observed - level) ** 2
+            level += alpha * (observed - level)
+
+        has_demand = observed > 0
+        first = has_demand & (demands_seen == 0)
+        later = has_demand & (demands_seen > 0)
+        size = np.where(first, observed, np.where(later, size + alpha * (observed - size), size))
+        interval = np.where(
+            later & (demands_seen == 1),
+            since_demand,
+            np.where(later, interval + alpha * (since_demand - interval), interval)
+        )
+        demands_seen += has_demand
+        since_demand = np.where(has_demand, 1, since_demand + 1)
+
+    demand_days = np.count_nonzero(demand, axis=0)
+    # A single demand in the history is spread over the whole history
+    interval = np.where(demands_seen == 1, days, interval)
+    croston = np.divide(size, interval, out=np.zeros(series), where=interval > 0)
+    forecast = np.where(demand_days < INTERMITTENT_SHARE * days, croston, np.maximum(level, 0))
+    deviation = np.sqrt(squared_error / max(days - 1, 1))
+    return forecast, deviation
+
+
+def suggest_levels(item_ids, forecast, deviation, lead_times, service_factor, review_days):
+    """Returns (reorder points, optimum stocks) per item from per series forecasts.
+
+    item_ids lists the item of each series, lead_times the lead time of each
+    distinct item in np.unique(item_ids) order.
+    """
+    items, item_index = np.unique(item_ids, return_inverse=True)
+    daily = np.bincount(item_index, weights=forecast, minlength=len(items))
+    variance = np.bincount(item_index, weights=deviation ** 2, minlength=len(items))
+
+    lead_times = np.maximum(lead_times, 1)
+    safety_stock = service_factor * np.sqrt(variance * lead_times)
+    reorder_points = np.ceil(daily * lead_times + safety_stock)
+    optimum_stocks = reorder_points + np.ceil(daily * review_days)
+    return reorder_points.astype(np.int64), optimum_stocks.astype(np.int64)
+
+
+def forecast_reorder_levels(history_days=730, alpha=0.1, service_factor=1.65, review_days=30,
+                            batch_size=1000, chunk_size=10000):
+    """Writes suggested reorder points and optimum stocks for every item with sales.
+
+    Item.clean() requires reorder_point <= minimum_stock <= optimum_stock, so
+    minimum_stock is raised to the suggested reorder point where needed and
+    the optimum never drops below the minimum. Returns the number of items
+    updated.
+    """
+    start = timezone.localdate() - timedelta(days=history_days)
+    keys, series_index, day_index, quantities = load_demand(start, history_days)
+    if not len(keys):
+        return 0
+
+    # Smooth a slice of the series at a time to bound the matrix size
+    forecast = np.zeros(len(keys))
+    deviation = np.zeros(len(keys))
+    for first in range(0, len(keys), chunk_size):
+        last = min(first + chunk_size, len(keys))
+        demand = demand_matrix(history_days, first, last, series_index, day_index, quantities)
+        forecast[first:last], deviation[first:last] = smooth(demand, alpha)
+
+    series_items = keys[:, 0]
+    item_ids = np.unique(series_items)
+    items = {}
+    for offset in range(0, len(item_ids), batch_size):
+        items.update(
+            (item.pk, item)
+            for item in Item.objects.filter(
+                pk__in=item_ids[offset:offset + batch_size].tolist(), status='active', is_service=False
+            ).only('pk', 'lead_time_days', 'minimum_stock', 'reorder_point', 'optimum_stock')
+        )
+    lead_times = np.array([items[pk].lead_time_days if pk in items else 0 for pk in item_ids.tolist()])
+    reorder_points, optimum_stocks = suggest_levels(
+        series_items, forecast, deviation, lead_times, service_factor, review_days
+    )
+
+    updated = []
+    suggestions = zip(item_ids.tolist(), reorder_points.tolist(), optimum_stocks.tolist())
+    for pk, reorder_point, optimum_stock in suggestions:
+        item = items.get(pk)
+        if item is None:
+            continue
+        item.reorder_point = reorder_point
+        item.minimum_stock = max(item.minimum_stock, reorder_point)
+        item.optimum_stock = max(optimum_stock, item.minimum_stock)
+        updated.append(item)
+
+    Item.objects.bulk_update(
+        updated, ['reorder_point', 'minimum_stock', 'optimum_stock'], batch_size=batch_size
+    )
+    updated_ids = [item.pk for item in updated]
+    for offset in range(0, len(updated_ids), batch_size):
+        refresh_reorder_queue(updated_ids[offset:offset + batch_size])
+    return len(updated)
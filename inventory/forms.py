@@ -6,6 +6,7 @@ from .models import *
 from company.models import Branch,Department,Category
 from django.core.exceptions import ValidationError
 from django.utils import timezone
+from .units import unit_cache
 
 class StoreForm(forms.ModelForm):
     """Form for creating and editing stores."""
@@ -146,6 +147,20 @@ class ItemForm(forms.ModelForm):
 
         return cleaned_data
 
+class ItemImportForm(forms.Form):
+    """Form for uploading an item catalog."""
+
+    file = forms.FileField(
+        help_text='CSV or XLSX file with a header row. Required columns: name, department, category.',
+        widget=forms.ClearableFileInput(attrs={'class': 'form-control', 'accept': '.csv,.xlsx'})
+    )
+
+    def clean_file(self):
+        file = self.cleaned_data['file']
+        if not file.name.lower().endswith(('.csv', '.xlsx')):
+            raise ValidationError('Only .csv and .xlsx files can be imported.')
+        return file
+
 class ItemKitForm(forms.ModelForm):
     class Meta:
         model = ItemKit
@@ -189,7 +204,7 @@ class AdjustmentForm(forms.ModelForm):
     
     class Meta:
         model = Adjustment
-        fields = ['item', 'quantity', 'reason']
+        fields = ['item', 'quantity', 'reason', 'in_store', 'store', 'sale_point']
         widgets = {
             'reason': forms.Textarea(attrs={'rows': 3}),
         }
@@ -199,12 +214,38 @@ class AdjustmentForm(forms.ModelForm):
         quantity = cleaned_data.get('quantity')
         item = cleaned_data.get('item')
 
+        # The adjustment is posted to the store or the sale point, not both
+        if cleaned_data.get('in_store'):
+            cleaned_data['sale_point'] = None
+            if not cleaned_data.get('store'):
+                self.add_error('store', 'Select the store to adjust.')
+        else:
+            cleaned_data['store'] = None
+            if not cleaned_data.get('sale_point'):
+                self.add_error('sale_point', 'Select the sale point to adjust.')
+
         if item and quantity:
             if quantity < 0 and abs(quantity) > item.total_stock():
                 raise ValidationError('Adjustment quantity cannot exceed available stock.')
 
         return cleaned_data
 
+class CountSessionForm(forms.ModelForm):
+    """Form for opening a cycle count of a store or sale point."""
+
+    class Meta:
+        model = CountSession
+        fields = ['store', 'sale_point', 'notes']
+        widgets = {
+            'notes': forms.Textarea(attrs={'rows': 3}),
+        }
+
+    def clean(self):
+        cleaned_data = super().clean()
+        if bool(cleaned_data.get('store')) == bool(cleaned_data.get('sale_point')):
+            raise ValidationError('Select either a store or a sale point to count.')
+        return cleaned_data
+
 class RequisitionForm(forms.ModelForm):
     """Form for creating requisitions."""
     
@@ -235,6 +276,119 @@ class ReceivingForm(forms.ModelForm):
             raise ValidationError('Receiving date cannot be in the future.')
         return receiving_date
 
+class UnitChoiceIterator(forms.models.ModelChoiceIterator):
+    """Lists the units given to the field instead of querying its queryset."""
+
+    def __iter__(self):
+        if self.field.empty_label is not None:
+            yield ('', self.field.empty_label)
+        for unit in self.field.units.values():
+            yield self.choice(unit)
+
+    def __len__(self):
+        return len(self.field.units) + (self.field.empty_label is not None)
+
+
+class ItemUnitChoiceField(forms.ModelChoiceField):
+    """Unit choice resolved from a preloaded list of units, without a query per line."""
+
+    iterator = UnitChoiceIterator
+
+    def __init__(self, **kwargs):
+        super().__init__(ItemUnit.objects.none(), **kwargs)
+        self.units = {}
+
+    def set_units(self, units):
+        """Offers the units, given as dicts from the unit cache."""
+        self.units = {}
+        for unit in units:
+            instance = ItemUnit(
+                pk=unit['id'], item_id=unit['item_id'], unit=unit['unit'], smallest_units=unit['smallest_units'],
+                buying_price=unit['buying_price'], selling_price=unit['selling_price'],
+            )
+            instance.label = unit['label']
+            self.units[str(unit['id'])] = instance
+
+    def label_from_instance(self, obj):
+        return obj.label
+
+    def to_python(self, value):
+        if value in self.empty_values:
+            return None
+        unit = self.units.get(str(getattr(value, 'pk', value)))
+        if unit is None:
+            raise ValidationError(self.error_messages['invalid_choice'], code='invalid_choice')
+        return unit
+
+
+class ItemUnitFormMixin:
+    """Offers a line only the units of its item.
+
+    Formsets pass the units of all their lines' items in units, loaded
+    together; a form used on its own loads the units of its item.
+    """
+
+    def __init__(self, *args, units=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        item_id = self.line_item_id()
+        if units is None:
+            units = unit_cache.units([item_id] if item_id else [])
+        self.fields['unit'].set_units(units.get(item_id, []))
+
+    def _get_validation_exclusions(self):
+        # The unit was already matched against the loaded units of the item
+        exclude = super()._get_validation_exclusions()
+        exclude.add('unit')
+        return exclude
+
+    def line_item_id(self):
+        if self.is_bound:
+            value = self.data.get(self.add_prefix('item'))
+        else:
+            value = self.initial.get('item', self.instance.item_id)
+        try:
+            return int(value)
+        except (TypeError, ValueError):
+            return None
+
+
+class ItemUnitInlineFormSet(forms.BaseInlineFormSet):
+    """Inline formset of item lines whose units are loaded once for every line."""
+
+    def get_form_kwargs(self, index):
+        kwargs = super().get_form_kwargs(index)
+        kwargs['units'] = self.units
+        return kwargs
+
+    @property
+    def units(self):
+        if not hasattr(self, '_units'):
+            item_ids = set()
+            if self.is_bound:
+                for name, value in self.data.items():
+                    if name.startswith(f'{self.prefix}-') and name.endswith('-item'):
+                        try:
+                            item_ids.add(int(value))
+                        except (TypeError, ValueError):
+                            pass
+            else:
+                item_ids.update(line.item_id for line in self.get_queryset())
+            self._units = unit_cache.units(item_ids)
+        return self._units
+
+
+class ReceivedItemForm(ItemUnitFormMixin, forms.ModelForm):
+    unit = ItemUnitChoiceField()
+
+    class Meta:
+        model = ReceivedItem
+        fields = ['item', 'unit', 'quantity', 'unit_price', 'total_cost', 'lot_number', 'expiry_date']
+
+ReceivedItemFormSet = forms.inlineformset_factory(
+    Receiving, ReceivedItem, form=ReceivedItemForm, formset=ItemUnitInlineFormSet,
+    extra=1, can_delete=True
+)
+
 class IssueForm(forms.ModelForm):
     """Form for recording issued items."""
     
@@ -281,49 +435,27 @@ class TransferForm(forms.ModelForm):
             'onchange': 'handleTransferTypeChange(this.value)'
         })
 
-class TransferItemForm(forms.ModelForm):
+class TransferItemForm(ItemUnitFormMixin, forms.ModelForm):
+    unit = ItemUnitChoiceField()
+
     class Meta:
         model = TransferItem
         fields = ['item', 'unit', 'quantity']
 
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-        self.fields['unit'].queryset = ItemUnit.objects.all()
-
-        if 'item' in self.data:
-            try:
-                item_id = int(self.data.get('item'))
-                self.fields['unit'].queryset = ItemUnit.objects.filter(item_id=item_id)
-            except (ValueError, TypeError):
-                pass
-        elif self.instance.pk and self.instance.item:
-            self.fields['unit'].queryset = ItemUnit.objects.filter(item=self.instance.item)
-
 TransferItemFormSet = forms.inlineformset_factory(
-    Transfer, TransferItem, form=TransferItemForm,
+    Transfer, TransferItem, form=TransferItemForm, formset=ItemUnitInlineFormSet,
     extra=1, can_delete=True
 )
 
-class IssueItemForm(forms.ModelForm):
+class IssueItemForm(ItemUnitFormMixin, forms.ModelForm):
+    unit = ItemUnitChoiceField()
+
     class Meta:
         model = IssuedItem
         fields = ['item', 'unit', 'quantity']
 
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-        self.fields['unit'].queryset = ItemUnit.objects.all()
-
-        if 'item' in self.data:
-            try:
-                item_id = int(self.data.get('item'))
-                self.fields['unit'].queryset = ItemUnit.objects.filter(item_id=item_id)
-            except (ValueError, TypeError):
-                pass
-        elif self.instance.pk and self.instance.item:
-            self.fields['unit'].queryset = ItemUnit.objects.filter(item=self.instance.item)
-
 IssueItemFormSet = forms.inlineformset_factory(
-    Issue, IssuedItem, form=IssueItemForm,
+    Issue, IssuedItem, form=IssueItemForm, formset=ItemUnitInlineFormSet,
     extra=1, can_delete=True
 )
 
@@ -0,0 +1,150 @@
+"""
+Idempotent Requests
+
+This module lets clients retry write requests without applying them twice.
+
+A POST carrying an Idempotency-Key header (or an idempotency_key field) is
+run inside one transaction together with the insert of its IdempotencyKey
+row, and the response is stored on that row before the transaction
+commits. A retry with the same key then gets the stored response back
+without running the view again. A retry arriving while the first request
+is still running waits on the unique index until it commits. A request
+that raises, or whose response the view marked with not_stored(), leaves
+no row, so its retry runs afresh, and deadlocks are retried around the
+whole request. Keys expire after a day and are removed in bulk by the
+purge_idempotency_keys command.
+"""
+
+import hashlib
+import json
+import uuid
+from datetime import timedelta
+from functools import wraps
+
+from django.db import IntegrityError, transaction
+from django.http import HttpResponse, JsonResponse
+from django.utils import timezone
+
+from .models import IdempotencyKey
+from .stock import retry_on_deadlock
+
+IDEMPOTENCY_HEADER = 'HTTP_IDEMPOTENCY_KEY'
+IDEMPOTENCY_FIELD = 'idempotency_key'
+IDEMPOTENCY_KEY_TTL = timedelta(hours=24)
+MAX_KEY_LENGTH = 100
+
+# Headers that belong to the original exchange rather than its result
+UNSTORED_HEADERS = {'set-cookie', 'vary', 'date'}
+
+
+def new_key():
+    """Returns a fresh key for a form to send with its POST."""
+    return uuid.uuid4().hex
+
+
+def not_stored(response):
+    """Marks a response, such as an error redirect, as not to be replayed.
+
+    The request's writes and key are rolled back, so a retry with the same
+    key runs the view again.
+    """
+    response.idempotent_store = False
+    return response
+
+
+def request_key(request):
+    return request.META.get(IDEMPOTENCY_HEADER) or request.POST.get(IDEMPOTENCY_FIELD)
+
+
+def request_hash(request):
+    """Fingerprints the user, path and form or JSON data of a request."""
+    if request.content_type == 'application/json':
+        data = request.body.decode(errors='replace')
+    else:
+        data = sorted(
+            (name, values) for name, values in request.POST.lists()
+            if name not in (IDEMPOTENCY_FIELD, 'csrfmiddlewaretoken')
+        )
+    payload = json.dumps([request.user.pk, request.path, data], sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+def stored_response(record):
+    response = HttpResponse(bytes(record.content), status=record.status_code)
+    for name, value in record.headers.items():
+        response[name] = value
+    response['Idempotent-Replayed'] = 'true'
+    return response
+
+
+def idempotent(scope, ttl=IDEMPOTENCY_KEY_TTL):
+    """Makes a view replay its first response to POSTs sent again with the same key.
+
+    scope keeps the keys of different endpoints apart. Requests without a
+    key and non-POST requests run the view as usual.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            key = request_key(request)
+            if request.method != 'POST' or not key:
+                return view(request, *args, **kwargs)
+            if len(key) > MAX_KEY_LENGTH:
+                return JsonResponse(
+                    {'error': f'Idempotency keys are at most {MAX_KEY_LENGTH} characters'}, status=400
+                )
+            fingerprint = request_hash(request)
+
+            @retry_on_deadlock
+            @transaction.atomic
+            def run():
+                now = timezone.now()
+                IdempotencyKey.objects.filter(scope=scope, key=key, expires_at__lte=now).delete()
+                try:
+                    # A concurrent request with the same key blocks here until it commits
+                    with transaction.atomic():
+                        record = IdempotencyKey.objects.create(
+                            scope=scope, key=key, request_hash=fingerprint, status_code=0,
+                            content=b'', created_at=now, expires_at=now + ttl,
+                        )
+                except IntegrityError:
+                    record = IdempotencyKey.objects.get(scope=scope, key=key)
+                    if record.request_hash != fingerprint:
+                        return JsonResponse(
+                            {'error': 'This idempotency key was already used for a different request'},
+                            status=422,
+                        )
+                    return stored_response(record)
+
+                response = view(request, *args, **kwargs)
+                if not getattr(response, 'idempotent_store', True) or response.status_code >= 500:
+                    transaction.set_rollback(True)
+                    return response
+                if response.streaming:
+                    raise ValueError(f'{view.__name__} returns a streaming response and cannot be idempotent')
+                record.status_code = response.status_code
+                record.headers = {
+                    name: value for name, value in response.items() if name.lower() not in UNSTORED_HEADERS
+                }
+                record.content = response.content
+                record.save(update_fields=['status_code', 'headers', 'content'])
+                return response
+
+            return run()
+        return wrapper
+    return decorator
+
+
+def purge_expired_keys(batch_size=5000, now=None):
+    """Deletes expired keys in batches of primary keys. Returns the number deleted."""
+    now = now or timezone.now()
+    deleted = 0
+    while True:
+        pks = list(
+            IdempotencyKey.objects.filter(expires_at__lte=now).order_by('expires_at').values_list(
+                'pk', flat=True
+            )[:batch_size]
+        )
+        if not pks:
+            return deleted
+        deleted += IdempotencyKey.objects.filter(pk__in=pks).delete()[0]
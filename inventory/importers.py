@@ -0,0 +1,253 @@
+"""
+Item Import
+
+This module loads item catalogs from CSV or XLSX files.
+
+Rows are streamed from the file and handled in chunks. Each chunk is
+validated against data preloaded once per import (known barcodes,
+departments and categories) and then written with one bulk insert for the
+items and one for their base units, instead of a form post and two inserts
+per item. Invalid rows are skipped and reported with their row number.
+The whole import runs in one transaction, so a file that fails part way
+through, such as one that cannot be decoded or read, leaves no items behind.
+"""
+
+import csv
+import io
+import secrets
+from collections import defaultdict, namedtuple
+from decimal import Decimal, InvalidOperation
+
+from django.db import connection, transaction
+
+from company.models import Category, Department
+from .models import Item, ItemUnit
+from .reorder import refresh_reorder_queue
+from .search import index_items
+
+RowError = namedtuple('RowError', ['row', 'message'])
+
+ImportResult = namedtuple('ImportResult', ['created', 'errors'])
+
+# Optional columns copied onto the Item as they are; other columns are ignored
+INTEGER_COLUMNS = (
+    'initial_stock', 'minimum_stock', 'optimum_stock', 'reorder_point', 'lead_time_days', 'warranty_period',
+)
+TEXT_COLUMNS = ('location', 'dimensions', 'manufacturer', 'model_number', 'serial_number', 'notes')
+STATUSES = {value for value, _ in Item.STATUS_CHOICES}
+MAX_PRICE = Decimal(10) ** 8
+
+
+def read_csv(file):
+    """Yields the rows of a binary CSV file as dicts keyed by lowercase column name."""
+    text = io.TextIOWrapper(file, encoding='utf-8-sig', newline='')
+    reader = csv.reader(text)
+    header = [column.strip().lower() for column in next(reader, [])]
+    for values in reader:
+        yield dict(zip(header, values))
+
+
+def read_xlsx(file):
+    """Yields the rows of the first sheet of an XLSX file as dicts."""
+    try:
+        from openpyxl import load_workbook
+    except ImportError:
+        raise ImportError('Importing XLSX files requires openpyxl')
+
+    sheet = load_workbook(file, read_only=True, data_only=True).worksheets[0]
+    rows = sheet.iter_rows(values_only=True)
+    header = [str(column or '').strip().lower() for column in next(rows, ())]
+    for values in rows:
+        yield {
+            column: '' if value is None else str(value)
+            for column, value in zip(header, values)
+        }
+
+
+def read_rows(file, name):
+    """Returns a row reader for file based on the extension of name."""
+    if name.lower().endswith('.xlsx'):
+        return read_xlsx(file)
+    if name.lower().endswith('.csv'):
+        return read_csv(file)
+    raise ValueError('Only .csv and .xlsx files can be imported')
+
+
+class ItemImporter:
+    """Validates and creates items chunk by chunk.
+
+    Departments and categories may be given by id or by name; a category
+    name is looked up in the row's department first.
+    """
+
+    def __init__(self, chunk_size=1000):
+        self.chunk_size = chunk_size
+        self.bar_codes = set(Item.objects.exclude(bar_code=None).values_list('bar_code', flat=True))
+
+        self.departments = {}
+        for pk, name in Department.objects.values_list('pk', 'department_name'):
+            self.departments[str(pk)] = pk
+            self.departments.setdefault(name.strip().lower(), pk)
+
+        self.categories = {}
+        self.category_departments = {}
+        by_name = defaultdict(set)
+        for pk, name, department_id in Category.objects.values_list('pk', 'category_name', 'department_id'):
+            self.categories[str(pk)] = pk
+            self.categories.setdefault((department_id, name.strip().lower()), pk)
+            self.category_departments[pk] = department_id
+            by_name[name.strip().lower()].add(pk)
+        # A category name that is unique across departments is enough on its own
+        for name, pks in by_name.items():
+            if len(pks) == 1:
+                self.categories.setdefault(name, pks.pop())
+
+    @transaction.atomic
+    def run(self, rows):
+        """Imports rows, an iterable of dicts. Returns an ImportResult.
+
+        Errors raised while reading or writing roll the whole import back.
+        """
+        created = 0
+        errors = []
+        chunk = []
+        # Row 1 is the header
+        for number, row in enumerate(rows, start=2):
+            if not any(str(value).strip() for value in row.values()):
+                continue
+            try:
+                chunk.append(self.build_item(row))
+            except ValueError as e:
+                errors.append(RowError(number, str(e)))
+            if len(chunk) == self.chunk_size:
+                created += self.write(chunk)
+                chunk = []
+        if chunk:
+            created += self.write(chunk)
+        return ImportResult(created, errors)
+
+    def build_item(self, row):
+        """Returns an unsaved Item for row or raises ValueError."""
+        def value(column):
+            return str(row.get(column) or '').strip()
+
+        name = value('name')
+        if not name:
+            raise ValueError('Name is required')
+
+        department_id = self.departments.get(value('department').lower())
+        if department_id is None:
+            raise ValueError(f'Unknown department "{value("department")}"')
+        category = value('category').lower()
+        category_id = self.categories.get((department_id, category)) or self.categories.get(category)
+        if category_id is None:
+            raise ValueError(f'Unknown category "{value("category")}"')
+        if self.category_departments[category_id] != department_id:
+            raise ValueError(f'Category "{value("category")}" is not in department "{value("department")}"')
+
+        bar_code = value('bar_code') or None
+        if bar_code is not None:
+            if len(bar_code) > Item._meta.get_field('bar_code').max_length:
+                raise ValueError(f'Barcode "{bar_code}" is too long')
+            if bar_code in self.bar_codes:
+                raise ValueError(f'An item with barcode "{bar_code}" already exists')
+
+        prices = {}
+        for column in ('buying_price', 'selling_price'):
+            try:
+                prices[column] = Decimal(value(column) or '0').quantize(Decimal('0.01'))
+            except InvalidOperation:
+                raise ValueError(f'{column} "{value(column)}" is not a number')
+            if not prices[column].is_finite():
+                raise ValueError(f'{column} "{value(column)}" is not a number')
+            if prices[column] < 0:
+                raise ValueError(f'{column} cannot be negative')
+            if prices[column] >= MAX_PRICE:
+                raise ValueError(f'{column} is too large')
+        if prices['selling_price'] < prices['buying_price']:
+            raise ValueError('Selling price cannot be less than buying price')
+
+        numbers = {}
+        for column in INTEGER_COLUMNS:
+            try:
+                number = Decimal(value(column) or '0')
+            except InvalidOperation:
+                number = None
+            # Spreadsheets may store whole numbers as 3.0, which is kept; 2.5 is not truncated
+            if number is None or not number.is_finite() or number != number.to_integral_value():
+                raise ValueError(f'{column} "{value(column)}" is not a whole number')
+            numbers[column] = int(number)
+            if numbers[column] < 0:
+                raise ValueError(f'{column} cannot be negative')
+        if numbers['optimum_stock'] < numbers['minimum_stock']:
+            raise ValueError('Optimum stock cannot be less than minimum stock')
+        if numbers['reorder_point'] > numbers['minimum_stock']:
+            raise ValueError('Reorder point cannot be greater than minimum stock')
+
+        status = value('status').lower() or 'active'
+        if status not in STATUSES:
+            raise ValueError(f'Unknown status "{status}"')
+
+        if bar_code is not None:
+            self.bar_codes.add(bar_code)
+        return Item(
+            name=name,
+            bar_code=bar_code,
+            department_id=department_id,
+            category_id=category_id,
+            status=status,
+            smallest_unit=value('smallest_unit') or 'piece',
+            # Item.save() starts new items with their initial stock in the store total
+            store_stock=numbers['initial_stock'],
+            shop_stock=0,
+            **prices,
+            **numbers,
+            **{column: value(column) for column in TEXT_COLUMNS},
+        )
+
+    def write(self, items):
+        """Inserts a chunk of items with their base units. Returns the number created."""
+        if connection.features.can_return_rows_from_bulk_insert:
+            Item.objects.bulk_create(items)
+        else:
+            self.insert_and_assign_pks(items)
+
+        ItemUnit.objects.bulk_create([
+            ItemUnit(
+                item_id=item.pk,
+                unit=item.smallest_unit,
+                smallest_units=1,
+                buying_price=item.buying_price,
+                selling_price=item.selling_price,
+            )
+            for item in items
+        ])
+        index_items(items)
+        refresh_reorder_queue([item.pk for item in items])
+        return len(items)
+
+    @staticmethod
+    def insert_and_assign_pks(items):
+        """Inserts items and sets their pks on databases that do not return them.
+
+        The new rows are read back by barcode, which is unique. Items without
+        a barcode are inserted under a placeholder barcode made for this
+        chunk, which is cleared again once their pks are known.
+        """
+        marker = secrets.token_hex(4)
+        placeholders = []
+        for number, item in enumerate(items):
+            if item.bar_code is None:
+                item.bar_code = f'~{marker}{number}'
+                placeholders.append(item)
+        Item.objects.bulk_create(items)
+
+        pks = dict(
+            Item.objects.filter(bar_code__in=[item.bar_code for item in items]).values_list('bar_code', 'pk')
+        )
+        for item in items:
+            item.pk = pks[item.bar_code]
+        if placeholders:
+            Item.objects.filter(pk__in=[item.pk for item in placeholders]).update(bar_code=None)
+            for item in placeholders:
+                item.bar_code = None
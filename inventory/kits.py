@@ -0,0 +1,130 @@
+"""
+Kit Availability
+
+This module works out how many of each kit a sale point can sell and what
+each kit costs.
+
+A kit can be built as many times as its scarcest component allows: the
+minimum over its components of floor(stock / quantity). The components of
+every kit are loaded together with their stock at the requested sale
+points in one query, and the minimum is taken with NumPy over the whole
+(kit, sale point) matrix at once. Results are kept in the shared cache
+(see inventory.caching) per sale point and dropped when a posting moves
+the stock of a kit component there, when kit contents change or when item
+buying prices change.
+"""
+
+from collections import defaultdict
+from decimal import Decimal
+
+import numpy as np
+from django.db.models import F, FilteredRelation, Q, Sum
+
+from .caching import SharedCache
+from .models import ItemKitItem
+
+
+def kit_availability(sale_point_ids):
+    """Returns ({sale point id: {kit id: buildable kits}}, component item ids).
+
+    Kits missing from a sale point's dict cannot be built there.
+    """
+    sale_point_ids = sorted(set(sale_point_ids))
+    rows = ItemKitItem.objects.filter(quantity__gt=0).annotate(
+        stock=FilteredRelation(
+            'item__salepointitem',
+            condition=Q(item__salepointitem__sale_point_id__in=sale_point_ids),
+        )
+    ).values_list('pk', 'item_kit_id', 'item_id', 'quantity', 'stock__sale_point_id', 'stock__quantity')
+
+    # Each component comes back once per sale point stocking it. A kit
+    # listing the same item twice needs the sum of both quantities.
+    needed = defaultdict(int)
+    seen = set()
+    stock = {}
+    for pk, kit_id, item_id, quantity, sale_point_id, on_hand in rows:
+        if pk not in seen:
+            seen.add(pk)
+            needed[(kit_id, item_id)] += quantity
+        if sale_point_id is not None:
+            stock[(kit_id, item_id, sale_point_id)] = on_hand
+
+    availability = {sale_point_id: {} for sale_point_id in sale_point_ids}
+    component_items = {item_id for _, item_id in needed}
+    if not needed or not stock:
+        return availability, component_items
+
+    kit_ids = np.unique([kit_id for kit_id, _ in needed])
+    components = np.bincount(
+        np.searchsorted(kit_ids, [kit_id for kit_id, _ in needed]), minlength=len(kit_ids)
+    )
+
+    keys = np.array(list(stock), dtype=np.int64)
+    kit_index = np.searchsorted(kit_ids, keys[:, 0])
+    sale_point_index = np.searchsorted(sale_point_ids, keys[:, 2])
+    quantities = np.array([needed[(kit_id, item_id)] for kit_id, item_id, _ in stock], dtype=np.int64)
+    on_hand = np.fromiter(stock.values(), dtype=np.int64, count=len(stock))
+
+    shape = (len(kit_ids), len(sale_point_ids))
+    buildable = np.full(shape, np.iinfo(np.int64).max)
+    np.minimum.at(buildable, (kit_index, sale_point_index), on_hand // quantities)
+    stocked = np.zeros(shape, dtype=np.int64)
+    np.add.at(stocked, (kit_index, sale_point_index), 1)
+    # A component without a stock row at the sale point has none there
+    buildable = np.where(stocked == components[:, None], buildable, 0)
+
+    for kit_position, sale_point_position in zip(*np.nonzero(buildable)):
+        availability[sale_point_ids[sale_point_position]][int(kit_ids[kit_position])] = int(
+            buildable[kit_position, sale_point_position]
+        )
+    return availability, component_items
+
+
+def kit_costs():
+    """Returns {kit id: buying cost of its components} with one aggregate query."""
+    return {
+        kit_id: Decimal(cost)
+        for kit_id, cost in ItemKitItem.objects.values('item_kit_id').annotate(
+            cost=Sum(F('quantity') * F('item__buying_price'))
+        ).values_list('item_kit_id', 'cost')
+    }
+
+
+class KitCache(SharedCache):
+    """Caches kit availability per sale point and kit costs.
+
+    Availability is dropped for the sale points whose component stock
+    moved, and costs when kit contents or buying prices change.
+    """
+
+    def availability(self, sale_point_ids):
+        """Returns {sale point id: {kit id: buildable kits}} for the given sale points."""
+        def load(missing):
+            loaded, component_items = kit_availability(missing)
+            self.set_many({'components': component_items})
+            return loaded
+
+        return self.get_many(sale_point_ids, load)
+
+    def costs(self):
+        """Returns {kit id: buying cost} for every kit with components."""
+        return self.get_many(['costs'], lambda missing: {'costs': kit_costs()})['costs']
+
+    def discard_stock(self, sale_point_items):
+        """Drops the availability of sale points whose component stock moved.
+
+        sale_point_items maps sale point ids to the ids of the items posted
+        there. Without known components every given sale point is dropped.
+        """
+        components = self.get_many(['components'], lambda missing: {}).get('components')
+        self.discard([
+            sale_point_id
+            for sale_point_id, item_ids in sale_point_items.items()
+            if components is None or components.intersection(item_ids)
+        ])
+
+    def discard_costs(self):
+        self.discard(['costs'])
+
+
+kit_cache = KitCache('kits')
@@ -0,0 +1,238 @@
+"""
+Stock Lots
+
+This module keeps lot and expiry level stock in StockLot rows alongside the
+StoreItem and SalePointItem balances.
+
+Lots are created by postings whose lines carry a lot number or an expiry
+date, such as receivings. Every decrement takes stock out of the lots of its
+location first expiry first out, and lots taken out by a document that also
+adds stock elsewhere, such as an issue or a transfer, arrive at the other
+location with the same lot number and expiry. Stock added without lot
+details, such as returns, is left untracked, so a balance may hold more
+than its lots.
+
+Edited documents move lot stock by the change per lot rather than per
+item, so changing only the lot number or expiry of a line moves its
+quantity to the new lot.
+
+Lots carry the branch of their location so that the (branch, expiry date)
+index answers "expiring within N days" for a whole branch with one range
+scan.
+"""
+
+from collections import defaultdict
+from datetime import timedelta
+
+from django.db.models import Case, F, IntegerField, Q, Value, When
+from django.utils import timezone
+
+from .models import SalePoint, StockLot, Store
+
+LOCATION_MODELS = {'store': Store, 'sale_point': SalePoint}
+
+FEFO_ORDER = (F('expiry_date').asc(nulls_last=True), 'received_at', 'pk')
+
+
+def _key_filter(keys):
+    matches = Q()
+    for location_type, location_id, item_id in keys:
+        matches |= Q(**{f'{location_type}_id': location_id}, item_id=item_id)
+    return matches
+
+
+def _subtract(lot_quantities):
+    """Takes {lot pk: quantity} out of lots with one UPDATE and drops emptied lots."""
+    whens = [When(pk=pk, then=Value(quantity)) for pk, quantity in lot_quantities.items()]
+    StockLot.objects.filter(pk__in=lot_quantities).update(
+        quantity=F('quantity') - Case(*whens, default=Value(0), output_field=IntegerField())
+    )
+    StockLot.objects.filter(pk__in=lot_quantities, quantity=0).delete()
+
+
+def consume_lots(decrements):
+    """Takes decrements out of lots first expiry first out.
+
+    decrements maps (location type, location id, item id) to the quantity
+    leaving. Returns {item id: [(lot number, expiry date, quantity)]} of the
+    lot stock taken, in the order it was taken.
+    """
+    consumed = defaultdict(list)
+    if not decrements:
+        return consumed
+
+    remaining = dict(decrements)
+    taken = {}
+    # A locking read sees the lots as other postings left them, not this transaction's snapshot
+    lots = StockLot.objects.select_for_update().filter(
+        _key_filter(decrements), quantity__gt=0
+    ).order_by(*FEFO_ORDER).values_list(
+        'pk', 'store_id', 'sale_point_id', 'item_id', 'lot_number', 'expiry_date', 'quantity'
+    )
+    for pk, store_id, sale_point_id, item_id, lot_number, expiry_date, quantity in lots:
+        key = ('store', store_id, item_id) if store_id is not None else ('sale_point', sale_point_id, item_id)
+        if remaining.get(key, 0) <= 0:
+            continue
+        take = min(remaining[key], quantity)
+        remaining[key] -= take
+        taken[pk] = take
+        consumed[item_id].append((lot_number, expiry_date, take))
+
+    if taken:
+        _subtract(taken)
+    return consumed
+
+
+def receive_lots(increments, lines, consumed):
+    """Adds lots for the netted increments of a posting.
+
+    An increment takes the lot details of its own lines when they have
+    any, otherwise the lots the same posting consumed for the item.
+    """
+    explicit = defaultdict(list)
+    for line in lines:
+        if line.quantity > 0 and (line.lot_number or line.expiry_date):
+            explicit[(*line.location, line.item_id)].append([line.lot_number or '', line.expiry_date, line.quantity])
+    carried = {item_id: [list(piece) for piece in pieces] for item_id, pieces in consumed.items()}
+
+    pieces = defaultdict(int)
+    for key, quantity in sorted(increments.items()):
+        sources = explicit.get(key) or carried.get(key[2], [])
+        while quantity > 0 and sources:
+            lot_number, expiry_date, available = sources[0]
+            take = min(quantity, available)
+            pieces[(key, lot_number, expiry_date)] += take
+            quantity -= take
+            sources[0][2] -= take
+            if not sources[0][2]:
+                sources.pop(0)
+    _add_pieces(pieces)
+
+
+def _lot_filter(pieces):
+    matches = Q()
+    for (location_type, location_id, item_id), lot_number, expiry_date in pieces:
+        matches |= Q(
+            **{f'{location_type}_id': location_id}, item_id=item_id, lot_number=lot_number, expiry_date=expiry_date
+        )
+    return matches
+
+
+def _existing_lots(pieces):
+    """Returns {(location key, lot number, expiry date): (lot pk, quantity)} of the lots already stored.
+
+    The lots are locked so their quantities are current.
+    """
+    existing = {}
+    lots = StockLot.objects.select_for_update().filter(_lot_filter(pieces)).order_by('pk').values_list(
+        'pk', 'store_id', 'sale_point_id', 'item_id', 'lot_number', 'expiry_date', 'quantity'
+    )
+    for pk, store_id, sale_point_id, item_id, lot_number, expiry_date, quantity in lots:
+        key = ('store', store_id, item_id) if store_id is not None else ('sale_point', sale_point_id, item_id)
+        existing.setdefault((key, lot_number, expiry_date), (pk, quantity))
+    return existing
+
+
+def _add_pieces(pieces):
+    """Adds {(location key, lot number, expiry date): quantity} to the lots, creating missing ones."""
+    if not pieces:
+        return
+    # Stock of a lot already at the location tops up its row
+    existing = _existing_lots(pieces)
+    updates = {existing[piece][0]: quantity for piece, quantity in pieces.items() if piece in existing}
+    if updates:
+        whens = [When(pk=pk, then=Value(quantity)) for pk, quantity in updates.items()]
+        StockLot.objects.filter(pk__in=updates).update(
+            quantity=F('quantity') + Case(*whens, default=Value(0), output_field=IntegerField())
+        )
+
+    new_pieces = {piece: quantity for piece, quantity in pieces.items() if piece not in existing}
+    if not new_pieces:
+        return
+    branches = {}
+    for location_type, model in LOCATION_MODELS.items():
+        location_ids = {key[1] for (key, _, _) in new_pieces if key[0] == location_type}
+        if location_ids:
+            branches.update(
+                ((location_type, pk), branch_id)
+                for pk, branch_id in model.objects.filter(pk__in=location_ids).values_list('pk', 'branch_id')
+            )
+    now = timezone.now()
+    StockLot.objects.bulk_create([
+        StockLot(
+            item_id=item_id,
+            **{f'{location_type}_id': location_id},
+            branch_id=branches[(location_type, location_id)],
+            lot_number=lot_number,
+            expiry_date=expiry_date,
+            quantity=quantity,
+            received_at=now,
+        )
+        for ((location_type, location_id, item_id), lot_number, expiry_date), quantity in new_pieces.items()
+    ])
+
+
+def _take_pieces(pieces):
+    """Takes {(location key, lot number, expiry date): quantity} out of those exact lots.
+
+    Stock a lot no longer holds, for example because it was sold, is left
+    to the untracked part of the balance.
+    """
+    if not pieces:
+        return
+    existing = _existing_lots(pieces)
+    taken = {
+        existing[piece][0]: min(quantity, existing[piece][1])
+        for piece, quantity in pieces.items()
+        if piece in existing and existing[piece][1] > 0
+    }
+    if taken:
+        _subtract(taken)
+
+
+def apply_lots(lines, totals):
+    """Moves lot stock for a posting's lines and netted totals."""
+    consumed = consume_lots({key: -quantity for key, quantity in totals.items() if quantity < 0})
+    receive_lots({key: quantity for key, quantity in totals.items() if quantity > 0}, lines, consumed)
+
+
+def expiring_lots(branch, days, today=None):
+    """Returns the lots of a branch with stock that expire within days, soonest first."""
+    today = today or timezone.localdate()
+    return StockLot.objects.filter(
+        branch=branch,
+        expiry_date__gte=today,
+        expiry_date__lte=today + timedelta(days=days),
+        quantity__gt=0,
+    ).order_by('expiry_date', 'pk')
+
+
+def repost_lots(old_lines, new_lines):
+    """Moves lot stock for an edited document by the change per lot.
+
+    Lines with lot details are compared per (location, item, lot number,
+    expiry date), so an edit that only changes a lot number or expiry moves
+    the quantity from the old lot to the new one even though the stock
+    balance does not change. Lines without lot details are netted per item
+    and go through apply_lots as a normal posting does.
+    """
+    tracked = defaultdict(int)
+    untracked_lines = []
+    for sign, lines in ((-1, old_lines), (1, new_lines)):
+        for line in lines:
+            if line.lot_number or line.expiry_date:
+                piece = ((*line.location, line.item_id), line.lot_number or '', line.expiry_date)
+                tracked[piece] += sign * line.quantity
+            else:
+                untracked_lines.append(line._replace(quantity=sign * line.quantity))
+
+    _take_pieces({piece: -quantity for piece, quantity in tracked.items() if quantity < 0})
+    _add_pieces({piece: quantity for piece, quantity in tracked.items() if quantity > 0})
+
+    totals = defaultdict(int)
+    for line in untracked_lines:
+        totals[(*line.location, line.item_id)] += line.quantity
+    totals = {key: quantity for key, quantity in totals.items() if quantity}
+    if totals:
+        apply_lots(untracked_lines, totals)
+
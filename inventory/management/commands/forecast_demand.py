@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand
+from inventory.forecasting import forecast_reorder_levels
+
+
+class Command(BaseCommand):
+    help = 'Suggests item reorder points and optimum stock levels from sales history'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=730, help='Days of sales history to use')
+        parser.add_argument('--alpha', type=float, default=0.1, help='Smoothing factor between 0 and 1')
+        parser.add_argument('--service-factor', type=float, default=1.65,
+                            help='Safety stock in standard deviations of lead time demand')
+        parser.add_argument('--review-days', type=int, default=30,
+                            help='Days of demand the optimum stock covers above the reorder point')
+
+    def handle(self, *args, **options):
+        updated = forecast_reorder_levels(
+            history_days=options['days'],
+            alpha=options['alpha'],
+            service_factor=options['service_factor'],
+            review_days=options['review_days'],
+        )
+        self.stdout.write(self.style.SUCCESS(f'Updated reorder levels of {updated} items'))
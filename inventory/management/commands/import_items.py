@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand, CommandError
+from inventory.importers import ItemImporter, read_rows
+
+
+class Command(BaseCommand):
+    help = 'Imports items from a CSV or XLSX catalog'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='Path to a .csv or .xlsx file with a header row')
+        parser.add_argument('--chunk-size', type=int, default=1000,
+                            help='Number of rows written per bulk insert')
+
+    def handle(self, *args, **options):
+        path = options['path']
+        try:
+            with open(path, 'rb') as file:
+                result = ItemImporter(chunk_size=options['chunk_size']).run(read_rows(file, path))
+        except (OSError, ImportError, ValueError) as e:
+            raise CommandError(str(e))
+
+        for error in result.errors:
+            self.stderr.write(f'Row {error.row}: {error.message}')
+        self.stdout.write(
+            self.style.SUCCESS(f'Imported {result.created} items, skipped {len(result.errors)} rows')
+        )
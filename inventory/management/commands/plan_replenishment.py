@@ -0,0 +1,33 @@
+from django.core.management.base import BaseCommand
+from inventory.replenishment import draft_issues, plan_replenishment
+
+
+class Command(BaseCommand):
+    help = 'Drafts pending issues that refill sale points from the stores of their branch'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--branch', type=int, help='Only plan for the sale points of this branch id')
+        parser.add_argument('--dry-run', action='store_true', help='Report the plan without drafting issues')
+
+    def handle(self, *args, **options):
+        lines = plan_replenishment(branch=options['branch'])
+        units = sum(line.quantity for line in lines)
+        if options['dry_run']:
+            for line in lines:
+                self.stdout.write(
+                    f'store {line.store_id} -> sale point {line.sale_point_id}: '
+                    f'item {line.item_id} x {line.quantity}'
+                )
+            self.stdout.write(self.style.SUCCESS(f'Planned {len(lines)} lines ({units} units)'))
+            return
+        result = draft_issues(lines)
+        for line in result.skipped:
+            self.stderr.write(
+                f'Skipped item {line.item_id} for sale point {line.sale_point_id}: the item has no base unit'
+            )
+        drafted = len(lines) - len(result.skipped)
+        units -= sum(line.quantity for line in result.skipped)
+        self.stdout.write(self.style.SUCCESS(
+            f'Drafted {len(result.issues)} issues with {drafted} lines ({units} units), '
+            f'skipped {len(result.skipped)} lines'
+        ))
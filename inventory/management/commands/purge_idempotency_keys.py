@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+from inventory.idempotency import purge_expired_keys
+
+
+class Command(BaseCommand):
+    help = 'Deletes idempotency keys whose replay window has passed'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=5000,
+                            help='Number of keys deleted per statement')
+
+    def handle(self, *args, **options):
+        deleted = purge_expired_keys(batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f'Purged {deleted} expired idempotency keys'))
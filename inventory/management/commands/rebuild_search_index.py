@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand
+from inventory.models import Item
+from inventory.search import index_items
+
+
+class Command(BaseCommand):
+    help = 'Rebuilds the item search index from item names and barcodes'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help='Number of items indexed per batch')
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        items = Item.objects.order_by('pk').only('pk', 'name', 'bar_code')
+
+        indexed = 0
+        batch = []
+        for item in items.iterator(chunk_size=batch_size):
+            batch.append(item)
+            if len(batch) == batch_size:
+                index_items(batch)
+                indexed += len(batch)
+                batch = []
+        if batch:
+            index_items(batch)
+            indexed += len(batch)
+        self.stdout.write(self.style.SUCCESS(f'Indexed {indexed} items'))
@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand
+from inventory.models import Item
+from inventory.reorder import refresh_reorder_queue
+
+
+class Command(BaseCommand):
+    help = 'Rebuilds the reorder queue from the current stock of every item'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help='Number of items refreshed per query')
+
+    def handle(self, *args, **options):
+        item_ids = list(Item.objects.order_by('pk').values_list('pk', flat=True))
+        batch_size = options['batch_size']
+
+        changed = 0
+        for start in range(0, len(item_ids), batch_size):
+            changed += refresh_reorder_queue(item_ids[start:start + batch_size])
+        self.stdout.write(
+            self.style.SUCCESS(f'Refreshed reorder queue for {len(item_ids)} items, {changed} entries changed')
+        )
@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+from inventory.models import Item
+from inventory.stock import replay_movements
+
+
+class Command(BaseCommand):
+    help = 'Rebuilds store and sale point stock balances from the stock movement ledger'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--item', type=int, action='append', dest='items',
+                            help='Limit the replay to this item id (can be repeated)')
+
+    def handle(self, *args, **options):
+        items = None
+        if options['items']:
+            items = Item.objects.filter(pk__in=options['items'])
+
+        corrected = replay_movements(items)
+        self.stdout.write(
+            self.style.SUCCESS(f'Replayed stock ledger, corrected {corrected} balance rows')
+        )
@@ -0,0 +1,31 @@
+from datetime import datetime, timedelta
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from inventory.stock import take_snapshot
+
+
+class Command(BaseCommand):
+    help = 'Stores the closing stock of every item and location for a day (yesterday by default)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--date', help='Day to snapshot as YYYY-MM-DD')
+        parser.add_argument('--days', type=int, default=1,
+                            help='Number of days up to and including --date to snapshot, oldest first')
+
+    def handle(self, *args, **options):
+        if options['date']:
+            try:
+                last_day = datetime.strptime(options['date'], '%Y-%m-%d').date()
+            except ValueError:
+                raise CommandError('Date must be in YYYY-MM-DD format')
+        else:
+            last_day = timezone.localdate() - timedelta(days=1)
+
+        if last_day >= timezone.localdate():
+            raise CommandError('Only days that have already closed can be snapshot')
+
+        # Oldest first so each day starts from the snapshot of the day before
+        for offset in range(options['days'] - 1, -1, -1):
+            day = last_day - timedelta(days=offset)
+            rows = take_snapshot(day)
+            self.stdout.write(self.style.SUCCESS(f'Snapshot for {day}: {rows} balances'))
@@ -0,0 +1,137 @@
+"""
+Stock Matrix
+
+This module builds the item x location picture of stock across every store
+and sale point.
+
+Items are selected and paged with one values query. The balances of a page
+of items come from one query over both balance tables and are pivoted into
+a NumPy array with one column per location, so no model instances are
+created whatever the number of items and locations. CSV exports walk the
+item list in chunks and yield rows as each chunk is pivoted, which keeps
+memory flat for catalogs of tens of thousands of items.
+"""
+
+import csv
+from collections import namedtuple
+from itertools import chain
+
+import numpy as np
+from django.db.models import F, IntegerField, Value
+
+from .models import Item, SalePoint, SalePointItem, Store, StoreItem
+
+Location = namedtuple('Location', ['type', 'id', 'name'])
+
+# Position of each location type in the matrix columns and location codes
+LOCATION_TYPES = ('store', 'sale_point')
+
+
+def matrix_locations():
+    """Returns every store followed by every sale point, each ordered by name."""
+    return [
+        Location(location_type, pk, name)
+        for location_type, model in zip(LOCATION_TYPES, (Store, SalePoint))
+        for pk, name in model.objects.order_by('name', 'pk').values_list('pk', 'name')
+    ]
+
+
+def matrix_items(department=None, category=None, below_minimum=False):
+    """Returns a values query of (id, name, bar code, minimum stock) for the matrix rows.
+
+    below_minimum keeps the items whose total stock is under their minimum.
+    """
+    items = Item.objects.all()
+    if department:
+        items = items.filter(department_id=department)
+    if category:
+        items = items.filter(category_id=category)
+    if below_minimum:
+        items = items.filter(minimum_stock__gt=F('store_stock') + F('shop_stock'))
+    return items.order_by('name', 'pk').values_list('pk', 'name', 'bar_code', 'minimum_stock')
+
+
+def location_codes(location_types, location_ids):
+    return np.asarray(location_ids, dtype=np.int64) * len(LOCATION_TYPES) + np.asarray(location_types)
+
+
+def stock_matrix(item_ids, locations):
+    """Returns the len(item_ids) x len(locations) array of quantities on hand."""
+    matrix = np.zeros((len(item_ids), len(locations)), dtype=np.int64)
+    if not item_ids or not locations:
+        return matrix
+
+    rows = StoreItem.objects.filter(item_id__in=item_ids).values_list(
+        'item_id', Value(0, output_field=IntegerField()), 'store_id', 'quantity'
+    ).union(
+        SalePointItem.objects.filter(item_id__in=item_ids).values_list(
+            'item_id', Value(1, output_field=IntegerField()), 'sale_point_id', 'quantity'
+        ),
+        all=True,
+    )
+    balances = np.fromiter(chain.from_iterable(rows), dtype=np.int64).reshape(-1, 4)
+    if not len(balances):
+        return matrix
+
+    item_ids = np.asarray(item_ids, dtype=np.int64)
+    item_order = np.argsort(item_ids)
+    codes = location_codes(
+        [LOCATION_TYPES.index(location.type) for location in locations],
+        [location.id for location in locations],
+    )
+    code_order = np.argsort(codes)
+
+    # Balances of locations created after matrix_locations() ran are left out
+    balance_codes = location_codes(balances[:, 1], balances[:, 2])
+    code_positions = np.minimum(np.searchsorted(codes[code_order], balance_codes), len(codes) - 1)
+    known = codes[code_order][code_positions] == balance_codes
+
+    rows = item_order[np.searchsorted(item_ids[item_order], balances[known, 0])]
+    columns = code_order[code_positions[known]]
+    matrix[rows, columns] = balances[known, 3]
+    return matrix
+
+
+def matrix_rows(items, locations):
+    """Returns the JSON rows for a list of (id, name, bar code, minimum stock) items."""
+    quantities = stock_matrix([item[0] for item in items], locations)
+    totals = quantities.sum(axis=1)
+    return [
+        {
+            'id': pk,
+            'name': name,
+            'bar_code': bar_code,
+            'minimum_stock': minimum_stock,
+            'total': total,
+            'quantities': row,
+        }
+        for (pk, name, bar_code, minimum_stock), total, row in zip(
+            items, totals.tolist(), quantities.tolist()
+        )
+    ]
+
+
+class Echo:
+    """File-like object whose write returns the value for streaming."""
+
+    def write(self, value):
+        return value
+
+
+def matrix_csv(items, locations, chunk_size=2000):
+    """Yields CSV lines for the matrix of a values query of items, chunk by chunk."""
+    writer = csv.writer(Echo())
+    yield writer.writerow(
+        ['Item ID', 'Item', 'Barcode', 'Minimum Stock']
+        + [location.name for location in locations]
+        + ['Total']
+    )
+    item_ids = list(items.values_list('pk', flat=True))
+    for offset in range(0, len(item_ids), chunk_size):
+        chunk = list(items.filter(pk__in=item_ids[offset:offset + chunk_size]))
+        for row in matrix_rows(chunk, locations):
+            yield writer.writerow(
+                [row['id'], row['name'], row['bar_code'] or '', row['minimum_stock']]
+                + row['quantities']
+                + [row['total']]
+            )
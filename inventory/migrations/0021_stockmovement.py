@@ -0,0 +1,94 @@
+# Generated by Django 5.2 on 2026-10-18 09:12
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("inventory", "0020_item_created_at_item_dimensions_item_expiry_date_and_more"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="StockMovement",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("quantity", models.IntegerField()),
+                (
+                    "source_type",
+                    models.CharField(
+                        choices=[
+                            ("opening", "Opening Balance"),
+                            ("receiving", "Receiving"),
+                            ("issue", "Issue"),
+                            ("transfer", "Transfer"),
+                            ("adjustment", "Adjustment"),
+                            ("sale", "Sale"),
+                            ("return", "Return"),
+                            ("manual", "Manual"),
+                        ],
+                        default="manual",
+                        max_length=20,
+                    ),
+                ),
+                ("source_id", models.PositiveBigIntegerField(blank=True, null=True)),
+                (
+                    "created_at",
+                    models.DateTimeField(default=django.utils.timezone.now),
+                ),
+                (
+                    "item",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to="inventory.item",
+                    ),
+                ),
+                (
+                    "sale_point",
+                    models.ForeignKey(
+                        blank=True,
+                        null=True,
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to="inventory.salepoint",
+                    ),
+                ),
+                (
+                    "store",
+                    models.ForeignKey(
+                        blank=True,
+                        null=True,
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to="inventory.store",
+                    ),
+                ),
+            ],
+            options={
+                "verbose_name": "Stock Movement",
+                "verbose_name_plural": "Stock Movements",
+                "indexes": [
+                    models.Index(
+                        fields=["store", "item", "created_at"],
+                        name="inventory_s_store_i_f2259e_idx",
+                    ),
+                    models.Index(
+                        fields=["sale_point", "item", "created_at"],
+                        name="inventory_s_sale_po_cc086c_idx",
+                    ),
+                    models.Index(
+                        fields=["source_type", "source_id"],
+                        name="inventory_s_source__18ec1c_idx",
+                    ),
+                ],
+            },
+        ),
+    ]
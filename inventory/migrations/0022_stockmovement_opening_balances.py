@@ -0,0 +1,45 @@
+# Generated by Django 5.2 on 2026-10-18 09:14
+
+from django.db import migrations
+
+
+def create_opening_balances(apps, schema_editor):
+    """Seeds the ledger with the balances that existed before it was introduced."""
+    StockMovement = apps.get_model("inventory", "StockMovement")
+    StoreItem = apps.get_model("inventory", "StoreItem")
+    SalePointItem = apps.get_model("inventory", "SalePointItem")
+
+    movements = [
+        StockMovement(
+            item_id=row.item_id,
+            store_id=row.store_id,
+            quantity=row.quantity,
+            source_type="opening",
+        )
+        for row in StoreItem.objects.exclude(quantity=0).iterator()
+    ]
+    movements += [
+        StockMovement(
+            item_id=row.item_id,
+            sale_point_id=row.sale_point_id,
+            quantity=row.quantity,
+            source_type="opening",
+        )
+        for row in SalePointItem.objects.exclude(quantity=0).iterator()
+    ]
+    StockMovement.objects.bulk_create(movements, batch_size=1000)
+
+
+def delete_opening_balances(apps, schema_editor):
+    StockMovement = apps.get_model("inventory", "StockMovement")
+    StockMovement.objects.filter(source_type="opening").delete()
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("inventory", "0021_stockmovement"),
+    ]
+
+    operations = [
+        migrations.RunPython(create_opening_balances, delete_opening_balances),
+    ]
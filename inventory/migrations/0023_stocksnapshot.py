@@ -0,0 +1,74 @@
+# Generated by Django 5.2 on 2026-10-18 11:05
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("inventory", "0022_stockmovement_opening_balances"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="stockmovement",
+            index=models.Index(
+                fields=["created_at"], name="inventory_s_created_05ebf5_idx"
+            ),
+        ),
+        migrations.CreateModel(
+            name="StockSnapshot",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("date", models.DateField()),
+                ("quantity", models.IntegerField()),
+                (
+                    "item",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to="inventory.item",
+                    ),
+                ),
+                (
+                    "sale_point",
+                    models.ForeignKey(
+                        blank=True,
+                        null=True,
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to="inventory.salepoint",
+                    ),
+                ),
+                (
+                    "store",
+                    models.ForeignKey(
+                        blank=True,
+                        null=True,
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to="inventory.store",
+                    ),
+                ),
+            ],
+            options={
+                "verbose_name": "Stock Snapshot",
+                "verbose_name_plural": "Stock Snapshots",
+                "indexes": [
+                    models.Index(
+                        fields=["date", "store", "item"],
+                        name="inventory_s_date_c8494c_idx",
+                    ),
+                    models.Index(
+                        fields=["date", "sale_point", "item"],
+                        name="inventory_s_date_7d8013_idx",
+                    ),
+                ],
+            },
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 5.2 on 2026-10-18 12:20
+
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery
+
+
+def value_existing_stock(apps, schema_editor):
+    """Values the stock that existed before valuation at the current buying price."""
+    Item = apps.get_model("inventory", "Item")
+    for model_name in ("StoreItem", "SalePointItem"):
+        model = apps.get_model("inventory", model_name)
+        buying_price = Item.objects.filter(pk=OuterRef("item_id")).values("buying_price")
+        model.objects.update(value=models.F("quantity") * Subquery(buying_price))
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("inventory", "0023_stocksnapshot"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="salepointitem",
+            name="value",
+            field=models.DecimalField(decimal_places=4, default=0, max_digits=18),
+        ),
+        migrations.AddField(
+            model_name="storeitem",
+            name="value",
+            field=models.DecimalField(decimal_places=4, default=0, max_digits=18),
+        ),
+        migrations.RunPython(value_existing_stock, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,62 @@
+# Generated by Django 5.2 on 2026-10-18 13:40
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("inventory", "0024_storeitem_value_salepointitem_value"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="ReorderQueue",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "level",
+                    models.CharField(
+                        choices=[
+                            ("reorder", "At Reorder Point"),
+                            ("minimum", "At Minimum Stock"),
+                        ],
+                        max_length=20,
+                    ),
+                ),
+                ("stock", models.IntegerField()),
+                (
+                    "queued_at",
+                    models.DateTimeField(default=django.utils.timezone.now),
+                ),
+                ("updated_at", models.DateTimeField(auto_now=True)),
+                (
+                    "item",
+                    models.OneToOneField(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="reorder_entry",
+                        to="inventory.item",
+                    ),
+                ),
+            ],
+            options={
+                "verbose_name": "Reorder Queue Entry",
+                "verbose_name_plural": "Reorder Queue",
+                "indexes": [
+                    models.Index(
+                        fields=["level", "queued_at"],
+                        name="inventory_r_level_2506a3_idx",
+                    ),
+                ],
+            },
+        ),
+    ]
@@ -0,0 +1,46 @@
+# Generated by Django 5.2 on 2026-10-18 15:10
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("inventory", "0025_reorderqueue"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="ItemSearchTrigram",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("trigram", models.CharField(max_length=3)),
+                (
+                    "item",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="search_trigrams",
+                        to="inventory.item",
+                    ),
+                ),
+            ],
+            options={
+                "verbose_name": "Item Search Trigram",
+                "verbose_name_plural": "Item Search Trigrams",
+                "indexes": [
+                    models.Index(
+                        fields=["trigram", "item"],
+                        name="inventory_i_trigram_7448ac_idx",
+                    ),
+                ],
+            },
+        ),
+    ]
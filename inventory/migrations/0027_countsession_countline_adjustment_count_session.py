@@ -0,0 +1,150 @@
+# Generated by Django 5.2 on 2026-10-18 17:10
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("company", "0007_employee_first_name_employee_last_name_employee_user_and_more"),
+        ("inventory", "0026_itemsearchtrigram"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="CountSession",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "status",
+                    models.CharField(
+                        choices=[
+                            ("open", "Open"),
+                            ("posted", "Posted"),
+                            ("cancelled", "Cancelled"),
+                        ],
+                        default="open",
+                        max_length=20,
+                    ),
+                ),
+                ("opened_at", models.DateTimeField(auto_now_add=True)),
+                ("posted_at", models.DateTimeField(blank=True, null=True)),
+                ("notes", models.TextField(blank=True, null=True)),
+                (
+                    "opened_by",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="count_sessions_opened",
+                        to="company.employee",
+                    ),
+                ),
+                (
+                    "posted_by",
+                    models.ForeignKey(
+                        blank=True,
+                        null=True,
+                        on_delete=django.db.models.deletion.SET_NULL,
+                        related_name="count_sessions_posted",
+                        to="company.employee",
+                    ),
+                ),
+                (
+                    "sale_point",
+                    models.ForeignKey(
+                        blank=True,
+                        null=True,
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to="inventory.salepoint",
+                    ),
+                ),
+                (
+                    "store",
+                    models.ForeignKey(
+                        blank=True,
+                        null=True,
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to="inventory.store",
+                    ),
+                ),
+            ],
+            options={
+                "verbose_name": "Count Session",
+                "verbose_name_plural": "Count Sessions",
+            },
+        ),
+        migrations.CreateModel(
+            name="CountLine",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("expected", models.IntegerField(default=0)),
+                ("counted", models.IntegerField(blank=True, null=True)),
+                ("counted_at", models.DateTimeField(blank=True, null=True)),
+                (
+                    "item",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to="inventory.item",
+                    ),
+                ),
+                (
+                    "session",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="lines",
+                        to="inventory.countsession",
+                    ),
+                ),
+            ],
+            options={
+                "verbose_name": "Count Line",
+                "verbose_name_plural": "Count Lines",
+                "unique_together": {("session", "item")},
+            },
+        ),
+        migrations.AddField(
+            model_name="adjustment",
+            name="count_session",
+            field=models.ForeignKey(
+                blank=True,
+                null=True,
+                on_delete=django.db.models.deletion.SET_NULL,
+                related_name="adjustments",
+                to="inventory.countsession",
+            ),
+        ),
+        migrations.AlterField(
+            model_name="stockmovement",
+            name="source_type",
+            field=models.CharField(
+                choices=[
+                    ("opening", "Opening Balance"),
+                    ("receiving", "Receiving"),
+                    ("issue", "Issue"),
+                    ("transfer", "Transfer"),
+                    ("adjustment", "Adjustment"),
+                    ("countsession", "Cycle Count"),
+                    ("sale", "Sale"),
+                    ("return", "Return"),
+                    ("manual", "Manual"),
+                ],
+                default="manual",
+                max_length=20,
+            ),
+        ),
+    ]
@@ -0,0 +1,100 @@
+# Generated by Django 5.2 on 2026-10-18 17:15
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        (
+            "company",
+            "0007_employee_first_name_employee_last_name_employee_user_and_more",
+        ),
+        ("inventory", "0027_countsession_countline_adjustment_count_session"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="StockLot",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("lot_number", models.CharField(blank=True, default="", max_length=50)),
+                ("expiry_date", models.DateField(blank=True, null=True)),
+                ("quantity", models.PositiveIntegerField(default=0)),
+                (
+                    "received_at",
+                    models.DateTimeField(default=django.utils.timezone.now),
+                ),
+                (
+                    "branch",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE, to="company.branch"
+                    ),
+                ),
+                (
+                    "item",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="lots",
+                        to="inventory.item",
+                    ),
+                ),
+                (
+                    "sale_point",
+                    models.ForeignKey(
+                        blank=True,
+                        null=True,
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to="inventory.salepoint",
+                    ),
+                ),
+                (
+                    "store",
+                    models.ForeignKey(
+                        blank=True,
+                        null=True,
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to="inventory.store",
+                    ),
+                ),
+            ],
+            options={
+                "verbose_name": "Stock Lot",
+                "verbose_name_plural": "Stock Lots",
+                "indexes": [
+                    models.Index(
+                        fields=["branch", "expiry_date"],
+                        name="inventory_s_branch__2cebab_idx",
+                    ),
+                    models.Index(
+                        fields=["store", "item", "expiry_date"],
+                        name="inventory_s_store_i_209b10_idx",
+                    ),
+                    models.Index(
+                        fields=["sale_point", "item", "expiry_date"],
+                        name="inventory_s_sale_po_8da6f0_idx",
+                    ),
+                ],
+            },
+        ),
+        migrations.AddField(
+            model_name="receiveditem",
+            name="lot_number",
+            field=models.CharField(blank=True, default="", max_length=50),
+        ),
+        migrations.AddField(
+            model_name="receiveditem",
+            name="expiry_date",
+            field=models.DateField(blank=True, null=True),
+        ),
+    ]
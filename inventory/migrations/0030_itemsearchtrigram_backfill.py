@@ -0,0 +1,45 @@
+# Generated by Django 5.2 on 2026-10-18 21:05
+
+import re
+
+from django.db import migrations
+
+# A copy of inventory.search.trigrams as it was when the index was introduced
+WORD_RE = re.compile(r"[^\W_]+")
+
+
+def trigrams(text):
+    """Returns the set of padded trigrams of every word of text."""
+    result = set()
+    for word in WORD_RE.findall((text or "").lower()):
+        padded = f"  {word} "
+        result.update(padded[i : i + 3] for i in range(len(padded) - 2))
+    return result
+
+
+def index_existing_items(apps, schema_editor):
+    """Indexes the items that existed before the search index was introduced."""
+    Item = apps.get_model("inventory", "Item")
+    ItemSearchTrigram = apps.get_model("inventory", "ItemSearchTrigram")
+
+    ItemSearchTrigram.objects.all().delete()
+    rows = []
+    for item in Item.objects.only("pk", "name", "bar_code").iterator(chunk_size=1000):
+        rows.extend(
+            ItemSearchTrigram(item_id=item.pk, trigram=trigram)
+            for trigram in sorted(trigrams(f'{item.name} {item.bar_code or ""}'))
+        )
+        if len(rows) >= 10000:
+            ItemSearchTrigram.objects.bulk_create(rows, batch_size=1000)
+            rows = []
+    ItemSearchTrigram.objects.bulk_create(rows, batch_size=1000)
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("inventory", "0029_idempotencykey"),
+    ]
+
+    operations = [
+        migrations.RunPython(index_existing_items, migrations.RunPython.noop),
+    ]
@@ -16,6 +16,14 @@ Key models include:
 - Requisition: Tracks requests for items from departments
 - Receiving: Records items received from suppliers
 - Issue: Manages movement of items between stores and shops
+- StockMovement: Append-only ledger of every stock change at a location
+- StockSnapshot: Daily closing stock per item and location
+- ReorderQueue: Items whose stock has fallen to their reorder thresholds
+- ItemSearchTrigram: Search index over item names and barcodes
+- CountSession: Cycle count of a store or sale point, posted as one batch of adjustments
+- CountLine: Expected and counted quantity of one item in a count session
+- StockLot: Stock of one lot and expiry date of an item at a location
+- IdempotencyKey: Stored response of a write request, replayed when the client retries it
 
 These models support inventory operations including stock tracking, transfers,
 requisitions, and adjustments across multiple locations.
@@ -62,31 +70,17 @@ class Store(models.Model):
         return self.storeitem_set.count()
     
     def get_total_value(self):
-        """Returns the total value of all items in the store."""
-        return sum(
-            item.quantity * item.item.buying_price 
-            for item in self.storeitem_set.all()
-        )
+        """Returns the total cost value of all items in the store."""
+        return self.storeitem_set.aggregate(total=Sum('value'))['total'] or Decimal('0')
     
     @transaction.atomic
-    def update_stock(self, qty, item):
-        """Updates the stock quantity for an item in the store."""
+    def update_stock(self, qty, item, source=None):
+        """Records a stock movement for an item in the store and applies it."""
         if self.status != 'active':
             raise ValidationError("Cannot update stock in an inactive store")
-            
-        store_item, created = StoreItem.objects.get_or_create(
-            store=self,
-            item=item,
-            defaults={'quantity': 0}
-        )
-        
-        store_item.quantity = F('quantity') + qty
-        store_item.save()
-        store_item.refresh_from_db()
-        
-        item.calculate_store_stock()
-        
-        return store_item
+
+        from .stock import StockLine, post_document
+        post_document([StockLine(item.pk, qty, store_id=self.pk)], source=source)
 
 class SalePoint(models.Model):
     """Represents a retail or sales location."""
@@ -127,24 +121,13 @@ class SalePoint(models.Model):
         )
     
     @transaction.atomic
-    def update_stock(self, qty, item):
-        """Updates the stock quantity for an item at the sale point."""
+    def update_stock(self, qty, item, source=None):
+        """Records a stock movement for an item at the sale point and applies it."""
         if self.status != 'active':
             raise ValidationError("Cannot update stock in an inactive sale point")
-            
-        sale_point_item, created = SalePointItem.objects.get_or_create(
-            sale_point=self,
-            item=item,
-            defaults={'quantity': 0}
-        )
-        
-        sale_point_item.quantity = F('quantity') + qty
-        sale_point_item.save()
-        sale_point_item.refresh_from_db()
-        
-        item.calculate_shop_stock()
-        
-        return sale_point_item
+
+        from .stock import StockLine, post_document
+        post_document([StockLine(item.pk, qty, sale_point_id=self.pk)], source=source)
 
 class Supplier(models.Model):
     """Represents a vendor who supplies inventory items."""
@@ -181,6 +164,14 @@ class Supplier(models.Model):
             total=Sum('receiveditem__total_cost')
         )['total'] or Decimal('0.00')
 
+# Item fields that decide whether the item belongs in the ReorderQueue
+REORDER_FIELDS = {'store_stock', 'shop_stock', 'minimum_stock', 'reorder_point', 'status', 'is_service'}
+# Item fields indexed or cached by inventory.search
+SEARCH_FIELDS = {'name', 'bar_code', 'selling_price', 'status'}
+# Item fields the search trigrams are built from
+INDEXED_FIELDS = ('name', 'bar_code')
+
+
 class Item(models.Model):
     """Core inventory item with stock tracking across locations."""
     
@@ -233,13 +224,13 @@ class Item(models.Model):
         return f"{self.name} ({self.bar_code})" if self.bar_code else self.name
 
     def calculate_store_stock(self):
-        """Calculate store stock based on StoreItem objects and adjust store stock."""
-        self.store_stock = sum(store_item.quantity for store_item in self.storeitem_set.all())
+        """Recalculate store stock from all StoreItem rows (use only to repair drift)."""
+        self.store_stock = self.storeitem_set.aggregate(total=Sum('quantity'))['total'] or 0
         self.save(update_fields=['store_stock'])
     
     def calculate_shop_stock(self):
-        """Calculate shop stock based on ShopItem objects and adjust shop stock."""
-        self.shop_stock = sum(shop_item.quantity for shop_item in self.salepointitem_set.all())
+        """Recalculate shop stock from all SalePointItem rows (use only to repair drift)."""
+        self.shop_stock = self.salepointitem_set.aggregate(total=Sum('quantity'))['total'] or 0
         self.save(update_fields=['shop_stock'])
     
     def total_stock(self):
@@ -251,8 +242,9 @@ class Item(models.Model):
         return self.total_stock() <= self.minimum_stock
 
     def get_stock_value(self):
-        """Returns the total value of current stock."""
-        return self.total_stock() * self.buying_price
+        """Returns the total cost value of current stock across all locations."""
+        from .stock import stock_values
+        return stock_values([self.pk]).get(self.pk, Decimal('0'))
 
     def get_margin(self):
         """Calculates the profit margin percentage."""
@@ -271,11 +263,37 @@ class Item(models.Model):
         if self.reorder_point > self.minimum_stock:
             raise ValidationError("Reorder point cannot be greater than minimum stock")
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        if all(field in instance.__dict__ for field in INDEXED_FIELDS):
+            instance._indexed_text = (instance.name, instance.bar_code)
+        return instance
+
     def save(self, *args, **kwargs):
         """Custom save method to handle initial stock and unit creation."""
-        if self.pk is None:  # New item
+        is_new = self.pk is None
+        if is_new:  # New item
             self.store_stock = self.initial_stock
             self.shop_stock = 0
+        super().save(*args, **kwargs)
+        update_fields = kwargs.get('update_fields')
+        if update_fields is None or set(update_fields) & REORDER_FIELDS:
+            from .reorder import refresh_reorder_queue
+            refresh_reorder_queue([self.pk])
+        if update_fields is None or set(update_fields) & SEARCH_FIELDS:
+            from .search import barcode_cache, index_items
+            indexed_text = (self.name, self.bar_code)
+            reindex = update_fields is None or set(update_fields) & set(INDEXED_FIELDS)
+            if reindex and (is_new or getattr(self, '_indexed_text', None) != indexed_text):
+                index_items([self])
+                self._indexed_text = indexed_text
+            else:
+                barcode_cache.discard_items([self.pk])
+        if update_fields is None or 'buying_price' in update_fields:
+            from .kits import kit_cache
+            kit_cache.discard_costs()
+        if is_new:
             ItemUnit.objects.create(
                 item=self,
                 unit=self.smallest_unit,
@@ -283,21 +301,53 @@ class Item(models.Model):
                 buying_price=self.buying_price,
                 selling_price=self.selling_price
             )
-        super().save(*args, **kwargs)
+
+    def delete(self, *args, **kwargs):
+        from .kits import kit_cache
+        from .search import barcode_cache
+        from .units import unit_cache
+        barcode_cache.discard_items([self.pk])
+        item_id = self.pk
+        result = super().delete(*args, **kwargs)
+        kit_cache.clear()
+        unit_cache.discard([item_id])
+        return result
 
 class StoreItem(models.Model):
     store = models.ForeignKey(Store, on_delete=models.CASCADE)
     item = models.ForeignKey(Item, on_delete=models.CASCADE)
     quantity = models.PositiveIntegerField(default=0)
+    # Cost of the units on hand, maintained as a moving average by inventory.stock
+    value = models.DecimalField(max_digits=18, decimal_places=4, default=0)
     last_updated = models.DateTimeField(auto_now=True)
 
     class Meta:
         unique_together = ('store', 'item')  # Ensures an item can't be duplicated in the same store
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        if 'quantity' in instance.__dict__:
+            instance._saved_quantity = instance.quantity
+        return instance
+
     def save(self, *args, **kwargs):
-        super().save(*args, **kwargs)
-        print(f"Saving StoreItem for {self.item.name} in {self.store.name} with quantity {self.quantity}")
-        self.item.calculate_store_stock()
+        """Saves the row and adds the change in quantity to Item.store_stock."""
+        from .stock import apply_item_deltas
+        previous = 0 if self._state.adding else getattr(self, '_saved_quantity', None)
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+            if previous is None:
+                self.item.calculate_store_stock()
+            else:
+                apply_item_deltas(store_deltas={self.item_id: self.quantity - previous})
+        self._saved_quantity = self.quantity
+
+    def delete(self, *args, **kwargs):
+        from .stock import apply_item_deltas
+        with transaction.atomic():
+            apply_item_deltas(store_deltas={self.item_id: -getattr(self, '_saved_quantity', self.quantity)})
+            return super().delete(*args, **kwargs)
     
     def __str__(self):
         return f"{self.item.name} - {self.store.name}: {self.quantity}"
@@ -306,15 +356,37 @@ class SalePointItem(models.Model):
     sale_point = models.ForeignKey(SalePoint, on_delete=models.CASCADE)
     item = models.ForeignKey(Item,on_delete=models.CASCADE)
     quantity = models.PositiveIntegerField()
+    # Cost of the units on hand, maintained as a moving average by inventory.stock
+    value = models.DecimalField(max_digits=18, decimal_places=4, default=0)
     last_updated = models.DateTimeField(auto_now=True)
     
     class Meta:
         unique_together = ('sale_point', 'item')  # Ensures an item can't be duplicated in the same store
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        if 'quantity' in instance.__dict__:
+            instance._saved_quantity = instance.quantity
+        return instance
+
     def save(self, *args, **kwargs):
-        super().save(*args, **kwargs)
-        print(f"Saving StoreItem for {self.item.name} in {self.sale_point.name} with quantity {self.quantity}")
-        self.item.calculate_shop_stock()
+        """Saves the row and adds the change in quantity to Item.shop_stock."""
+        from .stock import apply_item_deltas
+        previous = 0 if self._state.adding else getattr(self, '_saved_quantity', None)
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+            if previous is None:
+                self.item.calculate_shop_stock()
+            else:
+                apply_item_deltas(shop_deltas={self.item_id: self.quantity - previous})
+        self._saved_quantity = self.quantity
+
+    def delete(self, *args, **kwargs):
+        from .stock import apply_item_deltas
+        with transaction.atomic():
+            apply_item_deltas(shop_deltas={self.item_id: -getattr(self, '_saved_quantity', self.quantity)})
+            return super().delete(*args, **kwargs)
     
     def __str__(self):
         return f"{self.item.name} - {self.sale_point.name}: {self.quantity}"
@@ -329,6 +401,17 @@ class ItemUnit(models.Model):
     def __str__(self):
         return f"{self.unit} - {self.smallest_units} {self.item.smallest_unit} of {self.item.name}"
 
+    def save(self, *args, **kwargs):
+        from .units import unit_cache
+        super().save(*args, **kwargs)
+        unit_cache.discard([self.item_id])
+
+    def delete(self, *args, **kwargs):
+        from .units import unit_cache
+        result = super().delete(*args, **kwargs)
+        unit_cache.discard([self.item_id])
+        return result
+
 class ItemKit(models.Model):
     name = models.CharField(max_length=200)
     items = models.ManyToManyField(Item, through='ItemKitItem')
@@ -343,10 +426,19 @@ class ItemKit(models.Model):
 
     def total_cost(self):
         """Calculate total buying price of all items in the kit."""
-        return sum(
-            itemkititem.item.buying_price * itemkititem.quantity
-            for itemkititem in self.itemkititem_set.all()
-        )
+        from .kits import kit_cache
+        return kit_cache.costs().get(self.pk, 0)
+
+    def available_quantity(self, sale_point):
+        """Number of whole kits the sale point can make from its stock."""
+        from .kits import kit_cache
+        return kit_cache.availability([sale_point.pk])[sale_point.pk].get(self.pk, 0)
+
+    def delete(self, *args, **kwargs):
+        from .kits import kit_cache
+        result = super().delete(*args, **kwargs)
+        kit_cache.clear()
+        return result
     
     def __str__(self):
         return f"{self.name} | Selling Price: {self.selling_price}"
@@ -359,6 +451,17 @@ class ItemKitItem(models.Model):
     def subtotal(self):
         """Calculate the subtotal cost for this item in the kit."""
         return self.item.buying_price * self.quantity
+
+    def save(self, *args, **kwargs):
+        from .kits import kit_cache
+        super().save(*args, **kwargs)
+        kit_cache.clear()
+
+    def delete(self, *args, **kwargs):
+        from .kits import kit_cache
+        result = super().delete(*args, **kwargs)
+        kit_cache.clear()
+        return result
     
     def __str__(self):
         return f"Kit: {self.item_kit.name} | Item: {self.item.name} | Qty: {self.quantity}"
@@ -372,16 +475,43 @@ class Adjustment(models.Model):
     in_store = models.BooleanField(default=True)
     store = models.ForeignKey(Store, on_delete=models.CASCADE, null=True, blank=True)
     sale_point = models.ForeignKey(SalePoint, on_delete=models.SET_NULL, null=True, blank=True)
+    count_session = models.ForeignKey(
+        'CountSession', on_delete=models.SET_NULL, null=True, blank=True, related_name='adjustments'
+    )
+
+    def stock_lines(self, sign=1):
+        """Returns the stock line of this adjustment, or none without a location."""
+        from .stock import StockLine
+        if self.store_id:
+            return [StockLine(self.item_id, sign * self.quantity, store_id=self.store_id)]
+        if self.sale_point_id:
+            return [StockLine(self.item_id, sign * self.quantity, sale_point_id=self.sale_point_id)]
+        return []
 
     def update_stock(self):
-        if self.store:
-            self.store.update_stock(self.quantity,self.item)
-        elif self.sale_point:
-            self.sale_point.update_stock(self.quantity,self.item)
+        from .stock import post_document
+        post_document(self.stock_lines(), source=self)
 
-    def save(self, *args, **kwargs):
-        super().save(*args, **kwargs)
-        self.update_stock()
+    def save(self, *args, post_stock=True, **kwargs):
+        """Posts new adjustments, and only the change when an adjustment is edited."""
+        if not post_stock:
+            return super().save(*args, **kwargs)
+
+        from .stock import repost_document
+        with transaction.atomic():
+            previous = Adjustment.objects.filter(pk=self.pk).first() if self.pk else None
+            super().save(*args, **kwargs)
+            if previous is None:
+                self.update_stock()
+            else:
+                repost_document(previous.stock_lines(), self.stock_lines(), source=self)
+
+    def delete(self, *args, **kwargs):
+        """Reverses the stock of the adjustment along with deleting it."""
+        from .stock import post_document
+        with transaction.atomic():
+            post_document(self.stock_lines(sign=-1), source=self)
+            return super().delete(*args, **kwargs)
 
     def __str__(self):
         return f"{self.item.name} | Date: {self.date} | Adj Qty: {self.quantity}"
@@ -451,17 +581,29 @@ class ReceivedItem(models.Model):
     quantity = models.IntegerField()
     unit_price = models.FloatField()
     total_cost = models.FloatField()
+    lot_number = models.CharField(max_length=50, blank=True, default='')
+    expiry_date = models.DateField(null=True, blank=True)
 
-    def update_stock(self):
-        qty = self.quantity * self.unit.smallest_units
+    def stock_line(self, sign=1):
+        """Returns the stock line this item posts to the receiving location."""
+        from .stock import StockLine
+        qty = sign * self.quantity * self.unit.smallest_units
+        unit_cost = Decimal(str(self.unit_price)) / self.unit.smallest_units
+        lot = {'lot_number': self.lot_number, 'expiry_date': self.expiry_date}
         if self.receiving.is_store is True:
-            self.receiving.store.update_stock(qty,self.item)
-        else:
-            self.receiving.sale_point.update_stock(qty,self.item)
+            return StockLine(self.item_id, qty, store_id=self.receiving.store_id, unit_cost=unit_cost, **lot)
+        return StockLine(
+            self.item_id, qty, sale_point_id=self.receiving.sale_point_id, unit_cost=unit_cost, **lot
+        )
 
-    def save(self, *args, **kwargs):
+    def update_stock(self):
+        from .stock import post_document
+        post_document([self.stock_line()], source=self.receiving)
+
+    def save(self, *args, post_stock=True, **kwargs):
         super().save(*args, **kwargs)
-        self.update_stock()
+        if post_stock:
+            self.update_stock()
 
     def __str__(self):
         return f"{self.item.name} | Received Qty: {self.quantity}"
@@ -492,27 +634,45 @@ class Transfer(models.Model):
         else:
             return f"Transfer from {self.from_salepoint.name} to {self.to_store.name} on {self.date}"
     
+    def locations(self):
+        """Returns the (source, destination) location ids for the transfer type."""
+        if self.transfer_type == 'store_to_store':
+            return {'store_id': self.from_store_id}, {'store_id': self.to_store_id}
+        elif self.transfer_type == 'salepoint_to_salepoint':
+            return {'sale_point_id': self.from_salepoint_id}, {'sale_point_id': self.to_salepoint_id}
+        elif self.transfer_type == 'salepoint_to_store':
+            return {'sale_point_id': self.from_salepoint_id}, {'store_id': self.to_store_id}
+        raise ValidationError(f"Unknown transfer type: {self.transfer_type}")
+
+    def stock_lines(self):
+        """Returns the stock lines that move every transfer item from source to destination."""
+        from .stock import StockLine
+        source, destination = self.locations()
+        lines = []
+        for item_id, qty in self.transferitem_set.order_by('pk').values_list(
+            'item_id', F('quantity') * F('unit__smallest_units')
+        ):
+            lines.append(StockLine(item_id, -qty, **source))
+            lines.append(StockLine(item_id, qty, **destination))
+        return lines
+
     def complete_transfer(self):
         if self.completed:
             return
-            
-        with transaction.atomic():
-            for transfer_item in self.transferitem_set.all():
-                qty = transfer_item.quantity * transfer_item.unit.smallest_units
-                
-                # Deduct from source
-                if self.transfer_type == 'store_to_store':
-                    self.from_store.update_stock(-qty, transfer_item.item)
-                    self.to_store.update_stock(qty, transfer_item.item)
-                elif self.transfer_type == 'salepoint_to_salepoint':
-                    self.from_salepoint.update_stock(-qty, transfer_item.item)
-                    self.to_salepoint.update_stock(qty, transfer_item.item)
-                elif self.transfer_type == 'salepoint_to_store':
-                    self.from_salepoint.update_stock(-qty, transfer_item.item)
-                    self.to_store.update_stock(qty, transfer_item.item)
-            
+
+        from .stock import post_document, retry_on_deadlock
+
+        @retry_on_deadlock
+        @transaction.atomic
+        def post():
+            # Claiming the transfer first makes concurrent completions post it only once
+            if not Transfer.objects.filter(pk=self.pk, completed=False).update(completed=True):
+                return False
+            post_document(self.stock_lines(), source=self, lock_rows=True)
+            return True
+
+        if post():
             self.completed = True
-            self.save()
 
 class TransferItem(models.Model):
     transfer = models.ForeignKey(Transfer, on_delete=models.CASCADE)
@@ -562,18 +722,38 @@ class Issue(models.Model):
             self.approved_by = employee
             self.save()
     
+    def stock_lines(self):
+        """Returns the stock lines that move every issued item from the store to the sale point."""
+        from .stock import StockLine
+        lines = []
+        for item_id, qty in self.issueditem_set.order_by('pk').values_list(
+            'item_id', F('quantity') * F('unit__smallest_units')
+        ):
+            lines.append(StockLine(item_id, -qty, store_id=self.store_id))
+            lines.append(StockLine(item_id, qty, sale_point_id=self.sale_point_id))
+        return lines
+
     def complete(self, employee):
         if self.status == 'approved' and not self.completed_date:
-            with transaction.atomic():
-                for issued_item in self.issueditem_set.all():
-                    qty = issued_item.quantity * issued_item.unit.smallest_units
-                    self.store.update_stock(-qty, issued_item.item)
-                    self.sale_point.update_stock(qty, issued_item.item)
-                
+            from .stock import post_document, retry_on_deadlock
+            completed_date = timezone.now()
+
+            @retry_on_deadlock
+            @transaction.atomic
+            def post():
+                # Claiming the issue first makes concurrent completions post it only once
+                claimed = Issue.objects.filter(
+                    pk=self.pk, status='approved', completed_date__isnull=True
+                ).update(status='completed', completed_by=employee, completed_date=completed_date)
+                if not claimed:
+                    return False
+                post_document(self.stock_lines(), source=self, lock_rows=True)
+                return True
+
+            if post():
                 self.status = 'completed'
                 self.completed_by = employee
-                self.completed_date = timezone.now()
-                self.save()
+                self.completed_date = completed_date
 
 class IssuedItem(models.Model):
     item = models.ForeignKey(Item, on_delete=models.CASCADE)
@@ -582,4 +762,238 @@ class IssuedItem(models.Model):
     quantity = models.IntegerField()
     
     def __str__(self):
-        return f"{self.item.name} | Issue Qty: {self.quantity} {self.unit.unit}"    
\ No newline at end of file
+        return f"{self.item.name} | Issue Qty: {self.quantity} {self.unit.unit}"    
+
+class StockMovement(models.Model):
+    """Append-only record of a single stock change at a store or sale point.
+
+    StoreItem and SalePointItem quantities are running balances of these rows
+    and can be rebuilt from them with inventory.stock.replay_movements().
+    """
+
+    SOURCE_CHOICES = [
+        ('opening', 'Opening Balance'),
+        ('receiving', 'Receiving'),
+        ('issue', 'Issue'),
+        ('transfer', 'Transfer'),
+        ('adjustment', 'Adjustment'),
+        ('countsession', 'Cycle Count'),
+        ('sale', 'Sale'),
+        ('return', 'Return'),
+        ('manual', 'Manual'),
+    ]
+
+    item = models.ForeignKey(Item, on_delete=models.CASCADE)
+    store = models.ForeignKey(Store, on_delete=models.CASCADE, null=True, blank=True)
+    sale_point = models.ForeignKey(SalePoint, on_delete=models.CASCADE, null=True, blank=True)
+    quantity = models.IntegerField()
+    source_type = models.CharField(max_length=20, choices=SOURCE_CHOICES, default='manual')
+    source_id = models.PositiveBigIntegerField(null=True, blank=True)
+    created_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        verbose_name = 'Stock Movement'
+        verbose_name_plural = 'Stock Movements'
+        indexes = [
+            models.Index(fields=['store', 'item', 'created_at']),
+            models.Index(fields=['sale_point', 'item', 'created_at']),
+            models.Index(fields=['source_type', 'source_id']),
+            models.Index(fields=['created_at']),
+        ]
+
+    def __str__(self):
+        location = self.store or self.sale_point
+        return f"{self.item.name} | {location}: {self.quantity:+d} ({self.get_source_type_display()})"
+
+
+class StockSnapshot(models.Model):
+    """Closing stock of an item at a store or sale point at the end of a day.
+
+    Only non-zero balances are stored. Stock at any other moment is the
+    latest snapshot plus the movements recorded after it, see
+    inventory.stock.stock_as_of().
+    """
+
+    date = models.DateField()
+    item = models.ForeignKey(Item, on_delete=models.CASCADE)
+    store = models.ForeignKey(Store, on_delete=models.CASCADE, null=True, blank=True)
+    sale_point = models.ForeignKey(SalePoint, on_delete=models.CASCADE, null=True, blank=True)
+    quantity = models.IntegerField()
+
+    class Meta:
+        verbose_name = 'Stock Snapshot'
+        verbose_name_plural = 'Stock Snapshots'
+        indexes = [
+            models.Index(fields=['date', 'store', 'item']),
+            models.Index(fields=['date', 'sale_point', 'item']),
+        ]
+
+    def __str__(self):
+        location = self.store or self.sale_point
+        return f"{self.item.name} | {location} on {self.date}: {self.quantity}"
+
+
+class ReorderQueue(models.Model):
+    """An item whose total stock is at or below its reorder point or minimum stock.
+
+    Rows are added, escalated and removed by inventory.reorder as postings
+    move the stock across those thresholds, so listing items to reorder only
+    reads this table.
+    """
+
+    LEVEL_CHOICES = [
+        ('reorder', 'At Reorder Point'),
+        ('minimum', 'At Minimum Stock'),
+    ]
+
+    item = models.OneToOneField(Item, on_delete=models.CASCADE, related_name='reorder_entry')
+    level = models.CharField(max_length=20, choices=LEVEL_CHOICES)
+    stock = models.IntegerField()
+    queued_at = models.DateTimeField(default=timezone.now)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        verbose_name = 'Reorder Queue Entry'
+        verbose_name_plural = 'Reorder Queue'
+        indexes = [
+            models.Index(fields=['level', 'queued_at']),
+        ]
+
+    def __str__(self):
+        return f"{self.item.name} | {self.get_level_display()} ({self.stock})"
+
+
+class ItemSearchTrigram(models.Model):
+    """One trigram of an item's name or barcode, used by inventory.search."""
+
+    item = models.ForeignKey(Item, on_delete=models.CASCADE, related_name='search_trigrams')
+    trigram = models.CharField(max_length=3)
+
+    class Meta:
+        verbose_name = 'Item Search Trigram'
+        verbose_name_plural = 'Item Search Trigrams'
+        indexes = [
+            models.Index(fields=['trigram', 'item']),
+        ]
+
+    def __str__(self):
+        return f"{self.item_id}: {self.trigram!r}"
+
+
+class CountSession(models.Model):
+    """A cycle count of one store or sale point.
+
+    Expected quantities are frozen into CountLines when the session opens.
+    Counts from any number of devices are added to the lines while it is
+    open, and posting turns every variance into an Adjustment in one batch.
+    """
+
+    STATUS_CHOICES = [
+        ('open', 'Open'),
+        ('posted', 'Posted'),
+        ('cancelled', 'Cancelled'),
+    ]
+
+    store = models.ForeignKey(Store, on_delete=models.CASCADE, null=True, blank=True)
+    sale_point = models.ForeignKey(SalePoint, on_delete=models.CASCADE, null=True, blank=True)
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='open')
+    opened_by = models.ForeignKey(Employee, on_delete=models.CASCADE, related_name='count_sessions_opened')
+    opened_at = models.DateTimeField(auto_now_add=True)
+    posted_by = models.ForeignKey(
+        Employee, on_delete=models.SET_NULL, null=True, blank=True, related_name='count_sessions_posted'
+    )
+    posted_at = models.DateTimeField(null=True, blank=True)
+    notes = models.TextField(blank=True, null=True)
+
+    class Meta:
+        verbose_name = 'Count Session'
+        verbose_name_plural = 'Count Sessions'
+
+    @property
+    def location(self):
+        return self.store or self.sale_point
+
+    def __str__(self):
+        return f"Count of {self.location} on {self.opened_at:%Y-%m-%d} ({self.get_status_display()})"
+
+
+class CountLine(models.Model):
+    """Expected quantity of an item when its count session opened, and the quantity counted."""
+
+    session = models.ForeignKey(CountSession, on_delete=models.CASCADE, related_name='lines')
+    item = models.ForeignKey(Item, on_delete=models.CASCADE)
+    expected = models.IntegerField(default=0)
+    counted = models.IntegerField(null=True, blank=True)
+    counted_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        verbose_name = 'Count Line'
+        verbose_name_plural = 'Count Lines'
+        unique_together = ('session', 'item')
+
+    @property
+    def variance(self):
+        return None if self.counted is None else self.counted - self.expected
+
+    def __str__(self):
+        return f"{self.item_id}: expected {self.expected}, counted {self.counted}"
+
+
+class StockLot(models.Model):
+    """Stock of one lot of an item at a store or sale point, maintained by inventory.lots.
+
+    branch is the branch of the location, kept on the row so expiring lots
+    of a branch are found through the (branch, expiry_date) index.
+    """
+
+    item = models.ForeignKey(Item, on_delete=models.CASCADE, related_name='lots')
+    store = models.ForeignKey(Store, on_delete=models.CASCADE, null=True, blank=True)
+    sale_point = models.ForeignKey(SalePoint, on_delete=models.CASCADE, null=True, blank=True)
+    branch = models.ForeignKey(Branch, on_delete=models.CASCADE)
+    lot_number = models.CharField(max_length=50, blank=True, default='')
+    expiry_date = models.DateField(null=True, blank=True)
+    quantity = models.PositiveIntegerField(default=0)
+    received_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        verbose_name = 'Stock Lot'
+        verbose_name_plural = 'Stock Lots'
+        indexes = [
+            models.Index(fields=['branch', 'expiry_date']),
+            models.Index(fields=['store', 'item', 'expiry_date']),
+            models.Index(fields=['sale_point', 'item', 'expiry_date']),
+        ]
+
+    def __str__(self):
+        return f"{self.item_id} lot {self.lot_number or '-'} expiring {self.expiry_date} x {self.quantity}"
+
+
+class IdempotencyKey(models.Model):
+    """Response of a POST sent with an idempotency key, maintained by inventory.idempotency.
+
+    The row is written in the same transaction as the request's changes, so
+    a retry either finds the stored response or finds nothing was applied.
+    """
+
+    scope = models.CharField(max_length=50)
+    key = models.CharField(max_length=100)
+    request_hash = models.CharField(max_length=64)
+    status_code = models.PositiveSmallIntegerField()
+    headers = models.JSONField(default=dict)
+    content = models.BinaryField()
+    created_at = models.DateTimeField(default=timezone.now)
+    expires_at = models.DateTimeField()
+
+    class Meta:
+        verbose_name = 'Idempotency Key'
+        verbose_name_plural = 'Idempotency Keys'
+        constraints = [
+            models.UniqueConstraint(fields=['scope', 'key'], name='unique_idempotency_key'),
+        ]
+        indexes = [
+            models.Index(fields=['expires_at']),
+        ]
+
+    def __str__(self):
+        return f"{self.scope}:{self.key}"
+
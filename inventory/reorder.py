@@ -0,0 +1,79 @@
+"""
+Reorder Queue
+
+This module keeps the ReorderQueue in step with item stock levels.
+
+An item is queued while its total stock across stores and sale points is at
+or below its minimum stock, and escalated while it is at or below its reorder
+point. Postings refresh only the items they touched, so listing items to
+reorder reads the queue instead of scanning every item, and
+stock_threshold_crossed is sent once per crossing instead of being derived
+again by every poll.
+"""
+
+from functools import partial
+
+from django.db import transaction
+from django.db.models import Case, F, IntegerField, Value, When
+from django.utils import timezone
+
+from .models import Item, ReorderQueue
+from .signals import stock_threshold_crossed
+
+
+def reorder_level(stock, minimum_stock, reorder_point, active=True):
+    """Returns the queue level for a stock figure, or None when no reorder is needed.
+
+    A threshold of zero counts as not set.
+    """
+    if not active:
+        return None
+    if reorder_point and stock <= reorder_point:
+        return 'reorder'
+    if minimum_stock and stock <= minimum_stock:
+        return 'minimum'
+    return None
+
+
+def refresh_reorder_queue(item_ids):
+    """Adds, escalates or removes the queue entries of the given items.
+
+    Reads the items and their current entries in one query and writes only
+    the entries whose level changed. Returns the number of changed entries.
+    """
+    rows = Item.objects.filter(pk__in=item_ids).values_list(
+        'pk', 'status', 'is_service', 'minimum_stock', 'reorder_point',
+        'reorder_entry__level', 'reorder_entry__pk',
+    ).annotate(stock=F('store_stock') + F('shop_stock'))
+
+    now = timezone.now()
+    created, changed, removed, crossings = [], [], [], []
+    for item_id, status, is_service, minimum_stock, reorder_point, previous, entry_id, stock in rows:
+        level = reorder_level(stock, minimum_stock, reorder_point, status == 'active' and not is_service)
+        if level == previous:
+            continue
+        if previous is None:
+            created.append(ReorderQueue(item_id=item_id, level=level, stock=stock, queued_at=now))
+        elif level is None:
+            removed.append(entry_id)
+        else:
+            changed.append(ReorderQueue(pk=entry_id, level=level, stock=stock, updated_at=now))
+        crossings.append({'item_id': item_id, 'level': level, 'previous_level': previous, 'stock': stock})
+
+    if created:
+        ReorderQueue.objects.bulk_create(created, ignore_conflicts=True)
+        # A concurrent posting may have queued the same items first; its rows take these levels
+        ReorderQueue.objects.filter(item_id__in=[entry.item_id for entry in created]).update(
+            level=Case(*[When(item_id=entry.item_id, then=Value(entry.level)) for entry in created]),
+            stock=Case(
+                *[When(item_id=entry.item_id, then=Value(entry.stock)) for entry in created],
+                output_field=IntegerField(),
+            ),
+            updated_at=now,
+        )
+    ReorderQueue.objects.bulk_update(changed, ['level', 'stock', 'updated_at'])
+    ReorderQueue.objects.filter(pk__in=removed).delete()
+
+    for crossing in crossings:
+        transaction.on_commit(partial(stock_threshold_crossed.send, sender=Item, **crossing))
+    return len(crossings)
@@ -0,0 +1,219 @@
+"""
+Replenishment Planning
+
+This module proposes Issues that refill sale points from the stores of their
+branch.
+
+A sale point is due an item when its stock plus the quantity already on
+open issues is at or below the item's minimum stock, and is then filled up
+to the item's optimum stock. Store stock not yet promised to open issues is
+shared out between the sale points of the same branch, those short of the
+most first, and each store is drawn down fullest first.
+
+All sale points and items are solved in one pass of array arithmetic. The
+needs and the store supplies of every (branch, item) pair are laid end to
+end on one number line, so matching them up is a merge of their cumulative
+sums rather than a loop over items. Drafts are then written with one bulk
+insert for the issues, or one insert each where the database does not
+return ids, and one for their items.
+"""
+
+from collections import defaultdict, namedtuple
+
+import numpy as np
+from django.db import connection, transaction
+from django.db.models import F, Sum
+from django.utils import timezone
+
+from .models import Issue, IssuedItem, Item, ItemUnit, SalePoint, SalePointItem, StoreItem
+
+ReplenishmentLine = namedtuple('ReplenishmentLine', ['store_id', 'sale_point_id', 'item_id', 'quantity'])
+
+DraftResult = namedtuple('DraftResult', ['issues', 'skipped'])
+
+OPEN_ISSUE_STATUSES = ('pending', 'approved')
+
+
+def open_issue_quantities():
+    """Returns (store id, sale point id, item id, smallest units) rows of issues not yet completed."""
+    return IssuedItem.objects.filter(issue__status__in=OPEN_ISSUE_STATUSES).values(
+        'issue__store_id', 'issue__sale_point_id', 'item_id'
+    ).annotate(
+        quantity=Sum(F('quantity') * F('unit__smallest_units'))
+    ).values_list('issue__store_id', 'issue__sale_point_id', 'item_id', 'quantity')
+
+
+def allocate(need_groups, needs, supply_groups, supplies):
+    """Fills needs from supplies of the same group, in the order given.
+
+    Both sides must be sorted by group. Returns (need index, supply index,
+    quantity) arrays with one entry per need and supply that are matched.
+    """
+    groups = np.union1d(need_groups, supply_groups)
+    need_group_index = np.searchsorted(groups, need_groups)
+    supply_group_index = np.searchsorted(groups, supply_groups)
+    need_totals = np.zeros(len(groups), dtype=np.int64)
+    np.add.at(need_totals, need_group_index, needs)
+    supply_totals = np.zeros(len(groups), dtype=np.int64)
+    np.add.at(supply_totals, supply_group_index, supplies)
+
+    # Each group gets its own stretch of the number line
+    spans = np.maximum(need_totals, supply_totals)
+    offsets = np.cumsum(spans) - spans
+
+    def intervals(group_index, quantities):
+        ends = np.cumsum(quantities)
+        starts = ends - quantities
+        group_starts = starts[np.searchsorted(group_index, group_index)]
+        ends = offsets[group_index] + ends - group_starts
+        return ends - quantities, ends
+
+    need_starts, need_ends = intervals(need_group_index, needs)
+    supply_starts, supply_ends = intervals(supply_group_index, supplies)
+
+    points = np.unique(np.concatenate([need_starts, need_ends, supply_starts, supply_ends]))
+    starts, ends = points[:-1], points[1:]
+    need_index = np.minimum(np.searchsorted(need_ends, starts, side='right'), len(needs) - 1)
+    supply_index = np.minimum(np.searchsorted(supply_ends, starts, side='right'), len(supplies) - 1)
+    # Keep the pieces of the line covered by both a need and a supply
+    matched = (
+        (need_starts[need_index] <= starts) & (starts < need_ends[need_index])
+        & (supply_starts[supply_index] <= starts) & (starts < supply_ends[supply_index])
+    )
+    return need_index[matched], supply_index[matched], (ends - starts)[matched]
+
+
+def plan_replenishment(branch=None):
+    """Returns the ReplenishmentLines that refill every active sale point."""
+    items = np.array(
+        Item.objects.filter(status='active', is_service=False, optimum_stock__gt=0).order_by('pk').values_list(
+            'pk', 'minimum_stock', 'optimum_stock'
+        ),
+        dtype=np.int64,
+    ).reshape(-1, 3)
+    sale_points = SalePoint.objects.filter(status='active')
+    if branch is not None:
+        sale_points = sale_points.filter(branch=branch)
+    sale_points = np.array(sale_points.order_by('pk').values_list('pk', 'branch_id'), dtype=np.int64).reshape(-1, 2)
+    if not len(items) or not len(sale_points):
+        return []
+    item_ids, minimum_stock, optimum_stock = items.T
+    sale_point_ids, sale_point_branches = sale_points.T
+
+    def positions(ids, values):
+        """Maps ids to their positions in the sorted ids array, -1 where absent."""
+        found = np.minimum(np.searchsorted(ids, values), len(ids) - 1)
+        return np.where(ids[found] == values, found, -1)
+
+    # Stock position of every sale point and item, counting open issues as delivered
+    position = np.zeros((len(sale_point_ids), len(item_ids)), dtype=np.int64)
+    stock = np.array(
+        SalePointItem.objects.filter(sale_point_id__in=sale_point_ids.tolist()).values_list(
+            'sale_point_id', 'item_id', 'quantity'
+        ),
+        dtype=np.int64,
+    ).reshape(-1, 3)
+    open_issues = np.array(list(open_issue_quantities()), dtype=np.int64).reshape(-1, 4)
+    for sale_point_column, item_column, quantities in (
+        (stock[:, 0], stock[:, 1], stock[:, 2]),
+        (open_issues[:, 1], open_issues[:, 2], open_issues[:, 3]),
+    ):
+        rows, columns = positions(sale_point_ids, sale_point_column), positions(item_ids, item_column)
+        known = (rows >= 0) & (columns >= 0)
+        np.add.at(position, (rows[known], columns[known]), quantities[known])
+
+    need = np.where(position <= minimum_stock, optimum_stock - position, 0)
+    need_rows, need_columns = np.nonzero(need > 0)
+    needs = need[need_rows, need_columns]
+    if not len(needs):
+        return []
+
+    # Store stock of the same branches less what open issues already take out
+    supply = np.array(
+        StoreItem.objects.filter(
+            store__status='active',
+            store__branch_id__in=np.unique(sale_point_branches).tolist(),
+            item_id__in=np.unique(item_ids[need_columns]).tolist(),
+            quantity__gt=0,
+        ).values_list('store_id', 'store__branch_id', 'item_id', 'quantity'),
+        dtype=np.int64,
+    ).reshape(-1, 4)
+    if not len(supply):
+        return []
+    promised = defaultdict(int)
+    for store_id, _, item_id, quantity in open_issues.tolist():
+        promised[(store_id, item_id)] += quantity
+    supply[:, 3] -= np.array(
+        [promised.get((store_id, item_id), 0) for store_id, item_id in supply[:, [0, 2]].tolist()],
+        dtype=np.int64,
+    )
+    supply = supply[supply[:, 3] > 0]
+    if not len(supply):
+        return []
+
+    # Groups are (branch, item) pairs; neediest sale point and fullest store first
+    need_groups = sale_point_branches[need_rows] * (item_ids.max() + 1) + item_ids[need_columns]
+    need_order = np.lexsort((-needs, need_groups))
+    supply_groups = supply[:, 1] * (item_ids.max() + 1) + supply[:, 2]
+    supply_order = np.lexsort((-supply[:, 3], supply_groups))
+
+    need_index, supply_index, quantities = allocate(
+        need_groups[need_order], needs[need_order], supply_groups[supply_order], supply[supply_order, 3]
+    )
+    need_index, supply_index = need_order[need_index], supply_order[supply_index]
+    return [
+        ReplenishmentLine(*line)
+        for line in zip(
+            supply[supply_index, 0].tolist(),
+            sale_point_ids[need_rows[need_index]].tolist(),
+            item_ids[need_columns[need_index]].tolist(),
+            quantities.tolist(),
+        )
+    ]
+
+
+@transaction.atomic
+def draft_issues(lines, notes=None):
+    """Creates one pending Issue per store and sale point pair of lines.
+
+    Quantities are issued in the base unit of each item and the issues are
+    requested by the contact person of their sale point. Lines of items
+    without a base unit cannot be issued and are skipped, and a pair left
+    without lines gets no issue. Returns a DraftResult.
+    """
+    lines = list(lines)
+    units = {}
+    for unit_id, item_id in ItemUnit.objects.filter(
+        item_id__in={line.item_id for line in lines}, smallest_units=1
+    ).order_by('-pk').values_list('pk', 'item_id'):
+        units[item_id] = unit_id
+    skipped = [line for line in lines if line.item_id not in units]
+
+    by_document = defaultdict(list)
+    for line in lines:
+        if line.item_id in units:
+            by_document[(line.store_id, line.sale_point_id)].append(line)
+    if not by_document:
+        return DraftResult([], skipped)
+
+    contacts = dict(SalePoint.objects.filter(
+        pk__in={sale_point_id for _, sale_point_id in by_document}
+    ).values_list('pk', 'contact_person_id'))
+    notes = notes or f'Drafted by the replenishment planner on {timezone.localdate():%Y-%m-%d}'
+    issues = [
+        Issue(store_id=store_id, sale_point_id=sale_point_id, requested_by_id=contacts[sale_point_id], notes=notes)
+        for store_id, sale_point_id in by_document
+    ]
+    if connection.features.can_return_rows_from_bulk_insert:
+        Issue.objects.bulk_create(issues)
+    else:
+        # Inserted one by one, each issue learns its own id
+        for issue in issues:
+            issue.save()
+
+    IssuedItem.objects.bulk_create([
+        IssuedItem(issue=issue, item_id=line.item_id, unit_id=units[line.item_id], quantity=line.quantity)
+        for issue in issues
+        for line in by_document[(issue.store_id, issue.sale_point_id)]
+    ], batch_size=1000)
+    return DraftResult(issues, skipped)
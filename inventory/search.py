@@ -0,0 +1,144 @@
+"""
+Item Search
+
+This module finds items by barcode and name for item lists and POS screens.
+
+Exact barcode scans are answered from the shared cache. Everything else
+goes through ItemSearchTrigram, which holds the trigrams of every word of an
+item's name and barcode. Words are padded in front with two spaces, so the
+first trigrams of a word are its one and two letter prefixes and a typed
+prefix matches through the same (trigram, item) index as a fuzzy match. A
+search costs a few indexed queries whatever the number of items, instead of
+the table scans of icontains filters.
+"""
+
+import math
+import re
+
+from django.db.models import Count
+
+from .caching import SharedCache
+from .models import Item, ItemSearchTrigram
+
+# Share of the query trigrams an item must contain to be a fuzzy match
+MIN_SIMILARITY = 0.5
+
+WORD_RE = re.compile(r'[^\W_]+')
+
+
+def words(text):
+    """Returns the lowercase alphanumeric words of text."""
+    return WORD_RE.findall((text or '').lower())
+
+
+def trigrams(text, complete=True):
+    """Returns the set of padded trigrams of every word of text.
+
+    With complete=False the last word is treated as a prefix still being
+    typed and gets no trailing padding.
+    """
+    result = set()
+    text_words = words(text)
+    for index, word in enumerate(text_words):
+        padded = f'  {word}'
+        if complete or index < len(text_words) - 1:
+            padded += ' '
+        result.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return result
+
+
+def index_items(items, batch_size=1000):
+    """Rebuilds the search trigrams of the given items."""
+    items = list(items)
+    item_ids = [item.pk for item in items]
+    ItemSearchTrigram.objects.filter(item_id__in=item_ids).delete()
+    ItemSearchTrigram.objects.bulk_create(
+        [
+            ItemSearchTrigram(item_id=item.pk, trigram=trigram)
+            for item in items
+            for trigram in sorted(trigrams(f'{item.name} {item.bar_code or ""}'))
+        ],
+        batch_size=batch_size,
+    )
+    barcode_cache.discard_items(item_ids)
+
+
+class BarcodeCache(SharedCache):
+    """Cache of item summaries by exact barcode.
+
+    Entries are dropped when their item is saved or reindexed.
+    """
+
+    def get(self, bar_code):
+        """Returns the summary of the item with this barcode, or None."""
+        return self.get_many([bar_code], self.load).get(bar_code)
+
+    def load(self, bar_codes):
+        summaries = {
+            summary['bar_code']: summary
+            for summary in Item.objects.filter(bar_code__in=bar_codes, status='active').values(
+                'id', 'name', 'bar_code', 'selling_price'
+            )
+        }
+        # Remembers the barcode of each item so saving the item can drop it
+        self.set_many({('item', summary['id']): bar_code for bar_code, summary in summaries.items()})
+        return summaries
+
+    def discard_items(self, item_ids):
+        keys = [('item', item_id) for item_id in item_ids]
+        bar_codes = self.get_many(keys, lambda missing: {})
+        self.discard(keys + list(bar_codes.values()))
+
+
+barcode_cache = BarcodeCache('barcodes')
+
+
+def search_item_ids(query, limit=10, items=None):
+    """Returns the ids of the items best matching query, best first.
+
+    An exact barcode ranks first, then barcode prefixes, then items by the
+    share of the query trigrams found in their name or barcode. items
+    restricts the candidates and defaults to the active items; limit=None
+    returns every match.
+    """
+    query = (query or '').strip()
+    if not query:
+        return []
+
+    scores = {}
+    if items is None:
+        candidates = Item.objects.filter(status='active')
+        exact = barcode_cache.get(query)
+        exact_id = exact['id'] if exact is not None else None
+    else:
+        candidates = items
+        exact_id = candidates.filter(bar_code=query).values_list('pk', flat=True).first()
+    if exact_id is not None:
+        scores[exact_id] = 3.0
+
+    prefixes = candidates.filter(bar_code__istartswith=query).order_by('bar_code').values_list('pk', flat=True)
+    for item_id in prefixes if limit is None else prefixes[:limit]:
+        scores.setdefault(item_id, 2.0)
+
+    query_trigrams = trigrams(query, complete=False)
+    if query_trigrams:
+        min_hits = max(1, math.ceil(len(query_trigrams) * MIN_SIMILARITY))
+        matches = (
+            ItemSearchTrigram.objects.filter(trigram__in=query_trigrams, item__in=candidates.values('pk'))
+            .values('item_id')
+            .annotate(hits=Count('id'))
+            .filter(hits__gte=min_hits)
+            .order_by('-hits')
+        )
+        for match in matches if limit is None else matches[:limit * 5]:
+            scores.setdefault(match['item_id'], match['hits'] / len(query_trigrams))
+
+    ranked = sorted(scores.items(), key=lambda score: -score[1])
+    return [item_id for item_id, _ in (ranked if limit is None else ranked[:limit])]
+
+
+def search_items(query, limit=10):
+    """Returns the items best matching query, best first."""
+    item_ids = search_item_ids(query, limit)
+    items = Item.objects.in_bulk(item_ids)
+    return [items[item_id] for item_id in item_ids if item_id in items]
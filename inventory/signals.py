@@ -0,0 +1,13 @@
+"""
+Inventory Management Signals
+
+This module defines the signals sent by the inventory management system.
+"""
+
+from django.dispatch import Signal
+
+# Sent once when an item's stock crosses into or out of a reorder threshold,
+# after the transaction that moved the stock commits. Receivers get item_id,
+# level ('reorder', 'minimum' or None once stock recovered), previous_level
+# and stock.
+stock_threshold_crossed = Signal()
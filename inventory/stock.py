@@ -0,0 +1,736 @@
+"""
+Stock Posting
+
+This module is the single entry point for changing stock levels.
+
+Every change is written to the append-only StockMovement ledger and the same
+delta is then applied to the StoreItem or SalePointItem balance it affects.
+Balances are therefore a projection of the ledger and can be rebuilt from it
+with replay_movements() whenever they drift; their values are then
+rescaled at the balance's average cost, since the ledger holds no costs.
+
+Balances also carry the cost value of the stock they hold, kept as a
+moving average per item and location: increases add their unit cost and
+decreases remove the average cost of the units they take, in the same
+UPDATE that changes the quantity. Daily StockSnapshot rows let
+stock_as_of() answer stock on hand at any past moment from one snapshot
+plus the movements recorded after it.
+
+Documents post all of their lines at once through post_document(), which
+nets the lines per location and item and writes them set-based, so the
+query count does not grow with the number of lines. Decrements are
+conditional on the stock on hand, so a posting either fits completely or
+raises InsufficientStock without changing anything.
+"""
+
+import random
+import time
+from collections import defaultdict, namedtuple
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from decimal import Decimal
+from functools import wraps
+from threading import local
+
+from django.core.exceptions import ValidationError
+from django.db import DatabaseError, connection, transaction
+from django.db.models import (
+    Case, F, IntegerField, Max, OuterRef, Q, Subquery, Sum, Value, When
+)
+from django.db.models.functions import Coalesce, Greatest
+from django.utils import timezone
+
+from .models import (
+    Item, ItemKitItem, SalePoint, SalePointItem, StockMovement, StockSnapshot, Store, StoreItem
+)
+from .kits import kit_cache
+from .lots import apply_lots, repost_lots
+from .reorder import refresh_reorder_queue
+
+
+def source_fields(source):
+    """Returns the StockMovement source columns for a source document."""
+    if source is None:
+        return {'source_type': 'manual', 'source_id': None}
+    return {'source_type': source._meta.model_name, 'source_id': source.pk}
+
+
+class StockLine(namedtuple(
+    'StockLine',
+    ['item_id', 'quantity', 'store_id', 'sale_point_id', 'unit_cost', 'lot_number', 'expiry_date'],
+    defaults=[None, None, None, None, None]
+)):
+    """One stock delta for an item at either a store or a sale point.
+
+    unit_cost is the cost of one smallest unit for increases whose price is
+    known from the document, such as receivings. lot_number and expiry_date
+    put increases into a StockLot.
+    """
+
+    __slots__ = ()
+
+    @property
+    def location(self):
+        if self.store_id is not None:
+            return ('store', self.store_id)
+        if self.sale_point_id is not None:
+            return ('sale_point', self.sale_point_id)
+        raise ValueError("A stock line needs either a store or a sale point")
+
+
+# Location type -> (location model, balance model). The order is also the
+# order in which postings lock the balance tables.
+LOCATIONS = {
+    'store': (Store, StoreItem),
+    'sale_point': (SalePoint, SalePointItem),
+}
+
+
+Shortage = namedtuple('Shortage', ['location_type', 'location_id', 'item_id', 'requested', 'available'])
+
+
+class InsufficientStock(ValidationError):
+    """Raised when a posting would take stock at a location below zero."""
+
+    def __init__(self, shortages):
+        self.shortages = shortages
+        if not shortages:
+            super().__init__("Insufficient stock to complete this posting")
+            return
+
+        items = dict(Item.objects.filter(pk__in={s.item_id for s in shortages}).values_list('pk', 'name'))
+        locations = {}
+        for location_type, (location_model, _) in LOCATIONS.items():
+            location_ids = {s.location_id for s in shortages if s.location_type == location_type}
+            if location_ids:
+                for pk, name in location_model.objects.filter(pk__in=location_ids).values_list('pk', 'name'):
+                    locations[(location_type, pk)] = name
+
+        super().__init__([
+            f"Insufficient stock for {items.get(s.item_id, s.item_id)} at "
+            f"{locations.get((s.location_type, s.location_id), s.location_id)}: "
+            f"{s.requested} requested, {s.available} available"
+            for s in shortages
+        ])
+
+
+def coalesce_lines(lines):
+    """Nets stock lines per (location, item), dropping lines that cancel out."""
+    totals = defaultdict(int)
+    for line in lines:
+        location_type, location_id = line.location
+        totals[(location_type, location_id, line.item_id)] += line.quantity
+    return {key: quantity for key, quantity in totals.items() if quantity}
+
+
+def _split_by_location(totals):
+    """Yields the totals per balance table in the canonical lock order of LOCATIONS."""
+    for location_type in LOCATIONS:
+        location_totals = {key: qty for key, qty in sorted(totals.items()) if key[0] == location_type}
+        if location_totals:
+            yield location_type, location_totals
+
+
+def _check_locations_active(totals):
+    for location_type, (location_model, _) in LOCATIONS.items():
+        location_ids = {key[1] for key in totals if key[0] == location_type}
+        inactive = location_model.objects.filter(pk__in=location_ids).exclude(status='active')
+        if location_ids and inactive.exists():
+            raise ValidationError(
+                f"Cannot update stock in an inactive {location_model._meta.verbose_name.lower()}"
+            )
+
+
+def _lock_balances(location_type, totals):
+    """Locks the existing balance rows of one table in (location id, item id) order."""
+    _, balance_model = LOCATIONS[location_type]
+    location_field = f'{location_type}_id'
+    matches = Q()
+    for (_, location_id, item_id) in totals:
+        matches |= Q(**{location_field: location_id}, item_id=item_id)
+    list(
+        balance_model.objects.select_for_update()
+        .filter(matches)
+        .order_by(location_field, 'item_id')
+        .values_list('pk', flat=True)
+    )
+
+
+def average_costs(keys):
+    """Returns the average unit cost of the balances with stock among keys."""
+    averages = {}
+    for location_type, location_totals in _split_by_location(dict.fromkeys(keys, 0)):
+        _, balance_model = LOCATIONS[location_type]
+        location_field = f'{location_type}_id'
+        matches = Q()
+        for (_, location_id, item_id) in location_totals:
+            matches |= Q(**{location_field: location_id}, item_id=item_id)
+        for location_id, item_id, quantity, value in balance_model.objects.filter(
+            matches, quantity__gt=0
+        ).values_list(location_field, 'item_id', 'quantity', 'value'):
+            averages[(location_type, location_id, item_id)] = value / quantity
+    return averages
+
+
+def _inbound_costs(lines, totals):
+    """Returns the unit cost of every netted increase of a posting.
+
+    Increases priced by their document keep that price. Others take the
+    average cost of the locations the same document takes the item from,
+    then the current average of the receiving location and finally the
+    item's buying price.
+    """
+    priced = defaultdict(lambda: [0, Decimal(0)])
+    for line in lines:
+        if line.unit_cost is not None and line.quantity > 0:
+            key = (*line.location, line.item_id)
+            priced[key][0] += line.quantity
+            priced[key][1] += line.quantity * Decimal(str(line.unit_cost))
+    costs = {
+        key: value / quantity
+        for key, (quantity, value) in priced.items()
+        if totals.get(key, 0) > 0
+    }
+
+    unpriced = [key for key, quantity in totals.items() if quantity > 0 and key not in costs]
+    if not unpriced:
+        return costs
+
+    item_ids = {key[2] for key in unpriced}
+    averages = average_costs(key for key in totals if key[2] in item_ids)
+    outbound = defaultdict(lambda: [0, Decimal(0)])
+    for key, quantity in totals.items():
+        if quantity < 0 and key in averages:
+            outbound[key[2]][0] -= quantity
+            outbound[key[2]][1] -= quantity * averages[key]
+
+    buying_prices = None
+    for key in unpriced:
+        item_id = key[2]
+        if outbound[item_id][0]:
+            costs[key] = outbound[item_id][1] / outbound[item_id][0]
+        elif key in averages:
+            costs[key] = averages[key]
+        else:
+            if buying_prices is None:
+                buying_prices = dict(Item.objects.filter(pk__in=item_ids).values_list('pk', 'buying_price'))
+            costs[key] = buying_prices[item_id]
+    return costs
+
+
+def _apply_balances(location_type, totals, costs):
+    """Upserts one balance table: insert missing rows, then one conditional UPDATE.
+
+    Each decrement only matches its row while the row still holds enough
+    stock (quantity >= n), so concurrent tills cannot oversell without
+    taking any locks. Returns False when some line did not match.
+
+    value is assigned before quantity because MySQL evaluates SET
+    assignments left to right, and decreases need the old quantity.
+    """
+    _, balance_model = LOCATIONS[location_type]
+    location_field = f'{location_type}_id'
+    now = timezone.now()
+
+    balance_model.objects.bulk_create(
+        [
+            balance_model(**{location_field: location_id}, item_id=item_id, quantity=0)
+            for (_, location_id, item_id), quantity in sorted(totals.items())
+            if quantity > 0
+        ],
+        ignore_conflicts=True,
+    )
+
+    value_field = balance_model._meta.get_field('value')
+    matches = Q()
+    whens = []
+    value_whens = []
+    for key, quantity in totals.items():
+        _, location_id, item_id = key
+        condition = Q(**{location_field: location_id}, item_id=item_id)
+        whens.append(When(condition, then=Value(quantity)))
+        if quantity < 0:
+            value_whens.append(When(condition, then=F('value') - F('value') * Value(-quantity) / F('quantity')))
+            condition &= Q(quantity__gte=-quantity)
+        else:
+            value_whens.append(When(condition, then=F('value') + Value(quantity * costs[key])))
+        matches |= condition
+
+    updated = balance_model.objects.filter(matches).update(
+        value=Case(*value_whens, default=F('value'), output_field=value_field),
+        quantity=F('quantity') + Case(*whens, default=Value(0), output_field=IntegerField()),
+        last_updated=now,
+    )
+    return updated == len(totals)
+
+
+def find_shortages(totals):
+    """Returns a Shortage for every netted decrement the current stock cannot cover."""
+    shortages = []
+    for location_type, (location_model, balance_model) in LOCATIONS.items():
+        location_field = f'{location_type}_id'
+        requested = {
+            (location_id, item_id): -quantity
+            for (key_type, location_id, item_id), quantity in totals.items()
+            if key_type == location_type and quantity < 0
+        }
+        if not requested:
+            continue
+
+        available = dict.fromkeys(requested, 0)
+        balances = balance_model.objects.filter(
+            **{f'{location_field}__in': {key[0] for key in requested}},
+            item_id__in={key[1] for key in requested},
+        ).values_list(location_field, 'item_id', 'quantity')
+        for location_id, item_id, quantity in balances:
+            if (location_id, item_id) in available:
+                available[(location_id, item_id)] = quantity
+
+        shortages += [
+            Shortage(location_type, location_id, item_id, quantity, available[(location_id, item_id)])
+            for (location_id, item_id), quantity in requested.items()
+            if available[(location_id, item_id)] < quantity
+        ]
+    return shortages
+
+
+def rebuild_item_totals(item_ids):
+    """Recomputes Item.store_stock and Item.shop_stock from the balances in one UPDATE.
+
+    Only needed after balances were rebuilt; regular postings adjust the
+    totals by their deltas through apply_item_deltas().
+    """
+    def location_sum(balance_model):
+        return Coalesce(
+            Subquery(
+                balance_model.objects.filter(item=OuterRef('pk'))
+                .values('item')
+                .annotate(total=Sum('quantity'))
+                .values('total')
+            ),
+            0,
+        )
+
+    Item.objects.filter(pk__in=item_ids).update(
+        store_stock=location_sum(StoreItem),
+        shop_stock=location_sum(SalePointItem),
+    )
+    refresh_reorder_queue(item_ids)
+
+
+_deferred = local()
+
+
+def apply_item_deltas(store_deltas=None, shop_deltas=None):
+    """Adds per-item deltas to Item.store_stock and Item.shop_stock in one UPDATE.
+
+    Inside deferred_item_totals() the deltas are only collected and written
+    once when the block finishes.
+    """
+    store_deltas = {k: v for k, v in (store_deltas or {}).items() if v}
+    shop_deltas = {k: v for k, v in (shop_deltas or {}).items() if v}
+
+    pending = getattr(_deferred, 'pending', None)
+    if pending is not None:
+        for item_id, quantity in store_deltas.items():
+            pending['store_stock'][item_id] += quantity
+        for item_id, quantity in shop_deltas.items():
+            pending['shop_stock'][item_id] += quantity
+        return
+
+    updates = {}
+    for field, deltas in (('store_stock', store_deltas), ('shop_stock', shop_deltas)):
+        if deltas:
+            updates[field] = F(field) + Case(
+                *[When(pk=item_id, then=Value(quantity)) for item_id, quantity in deltas.items()],
+                default=Value(0),
+                output_field=IntegerField(),
+            )
+    if updates:
+        item_ids = store_deltas.keys() | shop_deltas.keys()
+        Item.objects.filter(pk__in=item_ids).update(**updates)
+        refresh_reorder_queue(item_ids)
+
+
+@contextmanager
+def deferred_item_totals():
+    """Coalesces Item total updates made inside the block into a single UPDATE.
+
+    The block runs in a transaction and the collected deltas are written just
+    before it commits, so a view that posts several documents touches each
+    Item row once. Nested blocks join the outermost one.
+    """
+    with transaction.atomic():
+        if getattr(_deferred, 'pending', None) is not None:
+            yield
+            return
+
+        _deferred.pending = {'store_stock': defaultdict(int), 'shop_stock': defaultdict(int)}
+        try:
+            yield
+            pending = _deferred.pending
+        finally:
+            _deferred.pending = None
+        apply_item_deltas(pending['store_stock'], pending['shop_stock'])
+
+
+@transaction.atomic
+def post_document(lines, source=None, lock_rows=False, lots=True):
+    """Applies all stock lines of a document with a fixed number of statements.
+
+    Lines are netted per (location, item) and then written as one ledger
+    insert, one upsert per balance table and one UPDATE that adds the same
+    deltas to the Item totals, no matter how many lines the document has.
+    Returns the netted deltas.
+
+    Documents that touch several locations pass lock_rows=True so the
+    balance rows are locked up front in the canonical (location type,
+    location id, item id) order. Two documents moving stock in opposite
+    directions then wait for each other instead of deadlocking.
+
+    With lots=False the StockLots are left to the caller.
+    """
+    lines = list(lines)
+    totals = coalesce_lines(lines)
+    if not totals:
+        return totals
+
+    _check_locations_active(totals)
+
+    # Savepoint so a short line undoes the balance updates of the whole document
+    with transaction.atomic():
+        if lock_rows:
+            for location_type, location_totals in _split_by_location(totals):
+                _lock_balances(location_type, location_totals)
+        costs = _inbound_costs(lines, totals)
+        complete = all([
+            _apply_balances(location_type, location_totals, costs)
+            for location_type, location_totals in _split_by_location(totals)
+        ])
+        if not complete:
+            transaction.set_rollback(True)
+    if not complete:
+        raise InsufficientStock(find_shortages(totals))
+
+    fields = source_fields(source)
+    now = timezone.now()
+    StockMovement.objects.bulk_create([
+        StockMovement(
+            item_id=item_id,
+            quantity=quantity,
+            created_at=now,
+            **{f'{location_type}_id': location_id},
+            **fields
+        )
+        for (location_type, location_id, item_id), quantity in totals.items()
+    ])
+
+    if lots:
+        apply_lots(lines, totals)
+
+    sale_point_items = defaultdict(set)
+    for (location_type, location_id, item_id) in totals:
+        if location_type == 'sale_point':
+            sale_point_items[location_id].add(item_id)
+    if sale_point_items:
+        kit_cache.discard_stock(sale_point_items)
+
+    item_deltas = {'store': defaultdict(int), 'sale_point': defaultdict(int)}
+    for (location_type, _, item_id), quantity in totals.items():
+        item_deltas[location_type][item_id] += quantity
+    apply_item_deltas(item_deltas['store'], item_deltas['sale_point'])
+    return totals
+
+
+def _line_values(lines):
+    """Returns the priced value of stock lines per (location, item)."""
+    values = defaultdict(Decimal)
+    for line in lines:
+        if line.unit_cost is not None:
+            values[(*line.location, line.item_id)] += line.quantity * Decimal(str(line.unit_cost))
+    return values
+
+
+def _revalue_balances(location_type, deltas):
+    """Adds value deltas to balances whose quantity is unchanged, with one UPDATE."""
+    _, balance_model = LOCATIONS[location_type]
+    location_field = f'{location_type}_id'
+    matches = Q()
+    whens = []
+    for (_, location_id, item_id), delta in deltas.items():
+        condition = Q(**{location_field: location_id}, item_id=item_id)
+        whens.append(When(condition, then=Value(delta)))
+        matches |= condition
+    value_field = balance_model._meta.get_field('value')
+    balance_model.objects.filter(matches, quantity__gt=0).update(
+        value=Greatest(
+            F('value') + Case(*whens, default=Value(0), output_field=value_field),
+            Value(0),
+            output_field=value_field,
+        ),
+        last_updated=timezone.now(),
+    )
+
+
+@transaction.atomic
+def repost_document(old_lines, new_lines, source=None):
+    """Posts only the difference between the lines a document posted and its edited lines.
+
+    Lines the edit left alone cancel out and write nothing. Increases are
+    priced from the new lines. Where an edit only changes a price, the
+    quantity stays put and the balance value is corrected without a stock
+    movement. Lots are moved by the change per lot, so an edit of only a
+    lot number or expiry date moves the quantity between lots. Returns the
+    netted deltas.
+    """
+    old_lines, new_lines = list(old_lines), list(new_lines)
+    totals = post_document(
+        [line._replace(quantity=-line.quantity) for line in old_lines] + new_lines, source=source, lots=False
+    )
+    repost_lots(old_lines, new_lines)
+
+    old_values, new_values = _line_values(old_lines), _line_values(new_lines)
+    deltas = {
+        key: new_values.get(key, 0) - old_values.get(key, 0)
+        for key in old_values.keys() | new_values.keys()
+        if key not in totals
+    }
+    deltas = {key: delta for key, delta in deltas.items() if delta}
+    for location_type, location_deltas in _split_by_location(deltas):
+        _revalue_balances(location_type, location_deltas)
+    return totals
+
+
+# MySQL deadlock and lock wait timeout, PostgreSQL serialization failure and deadlock
+RETRYABLE_ERROR_CODES = {1213, 1205, '40001', '40P01'}
+
+
+def is_retryable_error(error):
+    """Returns True for deadlock and serialization errors that are safe to retry."""
+    code = getattr(error.__cause__, 'pgcode', None) or (error.args[0] if error.args else None)
+    if code in RETRYABLE_ERROR_CODES:
+        return True
+    return 'database is locked' in str(error) or 'database table is locked' in str(error)
+
+
+def retry_on_deadlock(func=None, attempts=5, backoff=0.05):
+    """Retries a posting function when the database aborts it for a deadlock.
+
+    The whole transaction is retried, so the function must open its own
+    transaction and is only retried when it is not called inside another
+    one. Waits grow exponentially with jitter between attempts.
+    """
+    if func is None:
+        return lambda f: retry_on_deadlock(f, attempts=attempts, backoff=backoff)
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        for attempt in range(1, attempts + 1):
+            try:
+                return func(*args, **kwargs)
+            except DatabaseError as e:
+                if attempt == attempts or connection.in_atomic_block or not is_retryable_error(e):
+                    raise
+                time.sleep(backoff * (2 ** (attempt - 1)) * (1 + random.random()))
+    return wrapper
+
+
+def stock_values(items=None):
+    """Returns the cost value of the stock of each item across all locations in one query."""
+    store_values = StoreItem.objects.values('item_id').annotate(total=Sum('value')).order_by()
+    sale_point_values = SalePointItem.objects.values('item_id').annotate(total=Sum('value')).order_by()
+    if items is not None:
+        store_values = store_values.filter(item__in=items)
+        sale_point_values = sale_point_values.filter(item__in=items)
+
+    values = defaultdict(Decimal)
+    for row in store_values.union(sale_point_values, all=True):
+        values[row['item_id']] += row['total']
+    return dict(values)
+
+
+def kit_components(kits):
+    """Expands {kit_id: quantity} into the {item_id: quantity} of its components with one query."""
+    components = defaultdict(int)
+    if kits:
+        rows = ItemKitItem.objects.filter(item_kit_id__in=kits.keys()).values_list('item_kit_id', 'item_id', 'quantity')
+        for kit_id, item_id, quantity in rows:
+            components[item_id] += quantity * kits[kit_id]
+    return components
+
+
+def sale_point_lines(sale_point, items=None, kits=None, sign=-1):
+    """Builds sale point stock lines for sold (sign=-1) or returned (sign=1) items and kits."""
+    quantities = defaultdict(int)
+    for item_id, quantity in (items or {}).items():
+        quantities[item_id] += quantity
+    for item_id, quantity in kit_components(kits).items():
+        quantities[item_id] += quantity
+    return [
+        StockLine(item_id, sign * quantity, sale_point_id=sale_point.pk)
+        for item_id, quantity in quantities.items()
+    ]
+
+
+def decrement_stock(sale_point, items=None, kits=None, source=None):
+    """Takes sold items and kits out of a sale point in one conditional posting.
+
+    items and kits map ids to quantities. Either every line is covered by
+    the stock on hand or nothing is posted and InsufficientStock lists the
+    short lines.
+    """
+    return post_document(sale_point_lines(sale_point, items, kits), source=source)
+
+
+@transaction.atomic
+def replay_movements(items=None):
+    """Rebuilds StoreItem and SalePointItem quantities from the ledger.
+
+    Pass a list of items to limit the replay, otherwise every balance is
+    recomputed. Returns the number of balance rows that were corrected.
+
+    The ledger holds no costs, so the value of a corrected balance is its
+    new quantity at the balance's average cost, or at the item's buying
+    price where the balance had no stock to average. Empty balances are
+    worth nothing.
+    """
+    movements = StockMovement.objects.all()
+    store_items = StoreItem.objects.all()
+    sale_point_items = SalePointItem.objects.all()
+    if items is not None:
+        movements = movements.filter(item__in=items)
+        store_items = store_items.filter(item__in=items)
+        sale_point_items = sale_point_items.filter(item__in=items)
+
+    corrected = 0
+    affected_items = set()
+    for model, location_field, balances in (
+        (StoreItem, 'store', store_items),
+        (SalePointItem, 'sale_point', sale_point_items),
+    ):
+        totals = {
+            (row[location_field], row['item']): row['total']
+            for row in movements.filter(**{f'{location_field}__isnull': False})
+            .values(location_field, 'item')
+            .annotate(total=Sum('quantity'))
+            .order_by()
+        }
+
+        drifted = []
+        unpriced = []
+        for balance in balances.select_for_update():
+            key = (getattr(balance, f'{location_field}_id'), balance.item_id)
+            expected = totals.pop(key, 0)
+            if balance.quantity != expected or (expected <= 0 and balance.value):
+                if expected <= 0:
+                    balance.value = 0
+                elif balance.quantity > 0:
+                    balance.value = balance.value / balance.quantity * expected
+                else:
+                    unpriced.append(balance)
+                balance.quantity = expected
+                drifted.append(balance)
+                affected_items.add(balance.item_id)
+
+        missing = [
+            model(**{f'{location_field}_id': location_id}, item_id=item_id, quantity=total)
+            for (location_id, item_id), total in totals.items()
+        ]
+        unpriced += [balance for balance in missing if balance.quantity > 0]
+        if unpriced:
+            buying_prices = dict(
+                Item.objects.filter(pk__in={balance.item_id for balance in unpriced}).values_list('pk', 'buying_price')
+            )
+            for balance in unpriced:
+                balance.value = buying_prices[balance.item_id] * balance.quantity
+        model.objects.bulk_update(drifted, ['quantity', 'value'])
+        model.objects.bulk_create(missing)
+        affected_items.update(item_id for _, item_id in totals)
+        corrected += len(drifted) + len(missing)
+
+    rebuild_item_totals(affected_items)
+    kit_cache.clear()
+
+    return corrected
+
+
+def day_end(day):
+    """Returns the moment a day closes, which is the start of the next day."""
+    return timezone.make_aware(datetime.combine(day + timedelta(days=1), datetime.min.time()))
+
+
+def _location_totals(rows, field):
+    """Folds store/sale point rows into {(location type, location id, item id): quantity}."""
+    totals = defaultdict(int)
+    for row in rows:
+        if row['store_id'] is not None:
+            key = ('store', row['store_id'], row['item_id'])
+        else:
+            key = ('sale_point', row['sale_point_id'], row['item_id'])
+        totals[key] += row[field]
+    return totals
+
+
+def stock_as_of(moment, items=None, stores=None, sale_points=None):
+    """Returns the stock on hand just before moment.
+
+    Reads the latest snapshot closed by then and adds the movements recorded
+    after it, so the cost depends on the time since the last snapshot rather
+    than on the length of the history. The result maps (location type,
+    location id, item id) to quantity and leaves out zero balances.
+    """
+    snapshots = StockSnapshot.objects.all()
+    movements = StockMovement.objects.filter(created_at__lt=moment)
+    if items is not None:
+        snapshots = snapshots.filter(item__in=items)
+        movements = movements.filter(item__in=items)
+    if stores is not None or sale_points is not None:
+        locations = Q(store__in=stores or []) | Q(sale_point__in=sale_points or [])
+        snapshots = snapshots.filter(locations)
+        movements = movements.filter(locations)
+
+    # Snapshots hold every non-zero balance of their day, so the latest day
+    # is looked up across all rows and a missing row means zero.
+    base_date = StockSnapshot.objects.filter(
+        date__lt=timezone.localdate(moment)
+    ).aggregate(latest=Max('date'))['latest']
+
+    totals = defaultdict(int)
+    if base_date is not None:
+        totals = _location_totals(
+            snapshots.filter(date=base_date).values('store_id', 'sale_point_id', 'item_id', 'quantity'),
+            'quantity'
+        )
+        movements = movements.filter(created_at__gte=day_end(base_date))
+
+    deltas = _location_totals(
+        movements.values('store_id', 'sale_point_id', 'item_id').annotate(total=Sum('quantity')).order_by(),
+        'total'
+    )
+    for key, quantity in deltas.items():
+        totals[key] += quantity
+    return {key: quantity for key, quantity in totals.items() if quantity}
+
+
+@transaction.atomic
+def take_snapshot(day):
+    """Stores the closing stock of every item and location for day.
+
+    Taking the snapshot of a day again replaces it. Returns the number of
+    snapshot rows written.
+    """
+    closing = stock_as_of(day_end(day))
+    StockSnapshot.objects.filter(date=day).delete()
+    StockSnapshot.objects.bulk_create(
+        [
+            StockSnapshot(
+                date=day,
+                item_id=item_id,
+                quantity=quantity,
+                **{f'{location_type}_id': location_id},
+            )
+            for (location_type, location_id, item_id), quantity in sorted(closing.items())
+        ],
+        batch_size=1000,
+    )
+    return len(closing)
@@ -1,3 +1,1454 @@
-from django.test import TestCase
+"""
+Inventory Management Tests
 
-# Create your tests here.
+This module defines the tests for stock posting in the inventory system.
+"""
+
+import io
+import json
+import os
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
+import numpy as np
+from datetime import date, datetime, time, timedelta
+from decimal import Decimal
+from django.core.exceptions import ValidationError
+from django.db import OperationalError, connection, connections, transaction
+from django.db.models import Sum
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.test import TestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from company.models import Company, Branch, Department, Category, Employee
+from .models import (
+    Store, SalePoint, Item, StoreItem, SalePointItem, ItemUnit, ItemKit, ItemKitItem,
+    Transfer, TransferItem, Issue, IssuedItem, StockMovement, StockSnapshot, Supplier, Receiving,
+    ReceivedItem, ReorderQueue, Adjustment, StockLot, IdempotencyKey
+)
+from .counting import open_session, post_session, record_counts
+from .forecasting import forecast_reorder_levels, smooth
+from .importers import ItemImporter, RowError, read_csv
+from .kits import kit_availability, kit_cache
+from .lots import expiring_lots
+from .matrix import matrix_csv, matrix_items, matrix_locations, stock_matrix
+from .replenishment import ReplenishmentLine, allocate, draft_issues, plan_replenishment
+from .search import barcode_cache, search_item_ids, trigrams
+from .signals import stock_threshold_crossed
+from .forms import IssueItemFormSet
+from .stock import (
+    InsufficientStock, Shortage, StockLine, day_end, decrement_stock, deferred_item_totals,
+    post_document, replay_movements, repost_document, retry_on_deadlock, stock_as_of, take_snapshot
+)
+from .units import UnitCache, load_units, unit_cache
+
+
+class InventoryFixtures:
+    def setUp(self):
+        self.company = Company.objects.create(
+            company_name='Test Company',
+            company_email='company@example.com',
+            company_phone='1234567890',
+            company_location='Test Location'
+        )
+        self.branch = Branch.objects.get(company=self.company)
+        self.department = Department.objects.create(
+            department_name='Test Department',
+            department_description='Test Description',
+            branch=self.branch
+        )
+        self.category = Category.objects.create(
+            category_name='Test Category',
+            category_description='Test Description',
+            department=self.department
+        )
+        self.employee = Employee.objects.create(
+            employee_name='Test Employee',
+            employee_email='employee@example.com',
+            employee_phone='1234567890',
+            employee_address='Test Address',
+            employee_department=self.department,
+            employee_branch=self.branch,
+            employee_position='Storekeeper',
+            employee_salary=Decimal('1000.00'),
+            first_name='Test',
+            last_name='Employee'
+        )
+        self.store = Store.objects.create(
+            name='Main Store',
+            address='Test Address',
+            branch=self.branch,
+            contact_person=self.employee,
+            contact_number='1234567890'
+        )
+        self.other_store = Store.objects.create(
+            name='Back Store',
+            address='Test Address',
+            branch=self.branch,
+            contact_person=self.employee,
+            contact_number='1234567890'
+        )
+        self.sale_point = SalePoint.objects.create(
+            name='Front Counter',
+            address='Test Address',
+            branch=self.branch,
+            contact_person=self.employee,
+            contact_number='1234567890'
+        )
+        self.item = self.create_item('Test Item', '1000001')
+
+    def create_item(self, name, bar_code=None):
+        return Item.objects.create(
+            name=name,
+            bar_code=bar_code,
+            department=self.department,
+            category=self.category,
+            buying_price=Decimal('10.00'),
+            selling_price=Decimal('15.00'),
+            smallest_unit='piece'
+        )
+
+    def base_unit(self, item):
+        return ItemUnit.objects.get(item=item, smallest_units=1)
+
+
+class InventoryTestCase(InventoryFixtures, TestCase):
+    pass
+
+
+class StockLedgerTest(InventoryTestCase):
+    def test_update_stock_records_movement(self):
+        self.store.update_stock(20, self.item)
+        self.store.update_stock(-5, self.item)
+
+        store_item = StoreItem.objects.get(store=self.store, item=self.item)
+        self.assertEqual(store_item.quantity, 15)
+        self.assertEqual(
+            list(StockMovement.objects.filter(item=self.item).values_list('quantity', flat=True).order_by('id')),
+            [20, -5]
+        )
+        self.item.refresh_from_db()
+        self.assertEqual(self.item.store_stock, 15)
+
+    def test_movement_records_source_document(self):
+        self.store.update_stock(30, self.item)
+        issue = Issue.objects.create(
+            store=self.store,
+            sale_point=self.sale_point,
+            requested_by=self.employee,
+            status='approved'
+        )
+        IssuedItem.objects.create(item=self.item, issue=issue, unit=self.base_unit(self.item), quantity=12)
+
+        issue.complete(self.employee)
+
+        movements = StockMovement.objects.filter(source_type='issue', source_id=issue.pk)
+        self.assertEqual(movements.count(), 2)
+        self.assertEqual(movements.get(store=self.store).quantity, -12)
+        self.assertEqual(movements.get(sale_point=self.sale_point).quantity, 12)
+
+    def test_transfer_writes_ledger(self):
+        self.store.update_stock(10, self.item)
+        transfer = Transfer.objects.create(
+            transfer_type='store_to_store',
+            from_store=self.store,
+            to_store=self.other_store,
+            user_responsible=self.employee
+        )
+        TransferItem.objects.create(transfer=transfer, item=self.item, unit=self.base_unit(self.item), quantity=4)
+
+        transfer.complete_transfer()
+
+        self.assertEqual(StoreItem.objects.get(store=self.store, item=self.item).quantity, 6)
+        self.assertEqual(StoreItem.objects.get(store=self.other_store, item=self.item).quantity, 4)
+        self.assertEqual(StockMovement.objects.filter(source_type='transfer', source_id=transfer.pk).count(), 2)
+
+    def test_replay_corrects_drifted_balances(self):
+        self.store.update_stock(10, self.item)
+        self.sale_point.update_stock(3, self.item)
+        StoreItem.objects.filter(store=self.store, item=self.item).update(quantity=99)
+        SalePointItem.objects.filter(sale_point=self.sale_point, item=self.item).delete()
+
+        corrected = replay_movements()
+
+        self.assertEqual(corrected, 2)
+        self.assertEqual(StoreItem.objects.get(store=self.store, item=self.item).quantity, 10)
+        self.assertEqual(SalePointItem.objects.get(sale_point=self.sale_point, item=self.item).quantity, 3)
+        self.item.refresh_from_db()
+        self.assertEqual(self.item.store_stock, 10)
+        self.assertEqual(self.item.shop_stock, 3)
+
+    def test_replay_rescales_values_at_average_cost(self):
+        self.store.update_stock(10, self.item)
+        self.other_store.update_stock(4, self.item)
+        StoreItem.objects.filter(store=self.store, item=self.item).update(quantity=20)
+        StoreItem.objects.filter(store=self.other_store, item=self.item).update(quantity=0, value=0)
+
+        replay_movements()
+
+        # The drifted row kept its total value over twice the units
+        store_item = StoreItem.objects.get(store=self.store, item=self.item)
+        self.assertEqual((store_item.quantity, store_item.value), (10, Decimal('50')))
+        other = StoreItem.objects.get(store=self.other_store, item=self.item)
+        self.assertEqual((other.quantity, other.value), (4, 4 * self.item.buying_price))
+
+
+class BulkPostingTest(InventoryTestCase):
+    def create_transfer(self, lines):
+        transfer = Transfer.objects.create(
+            transfer_type='store_to_store',
+            from_store=self.store,
+            to_store=self.other_store,
+            user_responsible=self.employee
+        )
+        for index in range(lines):
+            item = self.create_item(f'Bulk Item {transfer.pk}-{index}')
+            self.store.update_stock(10, item)
+            TransferItem.objects.create(transfer=transfer, item=item, unit=self.base_unit(item), quantity=2)
+        return Transfer.objects.get(pk=transfer.pk)
+
+    def test_query_count_does_not_grow_with_lines(self):
+        small = self.create_transfer(2)
+        large = self.create_transfer(25)
+
+        with CaptureQueriesContext(connection) as small_queries:
+            small.complete_transfer()
+        with CaptureQueriesContext(connection) as large_queries:
+            large.complete_transfer()
+
+        self.assertEqual(len(small_queries), len(large_queries))
+        self.assertEqual(StoreItem.objects.filter(store=self.other_store, quantity=2).count(), 27)
+
+    def test_post_document_nets_lines(self):
+        totals = post_document([
+            StockLine(self.item.pk, 5, store_id=self.store.pk),
+            StockLine(self.item.pk, 3, store_id=self.store.pk),
+            StockLine(self.item.pk, 4, sale_point_id=self.sale_point.pk),
+            StockLine(self.item.pk, -4, sale_point_id=self.sale_point.pk),
+        ])
+
+        self.assertEqual(totals, {('store', self.store.pk, self.item.pk): 8})
+        self.assertEqual(StockMovement.objects.count(), 1)
+        self.item.refresh_from_db()
+        self.assertEqual(self.item.store_stock, 8)
+        self.assertEqual(self.item.shop_stock, 0)
+
+    def test_inactive_location_is_rejected(self):
+        self.other_store.status = 'inactive'
+        self.other_store.save()
+
+        with self.assertRaises(ValidationError):
+            post_document([StockLine(self.item.pk, 5, store_id=self.other_store.pk)])
+        self.assertFalse(StockMovement.objects.exists())
+
+
+class ItemTotalsTest(InventoryTestCase):
+    def test_totals_follow_posting_deltas(self):
+        self.store.update_stock(7, self.item)
+        self.sale_point.update_stock(2, self.item)
+        self.store.update_stock(-3, self.item)
+
+        self.item.refresh_from_db()
+        self.assertEqual(self.item.store_stock, 4)
+        self.assertEqual(self.item.shop_stock, 2)
+
+    def test_direct_balance_edits_apply_their_delta(self):
+        self.store.update_stock(10, self.item)
+        store_item = StoreItem.objects.get(store=self.store, item=self.item)
+        store_item.quantity = 6
+        store_item.save()
+
+        self.item.refresh_from_db()
+        self.assertEqual(self.item.store_stock, 6)
+
+        store_item.delete()
+        self.item.refresh_from_db()
+        self.assertEqual(self.item.store_stock, 0)
+
+    def test_deferred_totals_touch_each_item_once(self):
+        with CaptureQueriesContext(connection) as queries:
+            with deferred_item_totals():
+                for _ in range(3):
+                    self.store.update_stock(5, self.item)
+                    self.sale_point.update_stock(1, self.item)
+
+        item_updates = [
+            query for query in queries.captured_queries
+            if query['sql'].startswith(f'UPDATE {connection.ops.quote_name(Item._meta.db_table)}')
+        ]
+        self.assertEqual(len(item_updates), 1)
+        self.item.refresh_from_db()
+        self.assertEqual(self.item.store_stock, 15)
+        self.assertEqual(self.item.shop_stock, 3)
+
+
+class ConditionalDecrementTest(InventoryTestCase):
+    def setUp(self):
+        super().setUp()
+        self.other_item = self.create_item('Other Item', '1000002')
+        self.sale_point.update_stock(5, self.item)
+        self.sale_point.update_stock(1, self.other_item)
+
+    def test_decrement_within_stock(self):
+        decrement_stock(self.sale_point, items={self.item.pk: 5})
+
+        self.assertEqual(SalePointItem.objects.get(sale_point=self.sale_point, item=self.item).quantity, 0)
+        self.item.refresh_from_db()
+        self.assertEqual(self.item.shop_stock, 0)
+
+    def test_short_line_posts_nothing(self):
+        movements = StockMovement.objects.count()
+
+        with self.assertRaises(InsufficientStock) as raised:
+            decrement_stock(self.sale_point, items={self.item.pk: 2, self.other_item.pk: 3})
+
+        self.assertEqual(
+            raised.exception.shortages,
+            [Shortage('sale_point', self.sale_point.pk, self.other_item.pk, 3, 1)]
+        )
+        self.assertIn('Other Item at Front Counter: 3 requested, 1 available', raised.exception.messages[0])
+        self.assertEqual(SalePointItem.objects.get(sale_point=self.sale_point, item=self.item).quantity, 5)
+        self.assertEqual(StockMovement.objects.count(), movements)
+
+    def test_kit_components_are_checked_together(self):
+        kit = ItemKit.objects.create(name='Test Kit', department=self.department, category=self.category)
+        ItemKitItem.objects.create(item_kit=kit, item=self.item, quantity=2)
+        ItemKitItem.objects.create(item_kit=kit, item=self.other_item, quantity=1)
+
+        decrement_stock(self.sale_point, kits={kit.pk: 1})
+        with self.assertRaises(InsufficientStock) as raised:
+            decrement_stock(self.sale_point, kits={kit.pk: 1}, items={self.item.pk: 1})
+
+        self.assertEqual(
+            [(s.item_id, s.requested, s.available) for s in raised.exception.shortages],
+            [(self.other_item.pk, 1, 0)]
+        )
+        self.assertEqual(SalePointItem.objects.get(sale_point=self.sale_point, item=self.item).quantity, 3)
+
+
+class StockAsOfTest(InventoryTestCase):
+    def setUp(self):
+        super().setUp()
+        self.days = [date(2026, 3, 29), date(2026, 3, 30), date(2026, 3, 31)]
+        for day, quantity in zip(self.days, (10, 5, -3)):
+            self.store.update_stock(quantity, self.item)
+            StockMovement.objects.filter(pk=StockMovement.objects.latest('id').pk).update(
+                created_at=timezone.make_aware(datetime.combine(day, time(12)))
+            )
+        self.sale_point.update_stock(2, self.item)
+
+    def test_as_of_replays_movements_after_snapshot(self):
+        take_snapshot(self.days[0])
+        # Older movements are no longer needed once a snapshot covers them
+        StockMovement.objects.filter(created_at__lt=day_end(self.days[0])).delete()
+
+        with self.assertNumQueries(3):
+            stock = stock_as_of(day_end(self.days[1]))
+
+        self.assertEqual(stock, {('store', self.store.pk, self.item.pk): 15})
+        self.assertEqual(
+            stock_as_of(timezone.now() + timedelta(seconds=1)),
+            {('store', self.store.pk, self.item.pk): 12, ('sale_point', self.sale_point.pk, self.item.pk): 2}
+        )
+
+    def test_snapshot_can_be_retaken(self):
+        self.assertEqual(take_snapshot(self.days[1]), 1)
+        self.store.update_stock(1, self.item)
+        self.assertEqual(take_snapshot(self.days[1]), 1)
+
+        self.assertEqual(StockSnapshot.objects.get(date=self.days[1]).quantity, 15)
+        self.assertEqual(
+            stock_as_of(day_end(self.days[0]), stores=[self.store]),
+            {('store', self.store.pk, self.item.pk): 10}
+        )
+
+    def test_inventory_report_as_of(self):
+        from reports.views import generate_inventory_report
+
+        report = generate_inventory_report(self.days[1])
+
+        self.assertEqual(list(report['store_stock']['Quantity']), [15])
+        self.assertTrue(report['sale_point_stock'].empty)
+        self.assertEqual(report['items'].iloc[0]['Total Stock'], 15)
+
+
+class ValuationTest(InventoryTestCase):
+    def receive(self, quantity, unit_price, unit=None):
+        supplier, _ = Supplier.objects.get_or_create(
+            name='Test Supplier',
+            defaults={'address': 'Test Address', 'contact_person': 'Supplier', 'contact_number': '1234567890'}
+        )
+        receiving = Receiving.objects.create(
+            supplier=supplier,
+            department=self.department,
+            user_responsible=self.employee,
+            store=self.store
+        )
+        ReceivedItem.objects.create(
+            item=self.item,
+            receiving=receiving,
+            unit=unit or self.base_unit(self.item),
+            quantity=quantity,
+            unit_price=unit_price,
+            total_cost=quantity * unit_price
+        )
+
+    def store_value(self, store):
+        return StoreItem.objects.get(store=store, item=self.item).value
+
+    def test_receipts_keep_moving_average(self):
+        self.receive(10, 10)
+        self.receive(10, 20)
+
+        self.assertEqual(self.store_value(self.store), Decimal('300'))
+        decrement = [StockLine(self.item.pk, -5, store_id=self.store.pk)]
+        post_document(decrement)
+        self.assertEqual(self.store_value(self.store), Decimal('225'))
+
+    def test_receipt_in_larger_unit_costs_per_smallest_unit(self):
+        box = ItemUnit.objects.create(item=self.item, unit='box', smallest_units=12, buying_price=120)
+
+        self.receive(2, 60, unit=box)
+
+        store_item = StoreItem.objects.get(store=self.store, item=self.item)
+        self.assertEqual((store_item.quantity, store_item.value), (24, Decimal('120')))
+
+    def test_transfer_moves_value_at_source_average(self):
+        self.receive(10, 12)
+        transfer = Transfer.objects.create(
+            transfer_type='store_to_store',
+            from_store=self.store,
+            to_store=self.other_store,
+            user_responsible=self.employee
+        )
+        TransferItem.objects.create(transfer=transfer, item=self.item, unit=self.base_unit(self.item), quantity=4)
+
+        transfer.complete_transfer()
+
+        self.assertEqual(self.store_value(self.store), Decimal('72'))
+        self.assertEqual(self.store_value(self.other_store), Decimal('48'))
+
+    def test_unpriced_increase_uses_buying_price(self):
+        self.sale_point.update_stock(3, self.item)
+
+        self.assertEqual(SalePointItem.objects.get(sale_point=self.sale_point, item=self.item).value, Decimal('30'))
+
+    def test_valuation_reads_are_single_queries(self):
+        self.receive(10, 12)
+        self.sale_point.update_stock(3, self.item)
+
+        with self.assertNumQueries(1):
+            self.assertEqual(self.store.get_total_value(), Decimal('120'))
+        with self.assertNumQueries(1):
+            self.assertEqual(self.item.get_stock_value(), Decimal('150'))
+
+
+class ReorderQueueTest(InventoryTestCase):
+    def setUp(self):
+        super().setUp()
+        self.item.minimum_stock = 10
+        self.item.reorder_point = 5
+        self.item.save()
+        self.store.update_stock(20, self.item)
+        self.crossings = []
+        stock_threshold_crossed.connect(self.record_crossing)
+        self.addCleanup(stock_threshold_crossed.disconnect, self.record_crossing)
+
+    def record_crossing(self, sender, item_id, level, previous_level, stock, **kwargs):
+        self.crossings.append((level, previous_level, stock))
+
+    def move(self, quantity):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.store.update_stock(quantity, self.item)
+
+    def test_crossings_fire_once(self):
+        self.move(-11)
+        self.move(-2)
+        self.move(-3)
+        self.move(-1)
+        self.move(30)
+
+        self.assertEqual(
+            self.crossings,
+            [('minimum', None, 9), ('reorder', 'minimum', 4), (None, 'reorder', 33)]
+        )
+        self.assertFalse(ReorderQueue.objects.exists())
+
+    def test_shop_stock_counts_towards_total(self):
+        self.move(-12)
+        self.assertEqual(ReorderQueue.objects.get(item=self.item).level, 'minimum')
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.sale_point.update_stock(4, self.item)
+
+        self.assertFalse(ReorderQueue.objects.exists())
+
+    def test_threshold_changes_requeue_item(self):
+        self.item.refresh_from_db()
+        self.item.minimum_stock = 25
+        self.item.save()
+
+        self.assertEqual(ReorderQueue.objects.get(item=self.item).stock, 20)
+
+    def test_entry_queued_by_a_concurrent_posting_is_updated(self):
+        bulk_create = ReorderQueue.objects.bulk_create
+
+        def racing(entries, **kwargs):
+            # Another posting queues the item after this one read the queue
+            ReorderQueue.objects.create(item=self.item, level='minimum', stock=9)
+            return bulk_create(entries, **kwargs)
+
+        with mock.patch.object(ReorderQueue.objects, 'bulk_create', side_effect=racing):
+            self.move(-16)
+
+        entry = ReorderQueue.objects.get(item=self.item)
+        self.assertEqual((entry.level, entry.stock), ('reorder', 4))
+
+    def test_low_stock_api_reads_queue(self):
+        other_item = self.create_item('Other Item', '1000002')
+        other_item.minimum_stock = 3
+        other_item.save()
+        self.sale_point.update_stock(2, other_item)
+        self.move(-16)
+        self.client.force_login(User.objects.create_user('storekeeper'))
+
+        with self.assertNumQueries(3):
+            response = self.client.get('/inventory/api/items/low-stock/')
+
+        self.assertEqual(
+            [(row['name'], row['level'], row['current_stock']) for row in response.json()['items']],
+            [('Test Item', 'reorder', 4), ('Other Item', 'minimum', 2)]
+        )
+
+
+class ForecastTest(InventoryTestCase):
+    def test_smoothing_handles_steady_and_intermittent_series(self):
+        demand = np.zeros((60, 2))
+        demand[:, 0] = 4
+        demand[::10, 1] = 20
+
+        forecast, deviation = smooth(demand, 0.2)
+
+        self.assertAlmostEqual(forecast[0], 4)
+        self.assertAlmostEqual(deviation[0], 0)
+        # Croston: 20 units every 10 days
+        self.assertAlmostEqual(forecast[1], 2)
+
+    def test_forecast_writes_levels(self):
+        from sales.models import Customer, Sale, SaleItem
+
+        customer = Customer.objects.create(name='Walk In', phone='1234567890')
+        self.item.lead_time_days = 5
+        self.item.save()
+        today = timezone.now()
+        for days_ago in range(1, 41):
+            sale = Sale.objects.create(
+                invoice_number=f'INV-{days_ago}',
+                customer=customer,
+                sale_point=self.sale_point,
+                sales_person=self.employee,
+                date=today - timedelta(days=days_ago),
+                payment_method='cash'
+            )
+            SaleItem.objects.create(sale=sale, item=self.item, quantity=3, unit_price=Decimal('15.00'))
+
+        self.assertEqual(forecast_reorder_levels(history_days=40), 1)
+
+        self.item.refresh_from_db()
+        self.assertEqual(self.item.reorder_point, 15)
+        self.assertEqual(self.item.minimum_stock, 15)
+        self.assertEqual(self.item.optimum_stock, 105)
+        self.item.full_clean()
+
+
+class ItemSearchTest(InventoryTestCase):
+    def setUp(self):
+        super().setUp()
+        barcode_cache.clear()
+        self.cola = self.create_item('Coca Cola 500ml', '5449000000996')
+        self.fanta = self.create_item('Fanta Orange 500ml', '5449000011527')
+        self.client.force_login(User.objects.create_user('cashier'))
+
+    def test_prefix_trigrams(self):
+        self.assertEqual(trigrams('Co', complete=False), {'  c', ' co'})
+        self.assertIn('la ', trigrams('Cola'))
+
+    def test_barcode_scan_is_cached(self):
+        self.assertEqual(search_item_ids('5449000000996')[0], self.cola.pk)
+
+        with self.assertNumQueries(0):
+            self.assertEqual(barcode_cache.get('5449000000996')['name'], 'Coca Cola 500ml')
+
+        self.cola.name = 'Coca Cola Zero 500ml'
+        self.cola.save()
+        self.assertEqual(barcode_cache.get('5449000000996')['name'], 'Coca Cola Zero 500ml')
+
+    def test_prefix_and_fuzzy_name_matches(self):
+        self.assertEqual(search_item_ids('fan'), [self.fanta.pk])
+        self.assertEqual(search_item_ids('orang'), [self.fanta.pk])
+        # Transposed letters still share most trigrams
+        self.assertEqual(search_item_ids('coca cloa')[0], self.cola.pk)
+        self.assertEqual(search_item_ids('544900001')[0], self.fanta.pk)
+
+    def test_renamed_item_is_reindexed(self):
+        self.fanta.name = 'Sprite Lemon'
+        self.fanta.save()
+
+        self.assertEqual(search_item_ids('fanta'), [])
+        self.assertEqual(search_item_ids('sprite'), [self.fanta.pk])
+
+    def test_item_is_reindexed_only_when_its_name_or_barcode_change(self):
+        fanta = Item.objects.get(pk=self.fanta.pk)
+        fanta.selling_price = Decimal('18.00')
+        with CaptureQueriesContext(connection) as queries:
+            fanta.save()
+        self.assertFalse(any('itemsearchtrigram' in query['sql'].lower() for query in queries))
+
+        fanta.bar_code = '5449000099999'
+        fanta.save()
+        self.assertEqual(search_item_ids('5449000099999')[0], fanta.pk)
+
+    def test_search_within_given_items(self):
+        self.fanta.status = 'inactive'
+        self.fanta.save()
+
+        self.assertEqual(search_item_ids('fanta'), [])
+        inactive = Item.objects.filter(status='inactive')
+        self.assertEqual(search_item_ids('fanta', items=inactive), [self.fanta.pk])
+        self.assertEqual(search_item_ids('5449000011527', items=inactive), [self.fanta.pk])
+        self.assertEqual(search_item_ids('500ml', items=inactive), [self.fanta.pk])
+
+    def test_unlimited_search_returns_every_match(self):
+        for number in range(12):
+            self.create_item(f'Water 500ml {number}', f'60000000000{number:02d}')
+
+        self.assertEqual(len(search_item_ids('water', limit=10)), 10)
+        self.assertEqual(len(search_item_ids('water', limit=None)), 12)
+
+    def test_typeahead_endpoint(self):
+        response = self.client.get('/inventory/api/items/search/', {'q': 'cola'})
+
+        self.assertEqual([row['id'] for row in response.json()['items']], [self.cola.pk])
+        self.assertEqual(response.json()['items'][0]['selling_price'], '15.00')
+
+
+class KitAvailabilityTest(InventoryTestCase):
+    def setUp(self):
+        super().setUp()
+        kit_cache.clear()
+        self.second_sale_point = SalePoint.objects.create(
+            name='Back Counter',
+            address='Test Address',
+            branch=self.branch,
+            contact_person=self.employee,
+            contact_number='1234567890'
+        )
+        self.glass = self.create_item('Glass')
+        self.kit = ItemKit.objects.create(
+            name='Drink Set', department=self.department, category=self.category, selling_price=60
+        )
+        ItemKitItem.objects.create(item_kit=self.kit, item=self.item, quantity=2)
+        ItemKitItem.objects.create(item_kit=self.kit, item=self.glass, quantity=3)
+        self.sale_point.update_stock(9, self.item)
+        self.sale_point.update_stock(10, self.glass)
+        self.second_sale_point.update_stock(9, self.item)
+
+    def test_buildable_quantity_per_sale_point(self):
+        availability, _ = kit_availability([self.sale_point.pk, self.second_sale_point.pk])
+
+        # min(9 // 2, 10 // 3); no glasses at the back counter
+        self.assertEqual(availability[self.sale_point.pk], {self.kit.pk: 3})
+        self.assertEqual(availability[self.second_sale_point.pk], {})
+
+    def test_component_movement_invalidates_cache(self):
+        self.assertEqual(self.kit.available_quantity(self.sale_point), 3)
+        with self.assertNumQueries(0):
+            self.assertEqual(self.kit.available_quantity(self.sale_point), 3)
+
+        decrement_stock(self.sale_point, items={self.glass.pk: 2})
+        self.assertEqual(self.kit.available_quantity(self.sale_point), 2)
+        decrement_stock(self.sale_point, kits={self.kit.pk: 2})
+        self.assertEqual(self.kit.available_quantity(self.sale_point), 0)
+
+    def test_kit_cost_follows_buying_prices(self):
+        self.assertEqual(self.kit.total_cost(), Decimal('50.00'))
+        with self.assertNumQueries(0):
+            self.kit.total_cost()
+
+        self.glass.buying_price = Decimal('12.00')
+        self.glass.save()
+        self.assertEqual(self.kit.total_cost(), Decimal('56.00'))
+
+    def test_availability_endpoint(self):
+        self.client.force_login(User.objects.create_user('cashier'))
+        response = self.client.get('/inventory/api/kits/availability/', {'sale_point_id': self.sale_point.pk})
+
+        kit = response.json()['kits'][0]
+        self.assertEqual(kit['available'], {str(self.sale_point.pk): 3})
+        self.assertEqual(Decimal(kit['cost']), Decimal('50'))
+
+
+class StockMatrixTest(InventoryTestCase):
+    def setUp(self):
+        super().setUp()
+        self.client.force_login(User.objects.create_user('manager'))
+        self.low = self.create_item('Low Item')
+        Item.objects.filter(pk=self.low.pk).update(minimum_stock=10)
+        self.store.update_stock(7, self.item)
+        self.other_store.update_stock(3, self.item)
+        self.sale_point.update_stock(2, self.item)
+        self.sale_point.update_stock(4, self.low)
+
+    def test_pivot_across_locations(self):
+        locations = matrix_locations()
+        self.assertEqual(
+            [location.name for location in locations], ['Back Store', 'Main Store', 'Front Counter']
+        )
+        matrix = stock_matrix([self.low.pk, self.item.pk], locations)
+        self.assertEqual(matrix.tolist(), [[0, 0, 4], [3, 7, 2]])
+
+    def test_json_is_paged_and_filtered(self):
+        response = self.client.get('/inventory/api/stock-matrix/', {'page_size': 1})
+        data = response.json()
+        self.assertEqual((data['count'], data['num_pages']), (2, 2))
+        self.assertEqual(data['items'][0]['name'], 'Low Item')
+
+        response = self.client.get('/inventory/api/stock-matrix/', {'below_minimum': '1'})
+        self.assertEqual([row['id'] for row in response.json()['items']], [self.low.pk])
+        self.assertEqual(response.json()['items'][0]['total'], 4)
+
+    def test_page_query_count_is_fixed(self):
+        for index in range(20):
+            self.sale_point.update_stock(1, self.create_item(f'Extra {index}'))
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get('/inventory/api/stock-matrix/', {'page_size': 500})
+        # Session, user, locations x 2, count, page, balances
+        self.assertLessEqual(len(queries.captured_queries), 7)
+
+    def test_csv_is_streamed_in_chunks(self):
+        response = self.client.get('/inventory/api/stock-matrix/', {'format': 'csv'})
+        lines = b''.join(response.streaming_content).decode().splitlines()
+
+        self.assertEqual(lines[0], 'Item ID,Item,Barcode,Minimum Stock,Back Store,Main Store,Front Counter,Total')
+        self.assertEqual(lines[2], f'{self.item.pk},Test Item,1000001,0,3,7,2,12')
+        chunked = list(matrix_csv(matrix_items(), matrix_locations(), chunk_size=1))
+        self.assertEqual([line.strip() for line in chunked], lines)
+
+
+class ReplenishmentTest(InventoryTestCase):
+    def setUp(self):
+        super().setUp()
+        self.second_sale_point = SalePoint.objects.create(
+            name='Back Counter',
+            address='Test Address',
+            branch=self.branch,
+            contact_person=self.employee,
+            contact_number='1234567890'
+        )
+        Item.objects.filter(pk=self.item.pk).update(minimum_stock=5, optimum_stock=20)
+        self.sale_point.update_stock(2, self.item)
+        self.second_sale_point.update_stock(10, self.item)
+
+    def test_allocation_merges_cumulative_needs_and_supplies(self):
+        need_index, supply_index, quantities = allocate(
+            np.array([1, 1, 2]), np.array([5, 4, 3]), np.array([1, 1, 2]), np.array([3, 10, 1])
+        )
+        self.assertEqual(
+            list(zip(need_index.tolist(), supply_index.tolist(), quantities.tolist())),
+            [(0, 0, 3), (0, 1, 2), (1, 1, 4), (2, 2, 1)]
+        )
+
+    def test_needs_are_filled_from_stores_fullest_first(self):
+        self.store.update_stock(12, self.item)
+        self.other_store.update_stock(4, self.item)
+        self.second_sale_point.update_stock(-7, self.item)
+
+        lines = sorted(plan_replenishment())
+        # Front counter needs 18 and back counter 17 but only 16 are in store
+        self.assertEqual(sum(line.quantity for line in lines), 16)
+        self.assertEqual(
+            sorted((line.store_id, line.sale_point_id, line.quantity) for line in lines),
+            sorted([
+                (self.store.pk, self.sale_point.pk, 12),
+                (self.other_store.pk, self.sale_point.pk, 4),
+            ])
+        )
+
+    def test_drafts_count_as_delivered_on_the_next_run(self):
+        self.store.update_stock(50, self.item)
+
+        issues = draft_issues(plan_replenishment()).issues
+        self.assertEqual(len(issues), 1)
+        issued = IssuedItem.objects.get(issue=issues[0])
+        self.assertEqual((issued.quantity, issued.unit, issues[0].status), (18, self.base_unit(self.item), 'pending'))
+        self.assertEqual(plan_replenishment(), [])
+
+        issues[0].approve(self.employee)
+        issues[0].complete(self.employee)
+        self.assertEqual(SalePointItem.objects.get(sale_point=self.sale_point, item=self.item).quantity, 20)
+
+    def test_items_without_a_base_unit_are_skipped(self):
+        unitless = self.create_item('Unitless Item')
+        ItemUnit.objects.filter(item=unitless).delete()
+        lines = [
+            ReplenishmentLine(self.store.pk, self.sale_point.pk, self.item.pk, 3),
+            ReplenishmentLine(self.other_store.pk, self.sale_point.pk, unitless.pk, 5),
+        ]
+
+        with mock.patch.object(
+            type(connection.features), 'can_return_rows_from_bulk_insert',
+            new_callable=mock.PropertyMock, return_value=False
+        ):
+            result = draft_issues(lines)
+
+        self.assertEqual(result.skipped, lines[1:])
+        self.assertEqual([issue.store_id for issue in result.issues], [self.store.pk])
+        self.assertEqual(Issue.objects.count(), 1)
+        self.assertEqual(IssuedItem.objects.get(issue=result.issues[0]).quantity, 3)
+
+    def test_command_drafts_issues(self):
+        self.store.update_stock(50, self.item)
+        out = io.StringIO()
+        call_command('plan_replenishment', '--dry-run', stdout=out)
+        self.assertFalse(Issue.objects.exists())
+
+        call_command('plan_replenishment', stdout=out)
+        self.assertEqual(Issue.objects.count(), 1)
+
+
+class ReceivingEditTest(InventoryTestCase):
+    def setUp(self):
+        super().setUp()
+        self.client.force_login(User.objects.create_user('storekeeper'))
+        self.supplier = Supplier.objects.create(
+            name='Test Supplier', address='Test Address', contact_person='Supplier', contact_number='1234567890'
+        )
+        self.receiving = Receiving.objects.create(
+            supplier=self.supplier,
+            department=self.department,
+            user_responsible=self.employee,
+            store=self.store
+        )
+        self.items = [self.item] + [self.create_item(f'Received Item {i}') for i in range(2)]
+        self.lines = [
+            ReceivedItem.objects.create(
+                item=item, receiving=self.receiving, unit=self.base_unit(item),
+                quantity=10, unit_price=10, total_cost=100
+            )
+            for item in self.items
+        ]
+
+    def edit(self, changes):
+        data = {
+            'supplier': self.supplier.pk,
+            'department': self.department.pk,
+            'is_store': 'on',
+            'store': self.store.pk,
+            'receiveditem_set-TOTAL_FORMS': len(self.lines),
+            'receiveditem_set-INITIAL_FORMS': len(self.lines),
+        }
+        for index, line in enumerate(self.lines):
+            values = {
+                'id': line.pk, 'receiving': self.receiving.pk, 'item': line.item_id, 'unit': line.unit_id,
+                'quantity': line.quantity, 'unit_price': line.unit_price, 'total_cost': line.total_cost,
+            }
+            values.update(changes.get(index, {}))
+            data.update({f'receiveditem_set-{index}-{field}': value for field, value in values.items()})
+        return self.client.post(f'/inventory/receivings/{self.receiving.pk}/edit/', data)
+
+    def balance(self, item):
+        return StoreItem.objects.get(store=self.store, item=item)
+
+    def test_price_edit_revalues_without_stock_writes(self):
+        movements = StockMovement.objects.count()
+
+        response = self.edit({1: {'unit_price': 12, 'total_cost': 120}})
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(StockMovement.objects.count(), movements)
+        self.assertEqual(self.balance(self.items[1]).quantity, 10)
+        self.assertEqual(self.balance(self.items[1]).value, Decimal('120'))
+        self.assertEqual(self.balance(self.items[0]).value, Decimal('100'))
+
+    def test_quantity_edit_posts_only_the_difference(self):
+        movements = StockMovement.objects.count()
+
+        self.edit({0: {'quantity': 12, 'total_cost': 120}, 2: {'DELETE': 'on'}})
+        self.assertEqual(
+            sorted(StockMovement.objects.filter(pk__gt=movements).values_list('item_id', 'quantity')),
+            sorted([(self.items[0].pk, 2), (self.items[2].pk, -10)])
+        )
+        self.assertEqual(self.balance(self.items[0]).quantity, 12)
+        self.assertEqual(self.balance(self.items[2]).quantity, 0)
+        self.items[0].refresh_from_db()
+        self.assertEqual(self.items[0].store_stock, 12)
+
+    def test_reducing_sold_stock_is_rejected(self):
+        self.store.update_stock(-8, self.item)
+        old_lines = [line.stock_line() for line in self.lines]
+        new_lines = [old_lines[0]._replace(quantity=5)] + old_lines[1:]
+
+        with self.assertRaises(InsufficientStock):
+            repost_document(old_lines, new_lines, source=self.receiving)
+        self.assertEqual(self.balance(self.item).quantity, 2)
+
+
+class StockLotTest(InventoryTestCase):
+    def setUp(self):
+        super().setUp()
+        self.today = timezone.localdate()
+        self.supplier = Supplier.objects.create(
+            name='Test Supplier', address='Test Address', contact_person='Supplier', contact_number='1234567890'
+        )
+        self.receiving = Receiving.objects.create(
+            supplier=self.supplier,
+            department=self.department,
+            user_responsible=self.employee,
+            store=self.store
+        )
+
+    def receive(self, quantity, lot_number, days):
+        return ReceivedItem.objects.create(
+            item=self.item, receiving=self.receiving, unit=self.base_unit(self.item),
+            quantity=quantity, unit_price=10, total_cost=10 * quantity,
+            lot_number=lot_number, expiry_date=self.today + timedelta(days=days)
+        )
+
+    def lots(self, **location):
+        return list(StockLot.objects.filter(item=self.item, **location).order_by('expiry_date').values_list(
+            'lot_number', 'quantity'
+        ))
+
+    def test_receiving_creates_lots(self):
+        self.receive(10, 'B2', 60)
+        self.receive(5, 'B1', 20)
+        self.receive(3, 'B1', 20)
+
+        self.assertEqual(self.lots(store=self.store), [('B1', 8), ('B2', 10)])
+        self.assertEqual(StockLot.objects.get(lot_number='B2').branch, self.branch)
+
+    def test_decrements_consume_first_expiry_first(self):
+        self.receive(10, 'LATE', 60)
+        self.receive(4, 'EARLY', 20)
+
+        self.store.update_stock(-6, self.item)
+        self.assertEqual(self.lots(store=self.store), [('LATE', 8)])
+
+    def test_issue_carries_lots_to_the_sale_point(self):
+        self.receive(10, 'LATE', 60)
+        self.receive(4, 'EARLY', 20)
+
+        post_document([
+            StockLine(self.item.pk, -6, store_id=self.store.pk),
+            StockLine(self.item.pk, 6, sale_point_id=self.sale_point.pk),
+        ])
+        self.assertEqual(self.lots(store=self.store), [('LATE', 8)])
+        self.assertEqual(self.lots(sale_point=self.sale_point), [('EARLY', 4), ('LATE', 2)])
+        self.assertEqual(
+            StockLot.objects.get(sale_point=self.sale_point, lot_number='EARLY').expiry_date,
+            self.today + timedelta(days=20)
+        )
+
+        self.sale_point.update_stock(-5, self.item)
+        self.assertEqual(self.lots(sale_point=self.sale_point), [('LATE', 1)])
+
+    def test_lot_only_edit_moves_the_lot(self):
+        line = self.receive(10, 'B1', 20)
+        old_line = line.stock_line()
+        line.lot_number, line.expiry_date = 'B2', self.today + timedelta(days=40)
+        line.save(post_stock=False)
+
+        repost_document([old_line], [line.stock_line()], source=self.receiving)
+        self.assertEqual(self.lots(store=self.store), [('B2', 10)])
+        self.assertEqual(StockLot.objects.get(lot_number='B2').expiry_date, self.today + timedelta(days=40))
+        self.assertEqual(StoreItem.objects.get(store=self.store, item=self.item).quantity, 10)
+
+        # A smaller quantity on another lot takes the whole old lot out
+        repost_document([line.stock_line()], [line.stock_line()._replace(quantity=7, lot_number='B3')])
+        self.assertEqual(self.lots(store=self.store), [('B3', 7)])
+
+    def test_expiring_lots_of_a_branch(self):
+        self.receive(10, 'SOON', 5)
+        self.receive(10, 'LATER', 45)
+        self.receive(10, 'GONE', -1)
+
+        self.assertEqual(
+            [lot.lot_number for lot in expiring_lots(self.branch, 30, today=self.today)], ['SOON']
+        )
+        self.client.force_login(User.objects.create_user('storekeeper'))
+        response = self.client.get('/inventory/api/lots/expiring/', {'branch_id': self.branch.pk, 'days': 60})
+        self.assertEqual([lot['lot_number'] for lot in response.json()['lots']], ['SOON', 'LATER'])
+        self.assertEqual(response.json()['lots'][0]['location_name'], self.store.name)
+        response = self.client.get('/inventory/api/lots/expiring/', {'branch_id': 'main'})
+        self.assertEqual(response.status_code, 400)
+
+
+class IdempotencyTest(InventoryTestCase):
+    def setUp(self):
+        super().setUp()
+        self.client.force_login(User.objects.create_user('storekeeper'))
+        self.store.update_stock(10, self.item)
+        self.issue = Issue.objects.create(
+            store=self.store, sale_point=self.sale_point, requested_by=self.employee, status='approved'
+        )
+        IssuedItem.objects.create(item=self.item, issue=self.issue, unit=self.base_unit(self.item), quantity=4)
+
+    def complete(self, issue, key):
+        return self.client.post(f'/inventory/issues/{issue.pk}/complete/', HTTP_IDEMPOTENCY_KEY=key)
+
+    def test_retried_completion_replays_the_response(self):
+        first = self.complete(self.issue, 'issue-1')
+        movements = StockMovement.objects.count()
+        retry = self.complete(self.issue, 'issue-1')
+
+        self.assertEqual(retry.status_code, first.status_code)
+        self.assertEqual(retry['Location'], first['Location'])
+        self.assertEqual(retry['Idempotent-Replayed'], 'true')
+        self.assertEqual(StockMovement.objects.count(), movements)
+        self.assertEqual(StoreItem.objects.get(store=self.store, item=self.item).quantity, 6)
+
+    def test_failed_completion_is_not_replayed(self):
+        IssuedItem.objects.create(item=self.item, issue=self.issue, unit=self.base_unit(self.item), quantity=20)
+
+        response = self.complete(self.issue, 'issue-1')
+        self.assertEqual(response.status_code, 302)
+        self.assertFalse(IdempotencyKey.objects.exists())
+        self.assertEqual(Issue.objects.get(pk=self.issue.pk).status, 'approved')
+
+        # Once the store has the stock, the retry runs the view again
+        self.store.update_stock(20, self.item)
+        retry = self.complete(self.issue, 'issue-1')
+        self.assertNotIn('Idempotent-Replayed', retry)
+        self.assertEqual(Issue.objects.get(pk=self.issue.pk).status, 'completed')
+        self.assertEqual(StoreItem.objects.get(store=self.store, item=self.item).quantity, 6)
+
+    def test_database_errors_propagate_without_storing_the_key(self):
+        with mock.patch('inventory.stock.post_document', side_effect=OperationalError(1213, 'Deadlock found')):
+            with self.assertRaises(OperationalError):
+                self.complete(self.issue, 'issue-1')
+        self.assertFalse(IdempotencyKey.objects.exists())
+
+    def test_completion_needs_a_post(self):
+        response = self.client.get(f'/inventory/issues/{self.issue.pk}/complete/')
+        self.assertEqual(response.status_code, 405)
+        self.assertEqual(Issue.objects.get(pk=self.issue.pk).status, 'approved')
+
+    def test_key_reused_for_another_issue_is_rejected(self):
+        other = Issue.objects.create(
+            store=self.store, sale_point=self.sale_point, requested_by=self.employee, status='approved'
+        )
+        self.complete(self.issue, 'issue-1')
+        self.assertEqual(self.complete(other, 'issue-1').status_code, 422)
+
+    def test_expired_keys_are_purged(self):
+        other = Issue.objects.create(
+            store=self.store, sale_point=self.sale_point, requested_by=self.employee, status='approved'
+        )
+        self.complete(self.issue, 'issue-1')
+        self.complete(other, 'issue-2')
+        IdempotencyKey.objects.filter(key='issue-1').update(expires_at=timezone.now() - timedelta(seconds=1))
+        out = io.StringIO()
+
+        call_command('purge_idempotency_keys', '--batch-size', '1', stdout=out)
+
+        self.assertIn('Purged 1 expired', out.getvalue())
+        self.assertEqual(list(IdempotencyKey.objects.values_list('key', flat=True)), ['issue-2'])
+
+
+class UnitConversionTest(InventoryTestCase):
+    def setUp(self):
+        super().setUp()
+        unit_cache.clear()
+        self.items = [self.item] + [self.create_item(f'Unit Item {i}') for i in range(9)]
+        self.boxes = {
+            item.pk: ItemUnit.objects.create(
+                item=item, unit='box', smallest_units=12, buying_price=120, selling_price=170
+            )
+            for item in self.items
+        }
+        self.issue = Issue.objects.create(
+            store=self.store, sale_point=self.sale_point, requested_by=self.employee
+        )
+
+    def formset_data(self, lines):
+        data = {'issueditem_set-TOTAL_FORMS': len(lines), 'issueditem_set-INITIAL_FORMS': 0}
+        for index, (item, unit) in enumerate(lines):
+            data.update({
+                f'issueditem_set-{index}-item': item.pk,
+                f'issueditem_set-{index}-unit': unit.pk,
+                f'issueditem_set-{index}-quantity': 2,
+            })
+        return data
+
+    def test_formset_loads_units_once_for_all_lines(self):
+        formset = IssueItemFormSet(
+            self.formset_data([(item, self.boxes[item.pk]) for item in self.items]), instance=self.issue
+        )
+        with CaptureQueriesContext(connection) as queries:
+            self.assertTrue(formset.is_valid())
+        unit_queries = [q for q in queries.captured_queries if 'inventory_itemunit' in q['sql']]
+        self.assertEqual(len(unit_queries), 1)
+        self.assertEqual(formset.forms[3].cleaned_data['unit'].smallest_units, 12)
+
+    def test_unit_of_another_item_is_rejected(self):
+        formset = IssueItemFormSet(
+            self.formset_data([(self.items[0], self.boxes[self.items[1].pk])]), instance=self.issue
+        )
+        self.assertFalse(formset.is_valid())
+        self.assertIn('unit', formset.forms[0].errors)
+
+    def test_unit_changes_reach_the_cache(self):
+        self.assertEqual([u['unit'] for u in unit_cache.units([self.item.pk])[self.item.pk]], ['piece', 'box'])
+        ItemUnit.objects.create(item=self.item, unit='crate', smallest_units=48, buying_price=480)
+        self.assertEqual(
+            [u['unit'] for u in unit_cache.units([self.item.pk])[self.item.pk]], ['piece', 'box', 'crate']
+        )
+
+    def test_unit_changes_reach_other_processes(self):
+        # Another worker using the same cache backend
+        other = UnitCache('units')
+        self.assertEqual(len(other.units([self.item.pk])[self.item.pk]), 2)
+
+        ItemUnit.objects.create(item=self.item, unit='crate', smallest_units=48, buying_price=480)
+        with self.assertNumQueries(1):
+            self.assertEqual(len(other.units([self.item.pk])[self.item.pk]), 3)
+
+    def test_load_racing_a_change_is_not_cached(self):
+        def load_then_change(item_ids):
+            units = load_units(item_ids)
+            self.boxes[self.item.pk].delete()
+            return units
+
+        with mock.patch('inventory.units.load_units', side_effect=load_then_change):
+            stale = unit_cache.units([self.item.pk])[self.item.pk]
+        self.assertEqual(len(stale), 2)
+        self.assertEqual(len(unit_cache.units([self.item.pk])[self.item.pk]), 1)
+
+    def test_issue_lines_convert_in_one_query(self):
+        for item in self.items:
+            IssuedItem.objects.create(item=item, issue=self.issue, unit=self.boxes[item.pk], quantity=2)
+        with CaptureQueriesContext(connection) as queries:
+            lines = self.issue.stock_lines()
+        self.assertEqual(len(queries.captured_queries), 1)
+        self.assertEqual({line.quantity for line in lines}, {-24, 24})
+
+    def test_units_endpoint(self):
+        self.client.force_login(User.objects.create_user('storekeeper'))
+        units = self.client.get(f'/inventory/api/items/{self.item.pk}/units/').json()['units']
+        self.assertEqual([(u['unit'], u['smallest_units'], u['is_base']) for u in units],
+                         [('piece', 1, True), ('box', 12, False)])
+        self.assertEqual(self.client.get('/inventory/api/items/999999/units/').status_code, 404)
+
+
+class CycleCountTest(InventoryTestCase):
+    def setUp(self):
+        super().setUp()
+        self.items = [self.item] + [self.create_item(f'Counted Item {i}', f'200000{i}') for i in range(3)]
+        for item in self.items:
+            self.store.update_stock(10, item)
+
+    def test_expected_quantities_are_frozen_at_open(self):
+        session = open_session(self.employee, store=self.store)
+        self.store.update_stock(-4, self.item)
+
+        self.assertEqual(session.lines.get(item=self.item).expected, 10)
+        self.assertEqual(session.lines.count(), 4)
+
+    def test_counts_from_devices_add_up(self):
+        session = open_session(self.employee, store=self.store)
+        other = self.create_item('Found Item')
+
+        record_counts(session, {self.item.pk: 6, other.pk: 2})
+        record_counts(session, {self.item.pk: 3})
+        self.assertEqual(session.lines.get(item=self.item).counted, 9)
+        self.assertEqual(session.lines.get(item=other).expected, 0)
+
+        record_counts(session, {self.item.pk: 7}, replace=True)
+        self.assertEqual(session.lines.get(item=self.item).counted, 7)
+
+    def test_variances_post_on_top_of_current_stock(self):
+        session = open_session(self.employee, store=self.store)
+        record_counts(session, {self.items[0].pk: 8, self.items[1].pk: 10, self.items[2].pk: 13})
+        # Sold while counting
+        self.store.update_stock(-1, self.items[0])
+
+        self.assertEqual(post_session(session, self.employee), 2)
+        self.assertEqual(
+            dict(StoreItem.objects.filter(store=self.store).values_list('item_id', 'quantity')),
+            {self.items[0].pk: 7, self.items[1].pk: 10, self.items[2].pk: 13, self.items[3].pk: 10}
+        )
+        self.assertEqual(
+            sorted(session.adjustments.values_list('item_id', 'quantity')),
+            [(self.items[0].pk, -2), (self.items[2].pk, 3)]
+        )
+        self.assertEqual(
+            StockMovement.objects.filter(source_type='countsession', source_id=session.pk).count(), 2
+        )
+        self.assertIsNone(post_session(session, self.employee))
+        with self.assertRaises(ValidationError):
+            record_counts(session, {self.item.pk: 1})
+
+    def test_posting_query_count_does_not_grow_with_lines(self):
+        items = [self.create_item(f'Bulk Item {i}') for i in range(30)]
+        for item in items:
+            self.store.update_stock(5, item)
+        self.other_store.update_stock(5, self.item)
+        self.other_store.update_stock(5, items[0])
+        small = open_session(self.employee, store=self.other_store)
+        record_counts(small, {self.item.pk: 4, items[0].pk: 6})
+        large = open_session(self.employee, store=self.store)
+        record_counts(large, {item_id: 4 for item_id in large.lines.values_list('item_id', flat=True)})
+        record_counts(large, {self.item.pk: 14}, replace=True)
+
+        with CaptureQueriesContext(connection) as small_queries:
+            post_session(small, self.employee)
+        with CaptureQueriesContext(connection) as large_queries:
+            post_session(large, self.employee)
+        self.assertEqual(len(small_queries.captured_queries), len(large_queries.captured_queries))
+
+    def test_counts_endpoint_takes_barcodes(self):
+        user = User.objects.create_user('counter')
+        self.employee.user = user
+        self.employee.save()
+        self.client.force_login(user)
+        session = open_session(self.employee, store=self.store)
+
+        response = self.client.post(
+            f'/inventory/api/counts/{session.pk}/counts/',
+            json.dumps({'counts': [
+                {'bar_code': '2000000', 'quantity': 1}, {'bar_code': '2000000', 'quantity': 1},
+                {'item_id': self.item.pk, 'quantity': 4}, {'bar_code': 'missing', 'quantity': 1},
+            ]}),
+            content_type='application/json'
+        )
+        self.assertEqual(response.json(), {'updated': 2, 'unknown': ['missing']})
+        self.assertEqual(session.lines.get(item=self.items[1]).counted, 2)
+
+        response = self.client.post(
+            f'/inventory/api/counts/{session.pk}/counts/',
+            json.dumps({'counts': [{'item_id': self.item.pk, 'quantity': 1}, {'item_id': 999999, 'quantity': 1}]}),
+            content_type='application/json'
+        )
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json(), {'error': 'Unknown items: 999999'})
+        self.assertEqual(session.lines.get(item=self.item).counted, 4)
+
+    def test_adjustment_edit_and_delete_post_differences(self):
+        adjustment = Adjustment.objects.create(
+            item=self.item, quantity=-3, reason='Damaged', user_responsible=self.employee, store=self.store
+        )
+        adjustment.quantity = -5
+        adjustment.save()
+        self.assertEqual(StoreItem.objects.get(store=self.store, item=self.item).quantity, 5)
+
+        adjustment.delete()
+        self.assertEqual(StoreItem.objects.get(store=self.store, item=self.item).quantity, 10)
+        self.item.refresh_from_db()
+        self.assertEqual(self.item.store_stock, 10)
+
+
+class ItemImportTest(InventoryTestCase):
+    header = 'name,bar_code,department,category,buying_price,selling_price,smallest_unit,minimum_stock,optimum_stock\n'
+
+    def catalog(self, rows):
+        return io.BytesIO((self.header + ''.join(rows)).encode())
+
+    def valid_rows(self, count, start=0):
+        return [
+            f'Imported {n},IMP{n:05d},Test Department,Test Category,10,12.5,piece,2,5\n'
+            for n in range(start, start + count)
+        ]
+
+    def test_rows_are_validated_and_reported(self):
+        rows = self.valid_rows(2) + [
+            'Duplicate,1000001,Test Department,Test Category,10,12,piece,0,0\n',
+            'Repeated,IMP00001,Test Department,Test Category,10,12,piece,0,0\n',
+            'No Category,,Test Department,Unknown,10,12,piece,0,0\n',
+            'Cheap,,Test Department,Test Category,10,8,piece,0,0\n',
+            ',,,,,,,,\n',
+            'Category Id,,Test Department,%d,abc,12,piece,0,0\n' % self.category.pk,
+            'Half,,Test Department,Test Category,10,12,piece,2.5,5\n',
+            'Spreadsheet,,Test Department,Test Category,10,12,piece,2.0,5\n',
+        ]
+
+        result = ItemImporter().run(read_csv(self.catalog(rows)))
+
+        self.assertEqual(result.created, 3)
+        self.assertEqual([error.row for error in result.errors], [4, 5, 6, 7, 9, 10])
+        self.assertEqual(result.errors[-1], RowError(10, 'minimum_stock "2.5" is not a whole number'))
+        self.assertEqual(Item.objects.get(name='Spreadsheet').minimum_stock, 2)
+        self.assertEqual(result.errors[0], RowError(4, 'An item with barcode "1000001" already exists'))
+        item = Item.objects.get(bar_code='IMP00001')
+        self.assertEqual((item.selling_price, item.minimum_stock), (Decimal('12.50'), 2))
+        self.assertEqual(self.base_unit(item).unit, 'piece')
+        self.assertEqual(search_item_ids('IMP00001')[0], item.pk)
+
+    def test_items_and_units_are_bulk_inserted(self):
+        with CaptureQueriesContext(connection) as queries:
+            ItemImporter(chunk_size=20).run(read_csv(self.catalog(self.valid_rows(45))))
+
+        def inserts(model):
+            table = connection.ops.quote_name(model._meta.db_table)
+            return [query for query in queries.captured_queries if query['sql'].startswith(f'INSERT INTO {table}')]
+
+        # Three chunks of rows, one insert of items and one of units each
+        self.assertEqual(len(inserts(Item)), 3)
+        self.assertEqual(len(inserts(ItemUnit)), 3)
+        self.assertEqual(ItemUnit.objects.filter(item__bar_code__startswith='IMP').count(), 45)
+
+    def test_failed_import_leaves_nothing_behind(self):
+        # The bad bytes come after the first chunks are written
+        data = self.catalog(self.valid_rows(300)).getvalue() + b'\xff\xfe\n'
+
+        with self.assertRaises(ValueError):
+            ItemImporter(chunk_size=20).run(read_csv(io.BytesIO(data)))
+
+        self.assertFalse(Item.objects.filter(bar_code__startswith='IMP').exists())
+
+    def test_pks_are_matched_when_database_does_not_return_them(self):
+        rows = self.valid_rows(2) + ['Imported 0,,Test Department,Test Category,1,2,piece,0,0\n']
+
+        with mock.patch.object(
+            type(connection.features), 'can_return_rows_from_bulk_insert',
+            new_callable=mock.PropertyMock, return_value=False
+        ):
+            result = ItemImporter().run(read_csv(self.catalog(rows)))
+
+        self.assertEqual(result.created, 3)
+        self.assertEqual(ItemUnit.objects.filter(item__name='Imported 0').count(), 2)
+        self.assertEqual(Item.objects.filter(name='Imported 0', bar_code=None).count(), 1)
+
+    def test_pks_are_not_taken_from_rows_inserted_alongside(self):
+        rows = ['Imported 0,,Test Department,Test Category,1,2,piece,0,0\n']
+        bulk_create = Item.objects.bulk_create
+
+        def insert_alongside(items):
+            # Another import adds an item of the same name between our reads
+            self.create_item('Imported 0')
+            return bulk_create(items)
+
+        with mock.patch.object(
+            type(connection.features), 'can_return_rows_from_bulk_insert',
+            new_callable=mock.PropertyMock, return_value=False
+        ), mock.patch.object(Item.objects, 'bulk_create', side_effect=insert_alongside):
+            ItemImporter().run(read_csv(self.catalog(rows)))
+
+        imported = Item.objects.get(name='Imported 0', buying_price=Decimal('1.00'))
+        self.assertIsNone(imported.bar_code)
+        self.assertEqual(
+            list(ItemUnit.objects.filter(item__name='Imported 0').values_list('item_id', flat=True).order_by('item_id')),
+            sorted(Item.objects.filter(name='Imported 0').values_list('pk', flat=True))
+        )
+
+    def test_command_imports_file(self):
+        with tempfile.NamedTemporaryFile('wb', suffix='.csv', delete=False) as file:
+            file.write(self.catalog(self.valid_rows(3)).getvalue())
+        self.addCleanup(os.remove, file.name)
+        out = io.StringIO()
+
+        call_command('import_items', file.name, stdout=out, stderr=io.StringIO())
+
+        self.assertIn('Imported 3 items, skipped 0 rows', out.getvalue())
+
+
+class ConcurrentCompletionTest(InventoryFixtures, TransactionTestCase):
+    """Completes transfers and issues that move the same rows in opposite directions at once."""
+
+    workers = 8
+
+    def setUp(self):
+        super().setUp()
+        self.other_item = self.create_item('Other Item', '1000002')
+        for store in (self.store, self.other_store):
+            store.update_stock(100, self.item)
+            store.update_stock(100, self.other_item)
+
+    def create_transfer(self, from_store, to_store, items):
+        transfer = Transfer.objects.create(
+            transfer_type='store_to_store',
+            from_store=from_store,
+            to_store=to_store,
+            user_responsible=self.employee
+        )
+        for item in items:
+            TransferItem.objects.create(transfer=transfer, item=item, unit=self.base_unit(item), quantity=1)
+        return transfer
+
+    def create_issue(self, store):
+        issue = Issue.objects.create(
+            store=store,
+            sale_point=self.sale_point,
+            requested_by=self.employee,
+            status='approved'
+        )
+        for item in (self.other_item, self.item):
+            IssuedItem.objects.create(item=item, issue=issue, unit=self.base_unit(item), quantity=1)
+        return issue
+
+    def run_concurrently(self, calls):
+        def run(call):
+            try:
+                call()
+            finally:
+                connections.close_all()
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            list(executor.map(run, calls))
+
+    def test_opposite_documents_complete_without_losing_stock(self):
+        documents = []
+        for index in range(self.workers * 2):
+            # Alternate directions and line order so naive locking would deadlock
+            items = (self.item, self.other_item) if index % 2 else (self.other_item, self.item)
+            stores = (self.store, self.other_store) if index % 2 else (self.other_store, self.store)
+            documents.append(self.create_transfer(*stores, items))
+        issues = [self.create_issue(store) for store in (self.store, self.other_store) * 2]
+
+        calls = [transfer.complete_transfer for transfer in documents]
+        calls += [lambda issue=issue: issue.complete(self.employee) for issue in issues]
+        # Each document is also completed twice to check it only posts once
+        self.run_concurrently(calls + calls[:self.workers])
+
+        self.assertFalse(Transfer.objects.filter(completed=False).exists())
+        self.assertFalse(Issue.objects.exclude(status='completed').exists())
+        for item in (self.item, self.other_item):
+            self.assertEqual(StoreItem.objects.filter(item=item).aggregate(total=Sum('quantity'))['total'], 196)
+            self.assertEqual(SalePointItem.objects.get(sale_point=self.sale_point, item=item).quantity, 4)
+            item.refresh_from_db()
+            self.assertEqual((item.store_stock, item.shop_stock), (196, 4))
+        for store_item in StoreItem.objects.all():
+            ledger = StockMovement.objects.filter(
+                store=store_item.store, item=store_item.item
+            ).aggregate(total=Sum('quantity'))['total']
+            self.assertEqual(store_item.quantity, ledger)
+
+
+class ConcurrentLotTest(InventoryFixtures, TransactionTestCase):
+    """Takes stock out of the same lot from several postings at once."""
+
+    workers = 4
+
+    def setUp(self):
+        super().setUp()
+        post_document([
+            StockLine(self.item.pk, 5, store_id=self.store.pk, lot_number='L1', expiry_date=date(2030, 1, 1)),
+            StockLine(self.item.pk, 20, store_id=self.store.pk),
+        ])
+
+    def test_postings_do_not_take_the_same_lot_twice(self):
+        @retry_on_deadlock
+        @transaction.atomic
+        def sell():
+            post_document([StockLine(self.item.pk, -2, store_id=self.store.pk)])
+
+        def run(call):
+            try:
+                call()
+            finally:
+                connections.close_all()
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            list(executor.map(run, [sell] * self.workers))
+
+        self.assertFalse(StockLot.objects.filter(quantity__gt=0).exists())
+        self.assertEqual(StoreItem.objects.get(store=self.store, item=self.item).quantity, 17)
@@ -0,0 +1,45 @@
+"""
+Unit Conversions
+
+This module serves the units of each item and how many smallest units each
+one holds.
+
+The units of any number of items load with one query, so a document or a
+formset resolves all of its lines at once rather than one unit lookup per
+line. The per-item lists are kept in the shared cache (see
+inventory.caching) for forms and the JSON unit endpoints. A change to an
+item's units drops its entry, and a load that started before the change
+is not stored, so a slow read cannot put back units that were just
+changed. Stock postings read conversions from their own documents' rows
+and never from the cache.
+"""
+
+from .caching import SharedCache
+from .models import ItemUnit
+
+
+def load_units(item_ids):
+    """Returns {item id: [unit dict]} for the items, smallest unit first, with one query."""
+    units = {item_id: [] for item_id in item_ids}
+    if not units:
+        return units
+    for unit in ItemUnit.objects.filter(item_id__in=units).order_by('smallest_units', 'pk').values(
+        'id', 'item_id', 'unit', 'smallest_units', 'buying_price', 'selling_price',
+        'item__name', 'item__smallest_unit',
+    ):
+        unit['label'] = (
+            f"{unit['unit']} - {unit['smallest_units']} {unit.pop('item__smallest_unit')} of {unit.pop('item__name')}"
+        )
+        units[unit['item_id']].append(unit)
+    return units
+
+
+class UnitCache(SharedCache):
+    """Cache of the units of each item."""
+
+    def units(self, item_ids):
+        """Returns {item id: [unit dict]} for the items, loading the missing ones together."""
+        return self.get_many(item_ids, load_units)
+
+
+unit_cache = UnitCache('units')
@@ -13,6 +13,7 @@ urlpatterns = [
     path('stores/<int:pk>/', views.store_detail, name='store_detail'),
     path('stores/<int:pk>/edit/', views.store_edit, name='store_edit'),
     path('stores/<int:pk>/delete/', views.StoreDeleteView.as_view(), name='store_delete'),
+    path('stores/stock-matrix/', views.stock_matrix, name='stock_matrix'),
     
     # Sale Point URLs
     path('sale-points/', views.SalePointListView.as_view(), name='sale_point_list'),
@@ -31,6 +32,7 @@ urlpatterns = [
     # Item URLs
     path('items/', views.item_list, name='item_list'),
     path('items/create/', views.item_create, name='item_create'),
+    path('items/import/', views.item_import, name='item_import'),
     path('items/<int:pk>/', views.item_detail, name='item_detail'),
     path('items/<int:pk>/edit/', views.item_edit, name='item_edit'),
     path('items/<int:pk>/delete/', views.ItemDeleteView.as_view(), name='item_delete'),
@@ -55,6 +57,12 @@ urlpatterns = [
     path('adjustments/<int:pk>/edit/', views.AdjustmentUpdateView.as_view(), name='adjustment_edit'),
     path('adjustments/<int:pk>/delete/', views.AdjustmentDeleteView.as_view(), name='adjustment_delete'),
     
+    # Count Session URLs
+    path('counts/create/', views.count_session_create, name='count_session_create'),
+    path('counts/<int:pk>/', views.count_session_detail, name='count_session_detail'),
+    path('counts/<int:pk>/post/', views.count_session_post, name='count_session_post'),
+    path('counts/<int:pk>/cancel/', views.count_session_cancel, name='count_session_cancel'),
+    
     # Requisition URLs
     path('requisitions/', views.RequisitionListView.as_view(), name='requisition_list'),
     path('requisitions/create/', views.requisition_create, name='requisition_create'),
@@ -75,9 +83,16 @@ urlpatterns = [
     path('issues/<int:pk>/', views.IssueDetailView.as_view(), name='issue_detail'),
     path('issues/<int:pk>/edit/', views.IssueUpdateView.as_view(), name='issue_edit'),
     path('issues/<int:pk>/delete/', views.IssueDeleteView.as_view(), name='issue_delete'),
+    path('issues/<int:pk>/complete/', views.complete_issue, name='issue_complete'),
     
     # API Endpoints
     path('api/items/<int:item_id>/stock/', views.get_item_stock, name='api_item_stock'),
     path('api/items/low-stock/', views.get_low_stock_items, name='api_low_stock_items'),
+    path('api/items/search/', views.item_search, name='api_item_search'),
     path('api/items/<int:item_id>/units/', views.get_item_units, name='api_item_units'),
+    path('api/items/details/', views.get_item_details, name='get-item-details'),
+    path('api/kits/availability/', views.kit_availability, name='api_kit_availability'),
+    path('api/lots/expiring/', views.expiring_lots_api, name='api_expiring_lots'),
+    path('api/stock-matrix/', views.stock_matrix_api, name='api_stock_matrix'),
+    path('api/counts/<int:pk>/counts/', views.count_session_counts, name='api_count_session_counts'),
 ]
\ No newline at end of file
@@ -1,17 +1,31 @@
 # views.py
+import json
+from collections import defaultdict
+
 from django.shortcuts import render, get_object_or_404, redirect
 from django.views.generic import ListView, CreateView, UpdateView, DeleteView, View, DetailView
-from django.http import JsonResponse
+from django.http import JsonResponse, StreamingHttpResponse
 from django.urls import reverse_lazy
 from django.db import transaction
 from django.contrib import messages
 from django.utils import timezone
 from django.contrib.auth.decorators import login_required
+from django.core.exceptions import ValidationError
 from django.core.paginator import Paginator
+from django.views.decorators.http import require_POST
 from django.db.models import Sum, F, Q
 
 from .models import *
 from .forms import *
+from .counting import cancel_session, open_session, post_session, record_counts
+from .importers import ItemImporter, read_rows
+from .idempotency import idempotent, new_key, not_stored
+from .kits import kit_cache
+from .lots import expiring_lots
+from .matrix import matrix_csv, matrix_items, matrix_locations, matrix_rows
+from .search import search_item_ids, search_items
+from .stock import InsufficientStock, repost_document
+from .units import unit_cache
 from company.models import Branch, Department, Category
 
 
@@ -99,20 +113,66 @@ def store_detail(request, pk):
     }
     return render(request, 'inventory/store_detail.html', context)
 
+# Items per page of the stock matrix, and the most a client may ask for
+STOCK_MATRIX_PAGE_SIZE = 100
+STOCK_MATRIX_MAX_PAGE_SIZE = 500
+
+def stock_matrix_filters(request):
+    """Item filters of the stock matrix taken from the query string."""
+    return {
+        'department': request.GET.get('department') or None,
+        'category': request.GET.get('category') or None,
+        'below_minimum': request.GET.get('below_minimum') in ('1', 'true', 'on'),
+    }
+
+def stock_matrix_page(request):
+    """Returns the locations and the requested page of (id, name, bar code, minimum stock) items."""
+    try:
+        page_size = min(int(request.GET.get('page_size', STOCK_MATRIX_PAGE_SIZE)), STOCK_MATRIX_MAX_PAGE_SIZE)
+    except ValueError:
+        page_size = STOCK_MATRIX_PAGE_SIZE
+    paginator = Paginator(matrix_items(**stock_matrix_filters(request)), max(page_size, 1))
+    return matrix_locations(), paginator.get_page(request.GET.get('page'))
+
+@login_required
+def stock_matrix(request):
+    """View for stock of every item across all stores and sale points."""
+    locations, page = stock_matrix_page(request)
+    context = {
+        'locations': locations,
+        'page': page,
+        'rows': matrix_rows(page.object_list, locations),
+        'departments': Department.objects.all(),
+        'categories': Category.objects.all(),
+        'filters': stock_matrix_filters(request),
+    }
+    return render(request, 'inventory/stock_matrix.html', context)
+
+@login_required
+def stock_matrix_api(request):
+    """API endpoint for the stock matrix as paginated JSON, or as a CSV file with format=csv."""
+    if request.GET.get('format') == 'csv':
+        response = StreamingHttpResponse(
+            matrix_csv(matrix_items(**stock_matrix_filters(request)), matrix_locations()),
+            content_type='text/csv'
+        )
+        response['Content-Disposition'] = 'attachment; filename="stock_matrix.csv"'
+        return response
+
+    locations, page = stock_matrix_page(request)
+    return JsonResponse({
+        'locations': [location._asdict() for location in locations],
+        'items': matrix_rows(page.object_list, locations),
+        'page': page.number,
+        'num_pages': page.paginator.num_pages,
+        'count': page.paginator.count,
+    })
+
 @login_required
 def item_list(request):
     """View for listing all items with search and filter functionality."""
     items = Item.objects.all()
     
-    # Search functionality
-    search_query = request.GET.get('search', '')
-    if search_query:
-        items = items.filter(
-            Q(name__icontains=search_query) |
-            Q(bar_code__icontains=search_query) |
-            Q(category__name__icontains=search_query)
-        )
-    
     # Filter by status
     status = request.GET.get('status', '')
     if status:
@@ -135,6 +195,14 @@ def item_list(request):
     elif stock_level == 'out':
         items = items.filter(store_stock=0)
     
+    # Search within the filtered items, so every match that passes the filters is listed
+    search_query = request.GET.get('search', '')
+    if search_query:
+        items = items.filter(
+            Q(pk__in=search_item_ids(search_query, limit=None, items=items)) |
+            Q(category__category_name__icontains=search_query)
+        )
+    
     # Pagination
     paginator = Paginator(items, 10)
     page_number = request.GET.get('page')
@@ -161,6 +229,34 @@ def item_create(request):
     
     return render(request, 'inventory/item_form.html', {'form': form, 'action': 'Create'})
 
+# Most row errors shown after an upload
+ITEM_IMPORT_ERROR_LIMIT = 200
+
+@login_required
+def item_import(request):
+    """View for importing items from a CSV or XLSX catalog."""
+    result = None
+    if request.method == 'POST':
+        form = ItemImportForm(request.POST, request.FILES)
+        if form.is_valid():
+            upload = form.cleaned_data['file']
+            try:
+                result = ItemImporter().run(read_rows(upload.file, upload.name))
+            except (ImportError, ValueError) as e:
+                form.add_error('file', str(e))
+            else:
+                messages.success(
+                    request, f'Imported {result.created} items, skipped {len(result.errors)} rows.'
+                )
+    else:
+        form = ItemImportForm()
+
+    return render(request, 'inventory/item_import.html', {
+        'form': form,
+        'result': result,
+        'errors': result.errors[:ITEM_IMPORT_ERROR_LIMIT] if result else [],
+    })
+
 @login_required
 def item_edit(request, pk):
     """View for editing an existing item."""
@@ -213,19 +309,12 @@ def adjustment_create(request):
         if form.is_valid():
             with transaction.atomic():
                 adjustment = form.save(commit=False)
-                adjustment.user_responsible = request.user
+                adjustment.user_responsible = request.user.employee
+                # Saving posts the adjustment to its location and the item totals
                 adjustment.save()
                 
-                # Update stock
-                item = adjustment.item
-                if adjustment.quantity > 0:
-                    item.store_stock += adjustment.quantity
-                else:
-                    item.store_stock += adjustment.quantity
-                item.save()
-                
                 messages.success(request, 'Inventory adjustment created successfully.')
-                return redirect('item_detail', pk=item.pk)
+                return redirect('item_detail', pk=adjustment.item_id)
     else:
         form = AdjustmentForm()
     
@@ -311,18 +400,101 @@ def get_item_stock(request, item_id):
         return JsonResponse({'error': 'Item not found'}, status=404)
 
 @login_required
-def get_low_stock_items(request):
-    """API endpoint for getting items that need reordering."""
-    items = Item.objects.filter(store_stock__lte=F('minimum_stock'))
+def item_search(request):
+    """API endpoint for item typeahead and barcode scans on POS screens."""
+    try:
+        limit = min(int(request.GET.get('limit', 10)), 50)
+    except ValueError:
+        limit = 10
+    items = search_items(request.GET.get('q', ''), limit=max(limit, 1))
     data = [{
         'id': item.id,
         'name': item.name,
-        'current_stock': item.store_stock,
-        'minimum_stock': item.minimum_stock,
-        'optimum_stock': item.optimum_stock,
+        'bar_code': item.bar_code,
+        'selling_price': str(item.selling_price),
+        'store_stock': item.store_stock,
+        'shop_stock': item.shop_stock,
     } for item in items]
     return JsonResponse({'items': data})
 
+@login_required
+def kit_availability(request):
+    """API endpoint for the kits each sale point can make from its stock."""
+    sale_points = SalePoint.objects.filter(status='active')
+    if request.GET.get('sale_point_id'):
+        sale_points = sale_points.filter(pk=request.GET['sale_point_id'])
+    sale_point_ids = list(sale_points.values_list('pk', flat=True))
+    availability = kit_cache.availability(sale_point_ids)
+    costs = kit_cache.costs()
+    kits = ItemKit.objects.values('id', 'name', 'selling_price')
+    data = [{
+        'id': kit['id'],
+        'name': kit['name'],
+        'selling_price': kit['selling_price'],
+        'cost': str(costs.get(kit['id'], 0)),
+        'available': {
+            str(sale_point_id): availability[sale_point_id].get(kit['id'], 0)
+            for sale_point_id in sale_point_ids
+        },
+    } for kit in kits]
+    return JsonResponse({'kits': data})
+
+EXPIRING_LOTS_DAYS = 30
+
+@login_required
+def expiring_lots_api(request):
+    """API endpoint for the lots of a branch expiring within ?days=, soonest first."""
+    try:
+        days = int(request.GET.get('days', EXPIRING_LOTS_DAYS))
+    except ValueError:
+        return JsonResponse({'error': 'days must be a number'}, status=400)
+    if days < 0:
+        return JsonResponse({'error': 'days must not be negative'}, status=400)
+    try:
+        branch_id = int(request.GET.get('branch_id') or 0)
+    except ValueError:
+        return JsonResponse({'error': 'branch_id must be a number'}, status=400)
+    branch = get_object_or_404(Branch, pk=branch_id)
+
+    lots = expiring_lots(branch, days).values(
+        'id', 'item_id', 'item__name', 'store_id', 'store__name', 'sale_point_id', 'sale_point__name',
+        'lot_number', 'expiry_date', 'quantity',
+    )
+    data = [{
+        'id': lot['id'],
+        'item_id': lot['item_id'],
+        'item_name': lot['item__name'],
+        'location_type': 'store' if lot['store_id'] else 'sale_point',
+        'location_id': lot['store_id'] or lot['sale_point_id'],
+        'location_name': lot['store__name'] or lot['sale_point__name'],
+        'lot_number': lot['lot_number'],
+        'expiry_date': lot['expiry_date'].isoformat(),
+        'quantity': lot['quantity'],
+    } for lot in lots]
+    return JsonResponse({'lots': data})
+
+@login_required
+def get_low_stock_items(request):
+    """API endpoint for getting items that need reordering."""
+    # Items at their reorder point first, then those with the longest lead time
+    entries = ReorderQueue.objects.select_related('item').order_by(
+        '-level', '-item__lead_time_days', 'queued_at'
+    )
+    data = [{
+        'id': entry.item.id,
+        'name': entry.item.name,
+        'current_stock': entry.item.total_stock(),
+        'store_stock': entry.item.store_stock,
+        'shop_stock': entry.item.shop_stock,
+        'minimum_stock': entry.item.minimum_stock,
+        'reorder_point': entry.item.reorder_point,
+        'optimum_stock': entry.item.optimum_stock,
+        'lead_time_days': entry.item.lead_time_days,
+        'level': entry.level,
+        'queued_at': entry.queued_at,
+    } for entry in entries]
+    return JsonResponse({'items': data})
+
 class StoreDeleteView(DeleteView):
     model = Store
     template_name = 'store_confirm_delete.html'
@@ -563,6 +735,16 @@ class RequisitionApproveView(UpdateView):
         messages.success(self.request, 'Requisition approval status updated.')
         return super().form_valid(form)
 
+def unit_data(units):
+    return [{
+        'id': unit['id'],
+        'unit': unit['unit'],
+        'smallest_units': unit['smallest_units'],
+        'buying_price': unit['buying_price'],
+        'selling_price': unit['selling_price'],
+        'is_base': unit['smallest_units'] == 1,
+    } for unit in units]
+
 @login_required
 def get_item_details(request):
     item_id = request.GET.get('item_id')
@@ -571,36 +753,21 @@ def get_item_details(request):
         data = {
             'id': item.id,
             'name': item.name,
-            'description': item.description,
-            'unit': item.unit.name if item.unit else '',
+            'unit': item.smallest_unit,
             'buying_price': float(item.buying_price),
             'selling_price': float(item.selling_price),
             'store_stock': item.store_stock,
+            'units': unit_data(unit_cache.units([item.pk])[item.pk]),
         }
         return JsonResponse(data)
     return JsonResponse({'error': 'No item ID provided'}, status=400)
 
 @login_required
 def get_item_units(request, item_id):
-    item = get_object_or_404(Item, pk=item_id)
-    units = []
-    if item.unit:
-        units.append({
-            'id': item.unit.id,
-            'name': item.unit.name,
-            'symbol': item.unit.symbol,
-            'is_base': True
-        })
-        # Add any additional units if they exist
-        additional_units = item.additional_units.all()
-        for unit in additional_units:
-            units.append({
-                'id': unit.id,
-                'name': unit.name,
-                'symbol': unit.symbol,
-                'is_base': False
-            })
-    return JsonResponse({'units': units})
+    units = unit_cache.units([item_id])[item_id]
+    if not units and not Item.objects.filter(pk=item_id).exists():
+        return JsonResponse({'error': 'Item not found'}, status=404)
+    return JsonResponse({'units': unit_data(units)})
 
 def get_unit_price(request):
     unit_id = request.GET.get('unit_id')
@@ -633,45 +800,42 @@ class ReceivingUpdateView(UpdateView):
     def form_valid(self, form):
         context = self.get_context_data()
         items_formset = context['items_formset']
-        
-        with transaction.atomic():
-            # Store the original received items before making changes
-            original_receiving = self.get_object()
-            original_items = list(original_receiving.receiveditem_set.all())
-            
-            # First, reverse the stock changes from the original items
-            for original_item in original_items:
-                qty = -1 * original_item.quantity * original_item.unit.smallest_units
-                if original_receiving.is_store:
-                    if original_receiving.store:
-                        original_receiving.store.update_stock(qty, original_item.item)
-                else:
-                    if original_receiving.sale_point:
-                        original_receiving.sale_point.update_stock(qty, original_item.item)
-            
-            # Now save the form and formset with new values
-            if items_formset.is_valid():
+
+        if not items_formset.is_valid():
+            return self.form_invalid(form)
+
+        original_receiving = self.get_object()
+        original_lines = [
+            original_item.stock_line()
+            for original_item in original_receiving.receiveditem_set.select_related('unit', 'receiving')
+        ]
+        try:
+            with transaction.atomic():
+                # Only changed and deleted lines are saved again, without posting one at a time
                 self.object = form.save()
                 items_formset.instance = self.object
-                items_formset.save()
-                
-                # The ReceivedItem.save() method will automatically update the stock
-                # with the new quantities through its update_stock method
-                
-                messages.success(self.request, "Receiving Edited Successfully!")
-                return super().form_valid(form)
-            else:
-                # Restore the original stock changes if formset is invalid
-                for original_item in original_items:
-                    qty = original_item.quantity * original_item.unit.smallest_units
-                    if original_receiving.is_store:
-                        if original_receiving.store:
-                            original_receiving.store.update_stock(qty, original_item.item)
-                    else:
-                        if original_receiving.sale_point:
-                            original_receiving.sale_point.update_stock(qty, original_item.item)
-                
-                return self.form_invalid(form)    
+                received_items = items_formset.save(commit=False)
+                for received_item in items_formset.deleted_objects:
+                    received_item.delete()
+                for received_item in received_items:
+                    received_item.save(post_stock=False)
+
+                # Post the net change per item, nothing for lines left as they were
+                repost_document(
+                    original_lines,
+                    [
+                        received_item.stock_line()
+                        for received_item in self.object.receiveditem_set.select_related('unit', 'receiving')
+                    ],
+                    source=self.object,
+                )
+        except InsufficientStock as e:
+            form.add_error(None, e)
+            return self.form_invalid(form)
+
+        messages.success(self.request, "Receiving Edited Successfully!")
+        return super().form_valid(form)
+
 class ReceivingListView(ListView):
     model = Receiving
     context_object_name = "receivings"
@@ -918,11 +1082,21 @@ class IssueListView(ListView):
     context_object_name = 'issues'
     ordering = ['-date']
 
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context['idempotency_key'] = new_key()
+        return context
+
 class IssueDetailView(DetailView):
     model = Issue
     template_name = 'inventory/issue_detail.html'
     context_object_name = 'issue'
 
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context['idempotency_key'] = new_key()
+        return context
+
 class IssueDeleteView(DeleteView):
     model = Issue
     template_name = 'inventory/gen_confirm_delete.html'
@@ -989,25 +1163,30 @@ class IssueApproveView(UpdateView):
         return super().form_valid(form)
 
 
+@login_required
+@require_POST
+@idempotent('complete_issue')
 def complete_issue(request, pk):
     issue = get_object_or_404(Issue, pk=pk)
     
     if issue.status != 'approved':
         messages.error(request, "Only approved issue requests can be completed.")
-        return redirect('inventory:issue_detail', pk=issue.pk)
+        return not_stored(redirect('inventory:issue_detail', pk=issue.pk))
     
     if issue.completed_date:
         messages.error(request, "This issue request has already been completed.")
-        return redirect('inventory:issue_detail', pk=issue.pk)
+        return not_stored(redirect('inventory:issue_detail', pk=issue.pk))
     
     try:
         # Assuming the current user is an employee
         #employee = request.user.employee  # You might need to adjust this based on your user model
         employee = Employee.objects.first()
         issue.complete(employee)
-        messages.success(request, "Issue request completed successfully.")
-    except Exception as e:
-        messages.error(request, f"Error completing issue request: {str(e)}")
+    # Anything else, deadlocks included, propagates so it is retried or fails without storing the key
+    except ValidationError as e:
+        messages.error(request, f"Error completing issue request: {'; '.join(e.messages)}")
+        return not_stored(redirect('inventory:issue_detail', pk=issue.pk))
+    messages.success(request, "Issue request completed successfully.")
     
     return redirect('inventory:issue_detail', pk=issue.pk)
 
@@ -1051,7 +1230,7 @@ class AdjustmentUpdateView(UpdateView):
     def form_valid(self, form):
         with transaction.atomic():
             adjustment = form.save(commit=False)
-            adjustment.user_responsible = self.request.user
+            adjustment.user_responsible = self.request.user.employee
             adjustment.save()
             messages.success(self.request, 'Inventory adjustment updated successfully.')
             return super().form_valid(form)
@@ -1066,12 +1245,104 @@ class AdjustmentDeleteView(DeleteView):
     template_name = 'inventory/gen_confirm_delete.html'
     success_url = reverse_lazy('inventory:adjustment_list')
 
-    def delete(self, request, *args, **kwargs):
-        adjustment = self.get_object()
-        with transaction.atomic():
-            # Reverse the adjustment effect on stock
-            item = adjustment.item
-            item.store_stock -= adjustment.quantity
-            item.save()
-            messages.success(request, 'Inventory adjustment deleted successfully.')
-            return super().delete(request, *args, **kwargs)        
\ No newline at end of file
+    def form_valid(self, form):
+        # Adjustment.delete() reverses the stock it posted
+        messages.success(self.request, 'Inventory adjustment deleted successfully.')
+        return super().form_valid(form)
+
+
+@login_required
+def count_session_create(request):
+    """View for opening a cycle count of a store or sale point."""
+    if request.method == 'POST':
+        form = CountSessionForm(request.POST)
+        if form.is_valid():
+            session = open_session(
+                request.user.employee,
+                store=form.cleaned_data['store'],
+                sale_point=form.cleaned_data['sale_point'],
+                notes=form.cleaned_data['notes'],
+            )
+            messages.success(request, f'Count session opened with {session.lines.count()} expected items.')
+            return redirect('inventory:count_session_detail', pk=session.pk)
+    else:
+        form = CountSessionForm()
+    return render(request, 'inventory/gen_form.html', {'form': form, 'model_name': 'Count Session'})
+
+@login_required
+def count_session_detail(request, pk):
+    """View for the counted lines and variances of a count session."""
+    session = get_object_or_404(CountSession.objects.select_related('store', 'sale_point'), pk=pk)
+    lines = session.lines.filter(counted__isnull=False).select_related('item').order_by('item__name')
+    paginator = Paginator(lines, 50)
+    context = {
+        'session': session,
+        'lines': paginator.get_page(request.GET.get('page')),
+        'expected_count': session.lines.count(),
+    }
+    return render(request, 'inventory/count_session_detail.html', context)
+
+@login_required
+def count_session_post(request, pk):
+    """Posts the variances of a count session as adjustments."""
+    session = get_object_or_404(CountSession, pk=pk)
+    if request.method == 'POST':
+        try:
+            posted = post_session(session, request.user.employee)
+        except InsufficientStock as e:
+            messages.error(request, f'Count could not be posted: {"; ".join(e.messages)}')
+        else:
+            if posted is None:
+                messages.error(request, 'Only open count sessions can be posted.')
+            else:
+                messages.success(request, f'Count posted with {posted} adjustments.')
+    return redirect('inventory:count_session_detail', pk=session.pk)
+
+@login_required
+def count_session_cancel(request, pk):
+    """Cancels an open count session without posting it."""
+    session = get_object_or_404(CountSession, pk=pk)
+    if request.method == 'POST':
+        if cancel_session(session):
+            messages.success(request, 'Count session cancelled.')
+        else:
+            messages.error(request, 'Only open count sessions can be cancelled.')
+    return redirect('inventory:count_session_detail', pk=session.pk)
+
+# Most counted lines one device may send in a single request
+COUNT_BATCH_LIMIT = 5000
+
+@login_required
+@require_POST
+def count_session_counts(request, pk):
+    """API endpoint for devices sending counts to an open count session.
+
+    Takes {"counts": [{"item_id": 1, "quantity": 3}, {"bar_code": "...", "quantity": 1}],
+    "replace": false}. Quantities are added to earlier counts unless replace is true.
+    """
+    session = get_object_or_404(CountSession, pk=pk)
+    try:
+        payload = json.loads(request.body)
+        counts = payload['counts']
+        if len(counts) > COUNT_BATCH_LIMIT:
+            return JsonResponse({'error': f'At most {COUNT_BATCH_LIMIT} counts per request'}, status=400)
+        bar_codes = {str(count['bar_code']) for count in counts if count.get('bar_code')}
+        item_ids = dict(Item.objects.filter(bar_code__in=bar_codes).values_list('bar_code', 'pk'))
+        totals = defaultdict(int)
+        unknown = []
+        for count in counts:
+            item_id = int(count['item_id']) if count.get('item_id') else item_ids.get(str(count.get('bar_code')))
+            if item_id is None:
+                unknown.append(count.get('bar_code'))
+                continue
+            totals[item_id] += int(count['quantity'])
+    except (ValueError, KeyError, TypeError):
+        return JsonResponse({'error': 'Expected {"counts": [{"item_id" or "bar_code", "quantity"}]}'}, status=400)
+
+    try:
+        updated = record_counts(session, totals, replace=bool(payload.get('replace')))
+    except ValidationError as e:
+        status = 400 if getattr(e, 'code', None) == 'unknown_item' else 409
+        return JsonResponse({'error': '; '.join(e.messages)}, status=status)
+    return JsonResponse({'updated': updated, 'unknown': unknown})
+
@@ -6,7 +6,8 @@ from django.utils import timezone
 from .models import ReportType, ReportSchedule, ReportHistory
 from .forms import ReportScheduleForm
 from company.models import Company, Department, Employee
-from inventory.models import Item, StoreItem, SalePointItem
+from inventory.models import Item, StoreItem, SalePointItem, Store, SalePoint
+from inventory.stock import day_end, stock_as_of
 from assets.models import Asset
 from sales.models import Sale, SaleItem
 import os
@@ -52,7 +53,8 @@ def generate_report(request, report_type_id):
         if report_type.name == 'Sales Report':
             data = generate_sales_report(start_date, end_date)
         elif report_type.name == 'Inventory Report':
-            data = generate_inventory_report()
+            # An end date turns the report into the stock as closed on that day
+            data = generate_inventory_report(end_date.date() if end_date else None)
         elif report_type.name == 'Assets Report':
             data = generate_assets_report()
         elif report_type.name == 'Company Report':
@@ -248,7 +250,11 @@ def generate_issues_report(start_date=None, end_date=None):
     
     return df
 
-def generate_inventory_report():
+def generate_inventory_report(as_of=None):
+    """Builds the inventory report, either for current stock or as closed on the as_of date."""
+    if as_of is not None:
+        return generate_inventory_report_as_of(as_of)
+
     items = Item.objects.all().select_related('category')
     store_items = StoreItem.objects.all().select_related('item', 'store')
     sale_point_items = SalePointItem.objects.all().select_related('item', 'sale_point')
@@ -258,7 +264,7 @@ def generate_inventory_report():
         item_data.append({
             'Item ID': item.id,
             'Name': item.name,
-            'Category': item.category.name,
+            'Category': item.category.category_name,
             'Description': item.notes,
             'Buying Price': float(item.buying_price),
             'Selling Price': float(item.selling_price),
@@ -292,6 +298,58 @@ def generate_inventory_report():
         'sale_point_stock': pd.DataFrame(sale_point_stock_data)
     }
 
+def generate_inventory_report_as_of(as_of):
+    """Builds the inventory report from the closing stock of the as_of date."""
+    closing = stock_as_of(day_end(as_of))
+    items = {item.id: item for item in Item.objects.all().select_related('category')}
+    stores = dict(Store.objects.values_list('id', 'name'))
+    sale_points = dict(SalePoint.objects.values_list('id', 'name'))
+
+    store_totals = {}
+    shop_totals = {}
+    store_stock_data = []
+    sale_point_stock_data = []
+    for (location_type, location_id, item_id), quantity in sorted(closing.items()):
+        if location_type == 'store':
+            store_totals[item_id] = store_totals.get(item_id, 0) + quantity
+            store_stock_data.append({
+                'Item': items[item_id].name,
+                'Store': stores[location_id],
+                'Quantity': quantity,
+                'As Of': as_of
+            })
+        else:
+            shop_totals[item_id] = shop_totals.get(item_id, 0) + quantity
+            sale_point_stock_data.append({
+                'Item': items[item_id].name,
+                'Sale Point': sale_points[location_id],
+                'Quantity': quantity,
+                'As Of': as_of
+            })
+
+    item_data = []
+    for item in items.values():
+        store_stock = store_totals.get(item.id, 0)
+        shop_stock = shop_totals.get(item.id, 0)
+        item_data.append({
+            'Item ID': item.id,
+            'Name': item.name,
+            'Category': item.category.category_name,
+            'Description': item.notes,
+            'Buying Price': float(item.buying_price),
+            'Selling Price': float(item.selling_price),
+            'Store Stock': store_stock,
+            'Shop Stock': shop_stock,
+            'Total Stock': store_stock + shop_stock,
+            'Status': item.status
+        })
+
+    return {
+        'items': pd.DataFrame(item_data),
+        'store_stock': pd.DataFrame(store_stock_data),
+        'sale_point_stock': pd.DataFrame(sale_point_stock_data)
+    }
+
 def generate_sales_report(start_date=None, end_date=None):
     sales = Sale.objects.all().select_related('customer')
     
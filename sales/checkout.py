@@ -0,0 +1,189 @@
+"""
+POS Checkout
+
+This module records a whole basket as one Sale in a single transaction.
+
+The sale, its item and kit lines and its payments are written with bulk
+inserts, so no model save methods or signals run for them. Totals and the
+payment status are worked out in Python from the basket before the sale is
+inserted, the stock of every line is taken out of the sale point in one
+conditional posting, the daily stats of the sales person are moved by the
+sale's amount and every credit payment gets its customer ledger entry.
+The number of queries is the same however many lines the basket has.
+"""
+
+from collections import defaultdict, namedtuple
+from decimal import Decimal, InvalidOperation
+
+from django.core.exceptions import ValidationError
+from django.db import connection, transaction
+
+from inventory.models import Item, ItemKit
+from inventory.stock import decrement_stock, source_fields
+from .models import CustomerLedgerEntry, Payment, Sale, SaleItem, SaleKit
+from .ledger import record_entries
+from .recalc import CENT, TAX_RATE, payment_status
+from .stats import apply_deltas, sale_share, share_deltas
+
+BasketLine = namedtuple('BasketLine', ['id', 'quantity', 'unit_price'])
+BasketPayment = namedtuple('BasketPayment', ['amount', 'payment_method', 'reference_number'])
+
+
+def parse_amount(value, name):
+    try:
+        amount = Decimal(str(value)).quantize(CENT)
+    except (InvalidOperation, TypeError, ValueError):
+        raise ValidationError(f"{name} must be a number")
+    if amount < 0:
+        raise ValidationError(f"{name} cannot be negative")
+    return amount
+
+
+def parse_lines(lines, id_field):
+    """Returns BasketLines for a list of {id_field, quantity, unit_price} dicts."""
+    parsed = []
+    for line in lines or []:
+        try:
+            line_id = int(line[id_field])
+            quantity = int(line['quantity'])
+        except (KeyError, TypeError, ValueError):
+            raise ValidationError(f"Every line needs a whole {id_field} and quantity")
+        if quantity <= 0:
+            raise ValidationError("Quantities must be positive")
+        unit_price = line.get('unit_price')
+        parsed.append(BasketLine(
+            line_id, quantity, None if unit_price is None else parse_amount(unit_price, 'unit_price')
+        ))
+    return parsed
+
+
+def parse_payments(payments):
+    methods = dict(Sale.PAYMENT_METHOD_CHOICES)
+    parsed = []
+    for payment in payments or []:
+        method = payment.get('payment_method')
+        if method not in methods:
+            raise ValidationError(f"Unknown payment method: {method}")
+        parsed.append(BasketPayment(
+            parse_amount(payment.get('amount'), 'amount'), method, payment.get('reference_number') or None
+        ))
+    return parsed
+
+
+def priced_lines(lines, prices, kind):
+    """Fills in missing unit prices and returns (lines, subtotal)."""
+    missing = sorted({line.id for line in lines} - set(prices))
+    if missing:
+        raise ValidationError(f"Unknown or unsellable {kind}: {', '.join(map(str, missing))}")
+    priced = [
+        line._replace(unit_price=line.unit_price if line.unit_price is not None else prices[line.id])
+        for line in lines
+    ]
+    return priced, sum((line.quantity * line.unit_price for line in priced), Decimal(0))
+
+
+@transaction.atomic
+def checkout(sale_point, customer, sales_person, invoice_number, items=None, kits=None, payments=None,
+             payment_method=None, notes=None):
+    """Records a basket as one Sale and returns it.
+
+    items and kits are lists of BasketLines, whose unit prices default to
+    the current selling prices, and payments a list of BasketPayments.
+    Raises ValidationError for a bad basket and InsufficientStock when the
+    sale point cannot cover it, in which case nothing is written.
+    """
+    items, kits, payments = items or [], kits or [], payments or []
+    if not items and not kits:
+        raise ValidationError("The basket is empty")
+
+    item_prices = {}
+    if items:
+        item_prices = {
+            pk: Decimal(str(price))
+            for pk, price in Item.objects.filter(
+                pk__in={line.id for line in items}, is_sellable=True, status='active'
+            ).values_list('pk', 'selling_price')
+        }
+    kit_prices = {}
+    if kits:
+        kit_prices = {
+            pk: Decimal(str(price))
+            for pk, price in ItemKit.objects.filter(
+                pk__in={line.id for line in kits}, status='Active'
+            ).values_list('pk', 'selling_price')
+        }
+    items, items_total = priced_lines(items, item_prices, 'items')
+    kits, kits_total = priced_lines(kits, kit_prices, 'kits')
+
+    # The same arithmetic as recalc.recalculate_sales, done once
+    subtotal = items_total + kits_total
+    tax_amount = (subtotal * TAX_RATE).quantize(CENT)
+    discount_amount = Decimal('0.00')
+    total_amount = subtotal + tax_amount - discount_amount
+    total_paid = sum((payment.amount for payment in payments), Decimal(0))
+    if total_paid > total_amount:
+        raise ValidationError(f"Payments of {total_paid} exceed the sale total of {total_amount}")
+
+    sale = Sale(
+        invoice_number=invoice_number,
+        customer=customer,
+        sale_point=sale_point,
+        sales_person=sales_person,
+        subtotal=subtotal,
+        tax_amount=tax_amount,
+        discount_amount=discount_amount,
+        total_amount=total_amount,
+        payment_status=payment_status(total_amount, total_paid),
+        payment_method=payment_method or (payments[0].payment_method if payments else 'cash'),
+        notes=notes,
+    )
+    Sale.objects.bulk_create([sale])
+    if not connection.features.can_return_rows_from_bulk_insert:
+        sale.pk = Sale.objects.values_list('pk', flat=True).get(invoice_number=invoice_number)
+
+    item_quantities = defaultdict(int)
+    for line in items:
+        item_quantities[line.id] += line.quantity
+    kit_quantities = defaultdict(int)
+    for line in kits:
+        kit_quantities[line.id] += line.quantity
+    decrement_stock(sale_point, items=item_quantities, kits=kit_quantities, source=sale)
+
+    if items:
+        SaleItem.objects.bulk_create([
+            SaleItem(
+                sale=sale, item_id=line.id, quantity=line.quantity, unit_price=line.unit_price,
+                total_price=line.quantity * line.unit_price,
+            )
+            for line in items
+        ])
+    if kits:
+        SaleKit.objects.bulk_create([
+            SaleKit(
+                sale=sale, kit_id=line.id, quantity=line.quantity, unit_price=line.unit_price,
+                total_price=line.quantity * line.unit_price,
+            )
+            for line in kits
+        ])
+    if payments:
+        created = Payment.objects.bulk_create([
+            Payment(
+                sale=sale, amount=payment.amount, payment_method=payment.payment_method,
+                reference_number=payment.reference_number,
+            )
+            for payment in payments
+        ])
+        if not connection.features.can_return_rows_from_bulk_insert:
+            # The rows of one multi-row insert get increasing ids in order
+            pks = Payment.objects.filter(sale=sale).order_by('pk').values_list('pk', flat=True)
+            for payment, pk in zip(created, pks):
+                payment.pk = pk
+        # Credit payments lower the customer's balance, as the Payment signals do, with one entry each
+        record_entries([
+            CustomerLedgerEntry(customer_id=customer.pk, amount=-payment.amount, **source_fields(payment))
+            for payment in created
+            if payment.payment_method == 'credit'
+        ])
+
+    apply_deltas(share_deltas([(None, sale_share(sales_person.pk, sale.date, total_amount, sale.payment_status))]))
+    return sale
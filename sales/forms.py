@@ -6,6 +6,7 @@ This module defines the forms for managing sales in the ERP system.
 
 from django import forms
 from django.core.exceptions import ValidationError
+from django.db.models import Sum
 from django.utils import timezone
 from .models import (
     Customer, Sale, SaleItem, SaleKit, Payment, Return,
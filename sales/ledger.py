@@ -0,0 +1,157 @@
+"""
+Customer Ledger
+
+This module keeps Customer.balance as the running total of an append-only
+CustomerLedgerEntry ledger.
+
+Every change to a balance is recorded as an entry and added to the balance
+with an F() update in the same transaction, so payments and returns of the
+same customer landing at the same time all count instead of overwriting
+each other. Entries of several customers are written with one insert and
+one UPDATE.
+
+checkpoint_balances() stores the closing balance of every customer for a
+day. balances_as_of() starts from the latest checkpoint and adds only the
+entries recorded after it, so statements and aging reads cost the time
+since the last checkpoint rather than the length of the history.
+"""
+
+from collections import defaultdict
+from datetime import timedelta
+from decimal import Decimal
+
+from django.db import transaction
+from django.db.models import Case, DecimalField, F, Max, Sum, Value, When
+from django.utils import timezone
+
+from inventory.stock import day_end, source_fields
+from .models import Customer, CustomerBalanceCheckpoint, CustomerLedgerEntry
+
+AGING_DAYS = (30, 60, 90)
+
+
+@transaction.atomic
+def record_entries(entries):
+    """Appends CustomerLedgerEntries and adds them to their customers' balances.
+
+    Zero entries are dropped. Returns the entries written.
+    """
+    entries = [entry for entry in entries if entry.amount]
+    if not entries:
+        return entries
+    CustomerLedgerEntry.objects.bulk_create(entries)
+
+    totals = defaultdict(Decimal)
+    for entry in entries:
+        totals[entry.customer_id] += entry.amount
+    Customer.objects.filter(pk__in=totals).update(balance=F('balance') + Case(
+        *[When(pk=customer_id, then=Value(total)) for customer_id, total in totals.items()],
+        default=Value(Decimal(0)),
+        output_field=DecimalField(max_digits=10, decimal_places=2),
+    ))
+    return entries
+
+
+def record_entry(customer_id, amount, source=None):
+    """Records one change to a customer's balance, caused by source if given."""
+    return record_entries([
+        CustomerLedgerEntry(customer_id=customer_id, amount=amount, **source_fields(source))
+    ])
+
+
+def record_change(before, after, source=None):
+    """Records the difference between two (customer id, amount) shares of source.
+
+    Either share may be None. A share moved to another customer is taken
+    off the first and added to the second.
+    """
+    deltas = defaultdict(Decimal)
+    if before is not None:
+        deltas[before[0]] -= before[1]
+    if after is not None:
+        deltas[after[0]] += after[1]
+    return record_entries([
+        CustomerLedgerEntry(customer_id=customer_id, amount=amount, **source_fields(source))
+        for customer_id, amount in sorted(deltas.items())
+    ])
+
+
+def credit_share(customer_id, amount, payment_method):
+    """Returns the (customer id, amount) a payment moves its customer's balance by, or None."""
+    if payment_method != 'credit' or not amount:
+        return None
+    return customer_id, -Decimal(amount)
+
+
+def balances_as_of(moment, customers=None):
+    """Returns the customer balances just before moment.
+
+    Reads the latest checkpoint closed by then and adds the entries recorded
+    after it. The result maps customer ids to balances and leaves out zero
+    balances.
+    """
+    checkpoints = CustomerBalanceCheckpoint.objects.all()
+    entries = CustomerLedgerEntry.objects.filter(created_at__lt=moment)
+    if customers is not None:
+        checkpoints = checkpoints.filter(customer__in=customers)
+        entries = entries.filter(customer__in=customers)
+
+    # Checkpoints hold every non-zero balance of their day, so the latest day
+    # is looked up across all rows and a missing row means zero.
+    base_date = CustomerBalanceCheckpoint.objects.filter(
+        date__lt=timezone.localdate(moment)
+    ).aggregate(latest=Max('date'))['latest']
+
+    balances = defaultdict(Decimal)
+    if base_date is not None:
+        balances.update(checkpoints.filter(date=base_date).values_list('customer_id', 'balance'))
+        entries = entries.filter(created_at__gte=day_end(base_date))
+
+    for customer_id, total in entries.values('customer_id').annotate(total=Sum('amount')).order_by().values_list(
+        'customer_id', 'total'
+    ):
+        balances[customer_id] += total
+    return {customer_id: balance for customer_id, balance in balances.items() if balance}
+
+
+def statement(customer, start, end):
+    """Returns (opening balance, entries, closing balance) of a customer from start to end."""
+    opening = balances_as_of(start, [customer]).get(customer.pk, Decimal(0))
+    entries = list(
+        customer.ledger_entries.filter(created_at__gte=start, created_at__lt=end).order_by('created_at', 'pk')
+    )
+    return opening, entries, opening + sum((entry.amount for entry in entries), Decimal(0))
+
+
+def balance_aging(moment=None, customers=None, days=AGING_DAYS):
+    """Returns {customer id: [balance now, balance days[0] ago, ...]} for an aging report.
+
+    Each column is one balances_as_of() read, so the report costs the same
+    however long the customers' histories are.
+    """
+    moment = moment or timezone.now()
+    columns = [balances_as_of(moment - timedelta(days=age), customers) for age in (0, *days)]
+    customer_ids = sorted(set().union(*columns))
+    return {
+        customer_id: [column.get(customer_id, Decimal(0)) for column in columns]
+        for customer_id in customer_ids
+    }
+
+
+@transaction.atomic
+def checkpoint_balances(day):
+    """Stores the closing balance of every customer for day.
+
+    Checkpointing a day again replaces it. Returns the number of
+    checkpoint rows written.
+    """
+    closing = balances_as_of(day_end(day))
+    CustomerBalanceCheckpoint.objects.filter(date=day).delete()
+    CustomerBalanceCheckpoint.objects.bulk_create(
+        [
+            CustomerBalanceCheckpoint(date=day, customer_id=customer_id, balance=balance)
+            for customer_id, balance in sorted(closing.items())
+        ],
+        batch_size=1000,
+    )
+    return len(closing)
@@ -0,0 +1,16 @@
+from datetime import timedelta
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from sales.sequences import audit_gaps
+
+
+class Command(BaseCommand):
+    help = 'Records the invoice and return numbers that were reserved but never used'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--hours', type=int, default=24,
+                            help='Only audit blocks reserved at least this many hours ago')
+
+    def handle(self, *args, **options):
+        gaps = audit_gaps(before=timezone.now() - timedelta(hours=options['hours']))
+        self.stdout.write(self.style.SUCCESS(f'Recorded {gaps} sequence gaps'))
@@ -0,0 +1,55 @@
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, timedelta
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.db.models import Min
+from django.utils import timezone
+from sales.models import Return, Sale, SalesPersonDailyStats
+from sales.stats import rebuild_rollups, refresh_salespeople, stat_day
+
+
+class Command(BaseCommand):
+    help = 'Rebuilds the daily sales person stats from the sales and returns, in parallel date ranges'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--start', type=date.fromisoformat,
+                            help='First day to rebuild (YYYY-MM-DD), by default the day of the first sale')
+        parser.add_argument('--end', type=date.fromisoformat,
+                            help='Last day to rebuild (YYYY-MM-DD), by default today')
+        parser.add_argument('--days', type=int, default=31, help='Days rebuilt per chunk')
+        parser.add_argument('--workers', type=int, default=4, help='Chunks rebuilt at the same time')
+
+    def handle(self, *args, **options):
+        start, end = options['start'], options['end'] or timezone.localdate()
+        full = start is None and options['end'] is None
+        if start is None:
+            first = [
+                value for value in (
+                    Sale.objects.aggregate(first=Min('date'))['first'],
+                    Return.objects.aggregate(first=Min('date'))['first'],
+                ) if value is not None
+            ]
+            start = stat_day(min(first)) if first else end
+        if full:
+            # Rollups outside the history are left over from deleted documents
+            SalesPersonDailyStats.objects.exclude(date__range=(start, end)).delete()
+
+        chunks = []
+        while start <= end:
+            chunks.append((start, min(start + timedelta(days=options['days'] - 1), end)))
+            start = chunks[-1][1] + timedelta(days=1)
+
+        if options['workers'] > 1:
+            with ThreadPoolExecutor(max_workers=options['workers']) as executor:
+                written = sum(executor.map(self.rebuild_chunk, chunks))
+        else:
+            written = sum(rebuild_rollups(*chunk) for chunk in chunks)
+        refresh_salespeople()
+        self.stdout.write(self.style.SUCCESS(f'Rebuilt {written} daily stats in {len(chunks)} chunks'))
+
+    def rebuild_chunk(self, chunk):
+        # Every worker thread opens its own connection, closed when the chunk is done
+        try:
+            return rebuild_rollups(*chunk)
+        finally:
+            connection.close()
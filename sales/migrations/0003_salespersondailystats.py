@@ -0,0 +1,57 @@
+# Generated by Django 5.2 on 2026-10-18 19:40
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        (
+            "company",
+            "0007_employee_first_name_employee_last_name_employee_user_and_more",
+        ),
+        ("sales", "0002_documentsequence_sequenceblock_sequencegap"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="SalesPersonDailyStats",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("date", models.DateField()),
+                (
+                    "sales_total",
+                    models.DecimalField(decimal_places=2, default=0, max_digits=10),
+                ),
+                (
+                    "returns_total",
+                    models.DecimalField(decimal_places=2, default=0, max_digits=10),
+                ),
+                (
+                    "employee",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="daily_sales_stats",
+                        to="company.employee",
+                    ),
+                ),
+            ],
+            options={
+                "verbose_name_plural": "Sales Person Daily Stats",
+                "constraints": [
+                    models.UniqueConstraint(
+                        fields=("employee", "date"), name="unique_salesperson_day"
+                    )
+                ],
+            },
+        ),
+    ]
@@ -0,0 +1,104 @@
+# Generated by Django 5.2 on 2026-10-18 20:15
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("sales", "0003_salespersondailystats"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="CustomerBalanceCheckpoint",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("date", models.DateField()),
+                ("balance", models.DecimalField(decimal_places=2, max_digits=10)),
+                (
+                    "customer",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="balance_checkpoints",
+                        to="sales.customer",
+                    ),
+                ),
+            ],
+            options={
+                "verbose_name": "Customer Balance Checkpoint",
+                "verbose_name_plural": "Customer Balance Checkpoints",
+                "indexes": [
+                    models.Index(
+                        fields=["date", "customer"], name="sales_custo_date_e5a203_idx"
+                    )
+                ],
+            },
+        ),
+        migrations.CreateModel(
+            name="CustomerLedgerEntry",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("amount", models.DecimalField(decimal_places=2, max_digits=10)),
+                (
+                    "source_type",
+                    models.CharField(
+                        choices=[
+                            ("opening", "Opening Balance"),
+                            ("sale", "Sale"),
+                            ("payment", "Payment"),
+                            ("return", "Return"),
+                            ("manual", "Manual"),
+                        ],
+                        default="manual",
+                        max_length=20,
+                    ),
+                ),
+                ("source_id", models.PositiveBigIntegerField(blank=True, null=True)),
+                ("created_at", models.DateTimeField(default=django.utils.timezone.now)),
+                (
+                    "customer",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.PROTECT,
+                        related_name="ledger_entries",
+                        to="sales.customer",
+                    ),
+                ),
+            ],
+            options={
+                "verbose_name": "Customer Ledger Entry",
+                "verbose_name_plural": "Customer Ledger Entries",
+                "indexes": [
+                    models.Index(
+                        fields=["customer", "created_at"],
+                        name="sales_custo_custome_b53057_idx",
+                    ),
+                    models.Index(
+                        fields=["source_type", "source_id"],
+                        name="sales_custo_source__edffff_idx",
+                    ),
+                    models.Index(
+                        fields=["created_at"], name="sales_custo_created_2449b3_idx"
+                    ),
+                ],
+            },
+        ),
+    ]
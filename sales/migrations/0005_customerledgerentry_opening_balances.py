@@ -0,0 +1,36 @@
+# Generated by Django 5.2 on 2026-10-18 20:16
+
+from django.db import migrations
+
+
+def create_opening_balances(apps, schema_editor):
+    """Seeds the ledger with the balances that existed before it was introduced."""
+    Customer = apps.get_model("sales", "Customer")
+    CustomerLedgerEntry = apps.get_model("sales", "CustomerLedgerEntry")
+
+    CustomerLedgerEntry.objects.bulk_create(
+        [
+            CustomerLedgerEntry(
+                customer_id=row.pk,
+                amount=row.balance,
+                source_type="opening",
+            )
+            for row in Customer.objects.exclude(balance=0).iterator()
+        ],
+        batch_size=1000,
+    )
+
+
+def delete_opening_balances(apps, schema_editor):
+    CustomerLedgerEntry = apps.get_model("sales", "CustomerLedgerEntry")
+    CustomerLedgerEntry.objects.filter(source_type="opening").delete()
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("sales", "0004_customerbalancecheckpoint_customerledgerentry"),
+    ]
+
+    operations = [
+        migrations.RunPython(create_opening_balances, delete_opening_balances),
+    ]
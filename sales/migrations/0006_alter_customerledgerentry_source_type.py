@@ -0,0 +1,27 @@
+# Generated by Django 5.2 on 2026-10-18 20:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("sales", "0005_customerledgerentry_opening_balances"),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="customerledgerentry",
+            name="source_type",
+            field=models.CharField(
+                choices=[
+                    ("opening", "Opening Balance"),
+                    ("payment", "Payment"),
+                    ("return", "Return"),
+                    ("manual", "Manual"),
+                ],
+                default="manual",
+                max_length=20,
+            ),
+        ),
+    ]
@@ -5,6 +5,8 @@ This module defines the data models for managing sales in the ERP system.
 
 Key models include:
 - Customer: Represents customers who make purchases
+- CustomerLedgerEntry: Append-only record of a change to a customer's balance
+- CustomerBalanceCheckpoint: Closing balance of a customer at the end of a day
 - Sale: Represents a sales transaction
 - SaleItem: Individual items sold in a transaction
 - SaleKit: Item kits sold in a transaction
@@ -15,14 +17,17 @@ Key models include:
 - Discount: Manages discounts applied to sales
 - Tax: Handles tax calculations
 - SalesPerson: Tracks sales performance by employee
+- SalesPersonDailyStats: Sales and returns of one employee on one day
+- DocumentSequence: Next free number of an invoice or return sequence
+- SequenceBlock: Range of sequence numbers reserved by one process
+- SequenceGap: Reserved number that no document ended up using
 """
 
-from django.db import models
+from django.db import models, transaction
 from django.db.models import F, Sum
 from django.utils import timezone
 from inventory.models import Item, ItemKit, SalePoint
 from company.models import Employee, Branch
-from decimal import Decimal
 
 class Customer(models.Model):
     name = models.CharField(max_length=200)
@@ -40,8 +45,63 @@ class Customer(models.Model):
         return self.name
 
     def update_balance(self, amount):
-        self.balance += amount
-        self.save()
+        from .ledger import record_entry
+        record_entry(self.pk, amount)
+        self.refresh_from_db(fields=['balance'])
+
+class CustomerLedgerEntry(models.Model):
+    """Append-only record of a change to a customer's balance.
+
+    Customer.balance is the running total of these rows, kept by
+    sales.ledger.record_entries().
+    """
+
+    SOURCE_CHOICES = [
+        ('opening', 'Opening Balance'),
+        ('payment', 'Payment'),
+        ('return', 'Return'),
+        ('manual', 'Manual'),
+    ]
+
+    customer = models.ForeignKey(Customer, on_delete=models.PROTECT, related_name='ledger_entries')
+    amount = models.DecimalField(max_digits=10, decimal_places=2)
+    source_type = models.CharField(max_length=20, choices=SOURCE_CHOICES, default='manual')
+    source_id = models.PositiveBigIntegerField(null=True, blank=True)
+    created_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        verbose_name = 'Customer Ledger Entry'
+        verbose_name_plural = 'Customer Ledger Entries'
+        indexes = [
+            models.Index(fields=['customer', 'created_at']),
+            models.Index(fields=['source_type', 'source_id']),
+            models.Index(fields=['created_at']),
+        ]
+
+    def __str__(self):
+        return f"{self.customer.name}: {self.amount:+} ({self.get_source_type_display()})"
+
+class CustomerBalanceCheckpoint(models.Model):
+    """Closing balance of a customer at the end of a day.
+
+    Only non-zero balances are stored. The balance at any other moment is
+    the latest checkpoint plus the entries recorded after it, see
+    sales.ledger.balances_as_of().
+    """
+
+    date = models.DateField()
+    customer = models.ForeignKey(Customer, on_delete=models.CASCADE, related_name='balance_checkpoints')
+    balance = models.DecimalField(max_digits=10, decimal_places=2)
+
+    class Meta:
+        verbose_name = 'Customer Balance Checkpoint'
+        verbose_name_plural = 'Customer Balance Checkpoints'
+        indexes = [
+            models.Index(fields=['date', 'customer']),
+        ]
+
+    def __str__(self):
+        return f"{self.customer.name} on {self.date}: {self.balance}"
 
 class Sale(models.Model):
     PAYMENT_STATUS_CHOICES = (
@@ -78,28 +138,13 @@ class Sale(models.Model):
         return f"Sale #{self.invoice_number} - {self.customer.name}"
 
     def calculate_totals(self):
-        # Calculate subtotal from items and kits
-        items_total = self.saleitem_set.aggregate(total=Sum('total_price'))['total'] or 0
-        kits_total = self.salekit_set.aggregate(total=Sum('total_price'))['total'] or 0
-        self.subtotal = items_total + kits_total
-
-        # Calculate tax and discount
-        self.tax_amount = self.subtotal * Decimal('0.16')  # 16% VAT
-        self.discount_amount = self.subtotal * Decimal('0.00')  # Default discount
-
-        # Calculate final total
-        self.total_amount = self.subtotal + self.tax_amount - self.discount_amount
-        self.save()
+        """Recalculates the totals and payment status now instead of on commit."""
+        from .recalc import recalculate_sales
+        recalculate_sales([self.pk])
+        self.refresh_from_db(fields=['subtotal', 'tax_amount', 'discount_amount', 'total_amount', 'payment_status'])
 
     def update_payment_status(self):
-        total_paid = self.payment_set.aggregate(total=Sum('amount'))['total'] or 0
-        if total_paid >= self.total_amount:
-            self.payment_status = 'paid'
-        elif total_paid > 0:
-            self.payment_status = 'partial'
-        else:
-            self.payment_status = 'pending'
-        self.save()
+        self.calculate_totals()
 
 class SaleItem(models.Model):
     sale = models.ForeignKey(Sale, on_delete=models.CASCADE)
@@ -115,8 +160,6 @@ class SaleItem(models.Model):
     def save(self, *args, **kwargs):
         self.total_price = self.quantity * self.unit_price
         super().save(*args, **kwargs)
-        # Update sale totals
-        self.sale.calculate_totals()
 
 class SaleKit(models.Model):
     sale = models.ForeignKey(Sale, on_delete=models.CASCADE)
@@ -132,8 +175,6 @@ class SaleKit(models.Model):
     def save(self, *args, **kwargs):
         self.total_price = self.quantity * self.unit_price
         super().save(*args, **kwargs)
-        # Update sale totals
-        self.sale.calculate_totals()
 
 class Payment(models.Model):
     sale = models.ForeignKey(Sale, on_delete=models.CASCADE)
@@ -147,14 +188,6 @@ class Payment(models.Model):
     def __str__(self):
         return f"Payment for Sale #{self.sale.invoice_number} - {self.amount}"
 
-    def save(self, *args, **kwargs):
-        super().save(*args, **kwargs)
-        # Update sale payment status
-        self.sale.update_payment_status()
-        # Update customer balance if credit payment
-        if self.payment_method == 'credit':
-            self.sale.customer.update_balance(-self.amount)
-
 class Return(models.Model):
     STATUS_CHOICES = (
         ('pending', 'Pending'),
@@ -179,22 +212,27 @@ class Return(models.Model):
         return f"Return #{self.return_number} - {self.customer.name}"
 
     def calculate_total(self):
-        items_total = self.returnitem_set.aggregate(total=Sum('total_price'))['total'] or 0
-        kits_total = self.returnkit_set.aggregate(total=Sum('total_price'))['total'] or 0
-        self.total_amount = items_total + kits_total
-        self.save()
+        """Recalculates the total now instead of on commit."""
+        from .recalc import recalculate_returns
+        recalculate_returns([self.pk])
+        self.refresh_from_db(fields=['total_amount'])
 
     def approve(self, employee):
         self.status = 'approved'
         self.approved_by = employee
         self.save()
 
+    @transaction.atomic
     def complete(self, employee):
+        from .ledger import record_entry
+        # Claiming the return first makes concurrent completions credit the customer only once
+        claimed = Return.objects.filter(pk=self.pk).exclude(status='completed').update(
+            status='completed', completed_by=employee, updated_at=timezone.now()
+        )
         self.status = 'completed'
         self.completed_by = employee
-        self.save()
-        # Update customer balance
-        self.customer.update_balance(self.total_amount)
+        if claimed:
+            record_entry(self.customer_id, self.total_amount, source=self)
 
 class ReturnItem(models.Model):
     return_obj = models.ForeignKey(Return, on_delete=models.CASCADE)
@@ -210,7 +248,6 @@ class ReturnItem(models.Model):
     def save(self, *args, **kwargs):
         self.total_price = self.quantity * self.unit_price
         super().save(*args, **kwargs)
-        self.return_obj.calculate_total()
 
 class ReturnKit(models.Model):
     return_obj = models.ForeignKey(Return, on_delete=models.CASCADE)
@@ -226,7 +263,6 @@ class ReturnKit(models.Model):
     def save(self, *args, **kwargs):
         self.total_price = self.quantity * self.unit_price
         super().save(*args, **kwargs)
-        self.return_obj.calculate_total()
 
 class Discount(models.Model):
     name = models.CharField(max_length=100)
@@ -264,14 +300,78 @@ class SalesPerson(models.Model):
         return f"{self.employee.name} - {self.branch.name}"
 
     def update_stats(self):
-        # Calculate total sales
-        sales = Sale.objects.filter(sales_person=self.employee)
-        self.total_sales = sales.aggregate(total=Sum('total_amount'))['total'] or 0
-
-        # Calculate total returns
-        returns = Return.objects.filter(sale__sales_person=self.employee)
-        self.total_returns = returns.aggregate(total=Sum('total_amount'))['total'] or 0
-
-        # Calculate net sales
+        # Sum the daily rollups kept by sales.stats
+        totals = SalesPersonDailyStats.objects.filter(employee=self.employee).aggregate(
+            sales=Sum('sales_total'), returns=Sum('returns_total')
+        )
+        self.total_sales = totals['sales'] or 0
+        self.total_returns = totals['returns'] or 0
         self.net_sales = self.total_sales - self.total_returns
         self.save()
+
+class SalesPersonDailyStats(models.Model):
+    """Totals of the sales and returns of one employee on one day, kept by sales.stats."""
+
+    employee = models.ForeignKey(Employee, on_delete=models.CASCADE, related_name='daily_sales_stats')
+    date = models.DateField()
+    sales_total = models.DecimalField(max_digits=10, decimal_places=2, default=0)
+    returns_total = models.DecimalField(max_digits=10, decimal_places=2, default=0)
+
+    class Meta:
+        verbose_name_plural = "Sales Person Daily Stats"
+        constraints = [
+            models.UniqueConstraint(fields=['employee', 'date'], name='unique_salesperson_day'),
+        ]
+
+    def __str__(self):
+        return f"{self.employee.name} on {self.date}"
+
+class DocumentSequence(models.Model):
+    """Number sequence of one document type, per sale point, handed out in blocks by sales.sequences."""
+
+    name = models.CharField(max_length=20)
+    sale_point = models.ForeignKey(SalePoint, on_delete=models.PROTECT, null=True, blank=True)
+    prefix = models.CharField(max_length=10)
+    next_value = models.PositiveBigIntegerField(default=1)
+    block_size = models.PositiveIntegerField(default=100)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['name', 'sale_point'], name='unique_document_sequence'),
+        ]
+
+    def __str__(self):
+        return f"{self.name} {self.prefix} next {self.next_value}"
+
+class SequenceBlock(models.Model):
+    sequence = models.ForeignKey(DocumentSequence, on_delete=models.CASCADE, related_name='blocks')
+    start = models.PositiveBigIntegerField()
+    end = models.PositiveBigIntegerField()
+    # Tells a block apart from one reserved over the same range after a rollback
+    token = models.CharField(max_length=32)
+    reserved_at = models.DateTimeField(default=timezone.now)
+    audited_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['audited_at', 'reserved_at']),
+        ]
+
+    def __str__(self):
+        return f"{self.sequence} {self.start}-{self.end}"
+
+class SequenceGap(models.Model):
+    sequence = models.ForeignKey(DocumentSequence, on_delete=models.CASCADE, related_name='gaps')
+    block = models.ForeignKey(SequenceBlock, on_delete=models.CASCADE, related_name='gaps')
+    number = models.PositiveBigIntegerField()
+    document_number = models.CharField(max_length=50)
+    recorded_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['sequence', 'number'], name='unique_sequence_gap'),
+        ]
+
+    def __str__(self):
+        return f"Unused {self.document_number}"
+
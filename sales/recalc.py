@@ -0,0 +1,171 @@
+"""
+Document Totals
+
+This module keeps the totals of Sales and Returns in step with their lines
+and payments.
+
+Saving or deleting a line or a payment only marks its document dirty. The
+dirty documents of a transaction are recalculated once, when it commits,
+so a request that adds fifty lines to a sale works its totals out once
+instead of fifty times. Outside a transaction the recalculation runs
+straight away. The totals of any number of documents are read with one
+grouped query and written with one UPDATE, and the change in their totals
+is passed on to the sales person rollups (see sales.stats).
+"""
+
+from decimal import Decimal
+from threading import local
+
+from django.db import transaction
+from django.db.models import Case, DecimalField, OuterRef, Subquery, Sum, Value, When
+from django.db.models.functions import Coalesce
+
+from .models import Payment, Return, ReturnItem, ReturnKit, Sale, SaleItem, SaleKit
+from .stats import apply_deltas, return_share, sale_share, share_deltas
+
+TAX_RATE = Decimal('0.16')
+DISCOUNT_RATE = Decimal('0.00')
+CENT = Decimal('0.01')
+
+_dirty = local()
+
+
+def payment_status(total_amount, total_paid):
+    """Mirrors Sale.update_payment_status for amounts known up front."""
+    if total_paid >= total_amount:
+        return 'paid'
+    if total_paid > 0:
+        return 'partial'
+    return 'pending'
+
+
+def _line_sum(model, link, field='total_price'):
+    """Subquery summing field over the rows of model pointing at the outer document."""
+    return Coalesce(
+        Subquery(
+            model.objects.filter(**{link: OuterRef('pk')})
+            .order_by()
+            .values(link)
+            .annotate(total=Sum(field))
+            .values('total')
+        ),
+        Value(Decimal(0)),
+        output_field=DecimalField(max_digits=12, decimal_places=2),
+    )
+
+
+def recalculate_sales(sale_ids):
+    """Recalculates the totals and payment status of the sales. Returns the number recalculated."""
+    sale_ids = set(sale_ids)
+    if not sale_ids:
+        return 0
+    rows = Sale.objects.filter(pk__in=sale_ids).annotate(
+        items_total=_line_sum(SaleItem, 'sale'),
+        kits_total=_line_sum(SaleKit, 'sale'),
+        total_paid=_line_sum(Payment, 'sale', 'amount'),
+    ).values_list(
+        'pk', 'payment_status', 'sales_person_id', 'date', 'total_amount', 'items_total', 'kits_total', 'total_paid'
+    )
+
+    totals, statuses, changes = {}, {}, []
+    for pk, status, sales_person_id, date, previous_total, items_total, kits_total, total_paid in rows:
+        subtotal = Decimal(items_total) + Decimal(kits_total)
+        tax_amount = (subtotal * TAX_RATE).quantize(CENT)
+        discount_amount = (subtotal * DISCOUNT_RATE).quantize(CENT)
+        total_amount = subtotal + tax_amount - discount_amount
+        totals[pk] = (subtotal, tax_amount, discount_amount, total_amount)
+        # Cancelled sales keep their status whatever is paid
+        if status != 'cancelled':
+            statuses[pk] = payment_status(total_amount, Decimal(total_paid))
+        changes.append((
+            sale_share(sales_person_id, date, previous_total, status),
+            sale_share(sales_person_id, date, total_amount, status),
+        ))
+    if not totals:
+        return 0
+
+    def amounts(index):
+        return Case(
+            *[When(pk=pk, then=Value(values[index])) for pk, values in totals.items()],
+            output_field=DecimalField(max_digits=10, decimal_places=2),
+        )
+
+    updates = {
+        'subtotal': amounts(0),
+        'tax_amount': amounts(1),
+        'discount_amount': amounts(2),
+        'total_amount': amounts(3),
+    }
+    if statuses:
+        updates['payment_status'] = Case(
+            *[When(pk=pk, then=Value(status)) for pk, status in statuses.items()],
+            default='payment_status',
+        )
+    Sale.objects.filter(pk__in=totals).update(**updates)
+    apply_deltas(share_deltas(changes))
+    return len(totals)
+
+
+def recalculate_returns(return_ids):
+    """Recalculates the totals of the returns. Returns the number recalculated."""
+    return_ids = set(return_ids)
+    if not return_ids:
+        return 0
+    rows = Return.objects.filter(pk__in=return_ids).annotate(
+        items_total=_line_sum(ReturnItem, 'return_obj'),
+        kits_total=_line_sum(ReturnKit, 'return_obj'),
+    ).values_list('pk', 'status', 'sale__sales_person_id', 'date', 'total_amount', 'items_total', 'kits_total')
+
+    totals, changes = {}, []
+    for pk, status, sales_person_id, date, previous_total, items_total, kits_total in rows:
+        totals[pk] = Decimal(items_total) + Decimal(kits_total)
+        changes.append((
+            return_share(sales_person_id, date, previous_total, status),
+            return_share(sales_person_id, date, totals[pk], status),
+        ))
+    if totals:
+        Return.objects.filter(pk__in=totals).update(total_amount=Case(
+            *[When(pk=pk, then=Value(total)) for pk, total in totals.items()],
+            output_field=DecimalField(max_digits=10, decimal_places=2),
+        ))
+        apply_deltas(share_deltas(changes))
+    return len(totals)
+
+
+def _pending():
+    if getattr(_dirty, 'sales', None) is None:
+        _dirty.sales = set()
+        _dirty.returns = set()
+    return _dirty
+
+
+def flush():
+    """Recalculates every document marked dirty on this thread."""
+    pending = _pending()
+    sale_ids, return_ids = pending.sales, pending.returns
+    if not sale_ids and not return_ids:
+        return
+    pending.sales, pending.returns = set(), set()
+    with transaction.atomic():
+        recalculate_sales(sale_ids)
+        recalculate_returns(return_ids)
+
+
+def _schedule(ids, pk):
+    if pk is None:
+        return
+    ids.add(pk)
+    # Every mark registers the flush, so documents marked in a savepoint
+    # that rolls back are still picked up by a later flush of the
+    # transaction. Flushes after the first find nothing left to do.
+    transaction.on_commit(flush)
+
+
+def mark_sale(sale_id):
+    """Recalculates the sale when the current transaction commits."""
+    _schedule(_pending().sales, sale_id)
+
+
+def mark_return(return_id):
+    """Recalculates the return when the current transaction commits."""
+    _schedule(_pending().returns, return_id)
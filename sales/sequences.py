@@ -0,0 +1,218 @@
+"""
+Document Numbers
+
+This module hands out invoice and return numbers from DocumentSequences.
+
+Each process reserves a block of numbers per sequence with one short
+locked update of the sequence row and then hands the block out from memory,
+so allocating a number costs no queries and two tills can never be given
+the same number.
+
+The lock on the sequence row is held until the reserving transaction ends,
+so blocks are reserved ahead of need: once a quarter of a block is left,
+the next one is reserved as soon as the current transaction commits, in a
+short transaction of its own. A checkout then only reserves inside its own
+transaction for the first block of a process, or when numbers are taken
+faster than blocks are topped up. A block reserved inside a transaction is
+only shared with other threads once that transaction commits; until then
+the reserving thread checks that the block still exists before using it,
+so numbers from a block that was rolled back are never handed out.
+
+Numbers read INV{sale point}-{000001}. They replaced the INV{YYYYMMDD}{0001}
+invoice numbers worked out from the last sale of the day, so they no longer
+restart every day or carry the date; Sale.date does. Numbers given out
+before the change keep their old form and cannot clash with new ones.
+
+Numbers that are reserved but never end up on a document (the rest of a
+block when its process stops, or numbers of documents that were rolled
+back) are gaps. audit_gaps records them as SequenceGaps once their block is
+old enough that no process can still be using it.
+"""
+
+import threading
+import time
+import uuid
+from collections import defaultdict
+from datetime import timedelta
+
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+
+from .models import DocumentSequence, Return, Sale, SequenceBlock, SequenceGap
+
+# Sequence name -> (number prefix, document model, number field)
+SEQUENCES = {
+    'invoice': ('INV', Sale, 'invoice_number'),
+    'return': ('RET', Return, 'return_number'),
+}
+
+# Blocks are not used for longer than this so audits can rely on them being closed
+BLOCK_MAX_AGE = timedelta(hours=12)
+
+
+def format_number(prefix, sale_point_id, value):
+    return f"{prefix}{sale_point_id or 0}-{value:06d}"
+
+
+@transaction.atomic
+def reserve_block(name, sale_point_id=None, size=None):
+    """Reserves the next block of a sequence, creating the sequence if needed.
+
+    Returns (prefix, block).
+    """
+    sequence, _ = DocumentSequence.objects.get_or_create(
+        name=name, sale_point_id=sale_point_id, defaults={'prefix': SEQUENCES[name][0]}
+    )
+    sequence = DocumentSequence.objects.select_for_update().get(pk=sequence.pk)
+    size = size or sequence.block_size
+    DocumentSequence.objects.filter(pk=sequence.pk).update(next_value=F('next_value') + size)
+    block = SequenceBlock.objects.create(
+        sequence=sequence,
+        start=sequence.next_value,
+        end=sequence.next_value + size - 1,
+        token=uuid.uuid4().hex,
+    )
+    return sequence.prefix, block
+
+
+class Block:
+    """The unused part of a reserved block held in memory."""
+
+    def __init__(self, prefix, block, expires):
+        self.prefix = prefix
+        self.pk = block.pk
+        self.token = block.token
+        self.next = block.start
+        self.end = block.end
+        self.refill_at = block.end - (block.end - block.start + 1) // 4
+        self.refilled = False
+        self.expires = expires
+
+    def usable(self, now):
+        return self.next <= self.end and self.expires > now
+
+    def take(self):
+        value = self.next
+        self.next += 1
+        return value
+
+    def needs_refill(self):
+        """True once, when the block runs low."""
+        if self.refilled or self.next <= self.refill_at:
+            return False
+        self.refilled = True
+        return True
+
+
+class SequenceAllocator:
+    """Hands out document numbers from blocks cached in this process."""
+
+    def __init__(self, max_age=BLOCK_MAX_AGE):
+        self.max_age = max_age.total_seconds()
+        self._shared = defaultdict(list)
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def _pending(self):
+        """Blocks this thread reserved in a transaction that has not committed yet."""
+        if not hasattr(self._local, 'blocks'):
+            self._local.blocks = {}
+        return self._local.blocks
+
+    def _take_pending(self, key, now):
+        block = self._pending().get(key)
+        if block is None:
+            return None
+        # A pending block whose transaction was rolled back no longer exists
+        if not block.usable(now) or not SequenceBlock.objects.filter(pk=block.pk, token=block.token).exists():
+            del self._pending()[key]
+            return None
+        return block, block.take()
+
+    def _take_shared(self, key, now):
+        with self._lock:
+            blocks = self._shared[key]
+            while blocks and not blocks[0].usable(now):
+                blocks.pop(0)
+            if blocks:
+                return blocks[0], blocks[0].take()
+        return None
+
+    def _share(self, key, block):
+        if self._pending().get(key) is block:
+            del self._pending()[key]
+        with self._lock:
+            self._shared[key].append(block)
+
+    def _refill(self, key):
+        """Reserves the next block of a sequence before the current one runs out."""
+        prefix, reserved = reserve_block(*key)
+        block = Block(prefix, reserved, time.monotonic() + self.max_age)
+        with self._lock:
+            self._shared[key].append(block)
+
+    def next_number(self, name, sale_point_id=None):
+        """Returns the next number of the sequence for the sale point."""
+        key = (name, sale_point_id)
+        now = time.monotonic()
+        taken = self._take_pending(key, now) or self._take_shared(key, now)
+        if taken is None:
+            prefix, reserved = reserve_block(name, sale_point_id)
+            block = Block(prefix, reserved, now + self.max_age)
+            taken = block, block.take()
+            # Runs at once outside a transaction, otherwise when it commits
+            self._pending()[key] = block
+            transaction.on_commit(lambda: self._share(key, block))
+        block, value = taken
+        with self._lock:
+            refill = block.needs_refill()
+        if refill:
+            transaction.on_commit(lambda: self._refill(key))
+        return format_number(block.prefix, sale_point_id, value)
+
+    def clear(self):
+        with self._lock:
+            self._shared.clear()
+        self._pending().clear()
+
+
+allocator = SequenceAllocator()
+
+
+def next_invoice_number(sale_point_id):
+    return allocator.next_number('invoice', sale_point_id)
+
+
+def next_return_number(sale_point_id):
+    return allocator.next_number('return', sale_point_id)
+
+
+def audit_gaps(before=None):
+    """Records the unused numbers of blocks reserved before the cutoff.
+
+    Every block is audited once, with one query for the numbers its
+    documents used. Returns the number of gaps recorded.
+    """
+    before = before or timezone.now() - 2 * BLOCK_MAX_AGE
+    recorded = 0
+    blocks = SequenceBlock.objects.filter(audited_at__isnull=True, reserved_at__lt=before).select_related(
+        'sequence'
+    ).order_by('pk')
+    for block in blocks:
+        sequence = block.sequence
+        _, model, field = SEQUENCES[sequence.name]
+        numbers = {
+            format_number(sequence.prefix, sequence.sale_point_id, value): value
+            for value in range(block.start, block.end + 1)
+        }
+        used = set(model.objects.filter(**{f'{field}__in': list(numbers)}).values_list(field, flat=True))
+        with transaction.atomic():
+            gaps = SequenceGap.objects.bulk_create([
+                SequenceGap(sequence=sequence, block=block, number=value, document_number=number)
+                for number, value in numbers.items()
+                if number not in used
+            ], ignore_conflicts=True)
+            SequenceBlock.objects.filter(pk=block.pk).update(audited_at=timezone.now())
+        recorded += len(gaps)
+    return recorded
@@ -3,14 +3,19 @@ Sales Management Signals
 
 This module defines the signals for the sales management system.
 These signals handle automatic updates when related models change.
+Changes to lines and payments mark their document for recalculation when
+the transaction commits (see sales.recalc).
 """
 
-from django.db.models.signals import post_save, post_delete
+from django.db.models.signals import post_save, post_delete, pre_save
 from django.dispatch import receiver
 from .models import (
     Sale, SaleItem, SaleKit, Payment, Return,
-    ReturnItem, ReturnKit, SalesPerson
+    ReturnItem, ReturnKit
 )
+from .ledger import credit_share, record_change
+from .recalc import mark_return, mark_sale
+from .stats import apply_deltas, return_share, sale_share, share_deltas
 
 @receiver([post_save, post_delete], sender=SaleItem)
 @receiver([post_save, post_delete], sender=SaleKit)
@@ -18,16 +23,44 @@ def update_sale_totals(sender, instance, **kwargs):
     """
     Update sale totals when items or kits are added, modified, or deleted.
     """
-    if hasattr(instance, 'sale'):
-        instance.sale.calculate_totals()
+    mark_sale(instance.sale_id)
 
 @receiver([post_save, post_delete], sender=Payment)
 def update_sale_payment_status(sender, instance, **kwargs):
     """
     Update sale payment status when payments are added, modified, or deleted.
     """
-    if hasattr(instance, 'sale'):
-        instance.sale.update_payment_status()
+    mark_sale(instance.sale_id)
+
+@receiver(pre_save, sender=Payment)
+def remember_credit_share(sender, instance, **kwargs):
+    """
+    Remember what a payment counted for in its customer's balance before it is saved.
+    """
+    instance._credit_share = None
+    if instance._state.adding:
+        return
+    row = Payment.objects.filter(pk=instance.pk).values_list(
+        'sale__customer_id', 'amount', 'payment_method'
+    ).first()
+    instance._credit_share = row and credit_share(*row)
+
+@receiver(post_save, sender=Payment)
+def update_customer_balance(sender, instance, **kwargs):
+    """
+    Move the customer balance by what a saved credit payment changed.
+    """
+    before = getattr(instance, '_credit_share', None)
+    after = credit_share(instance.sale.customer_id, instance.amount, instance.payment_method)
+    record_change(before, after, source=instance)
+
+@receiver(post_delete, sender=Payment)
+def reverse_customer_balance(sender, instance, **kwargs):
+    """
+    Give a deleted credit payment back to the customer balance.
+    """
+    before = credit_share(instance.sale.customer_id, instance.amount, instance.payment_method)
+    record_change(before, None, source=instance)
 
 @receiver([post_save, post_delete], sender=ReturnItem)
 @receiver([post_save, post_delete], sender=ReturnKit)
@@ -35,20 +68,47 @@ def update_return_totals(sender, instance, **kwargs):
     """
     Update return totals when items or kits are added, modified, or deleted.
     """
-    if hasattr(instance, 'return_obj'):
-        instance.return_obj.calculate_total()
+    mark_return(instance.return_obj_id)
 
-@receiver([post_save, post_delete], sender=Sale)
-@receiver([post_save, post_delete], sender=Return)
+def salesperson_share(instance):
+    """What a sale or return in memory counts for in the sales person rollups."""
+    if isinstance(instance, Sale):
+        return sale_share(instance.sales_person_id, instance.date, instance.total_amount, instance.payment_status)
+    return return_share(instance.sale.sales_person_id, instance.date, instance.total_amount, instance.status)
+
+@receiver(pre_save, sender=Sale)
+@receiver(pre_save, sender=Return)
+def remember_salesperson_share(sender, instance, **kwargs):
+    """
+    Remember what a sale or return counted for before it is saved.
+    """
+    instance._salesperson_share = None
+    if instance._state.adding:
+        return
+    if sender is Sale:
+        row = Sale.objects.filter(pk=instance.pk).values_list(
+            'sales_person_id', 'date', 'total_amount', 'payment_status'
+        ).first()
+        instance._salesperson_share = row and sale_share(*row)
+    else:
+        row = Return.objects.filter(pk=instance.pk).values_list(
+            'sale__sales_person_id', 'date', 'total_amount', 'status'
+        ).first()
+        instance._salesperson_share = row and return_share(*row)
+
+@receiver(post_save, sender=Sale)
+@receiver(post_save, sender=Return)
 def update_salesperson_stats(sender, instance, **kwargs):
     """
-    Update salesperson statistics when sales or returns are added, modified, or deleted.
+    Move the salesperson rollups by what a saved sale or return changed.
     """
-    if isinstance(instance, Sale):
-        salesperson = SalesPerson.objects.filter(employee=instance.sales_person).first()
-        if salesperson:
-            salesperson.update_stats()
-    elif isinstance(instance, Return):
-        salesperson = SalesPerson.objects.filter(employee=instance.sale.sales_person).first()
-        if salesperson:
-            salesperson.update_stats() 
\ No newline at end of file
+    before = getattr(instance, '_salesperson_share', None)
+    apply_deltas(share_deltas([(before, salesperson_share(instance))]))
+
+@receiver(post_delete, sender=Sale)
+@receiver(post_delete, sender=Return)
+def remove_salesperson_stats(sender, instance, **kwargs):
+    """
+    Take a deleted sale or return out of the salesperson rollups.
+    """
+    apply_deltas(share_deltas([(salesperson_share(instance), None)]))
@@ -0,0 +1,144 @@
+"""
+Sales Person Stats
+
+This module keeps the SalesPersonDailyStats rollups and the SalesPerson
+totals derived from them.
+
+A sale counts towards the sales of its sales person on the day it was made
+unless it is cancelled, and a return towards the returns of the sale's
+sales person on the day it was made unless it is rejected. Whenever a sale
+or a return changes, only the difference between what it counted for
+before and after is added to the rollups of the affected days, so the cost
+of a change does not grow with the sales history. The SalesPerson totals
+are then summed from the rollups, one row per day.
+
+rebuild_rollups recomputes the rollups of a date range from the sales and
+returns, for backfills and to repair drift.
+"""
+
+from collections import defaultdict
+from decimal import Decimal
+
+from django.db import transaction
+from django.db.models import Case, DecimalField, F, OuterRef, Q, Subquery, Sum, Value, When
+from django.db.models.functions import Coalesce, TruncDate
+from django.utils import timezone
+
+from .models import Return, Sale, SalesPerson, SalesPersonDailyStats
+
+AMOUNT = DecimalField(max_digits=10, decimal_places=2)
+
+
+def stat_day(value):
+    return timezone.localdate(value) if timezone.is_aware(value) else value.date()
+
+
+def sale_share(sales_person_id, date, total_amount, payment_status):
+    """Returns the (field, employee id, day) and amount a sale counts for, or None."""
+    if payment_status == 'cancelled' or not total_amount:
+        return None
+    return ('sales_total', sales_person_id, stat_day(date)), Decimal(total_amount)
+
+
+def return_share(sales_person_id, date, total_amount, status):
+    """Returns the (field, employee id, day) and amount a return counts for, or None."""
+    if status == 'rejected' or not total_amount:
+        return None
+    return ('returns_total', sales_person_id, stat_day(date)), Decimal(total_amount)
+
+
+def share_deltas(changes):
+    """Turns (share before, share after) pairs into {(field, employee id, day): delta}."""
+    deltas = defaultdict(Decimal)
+    for before, after in changes:
+        if before is not None:
+            deltas[before[0]] -= before[1]
+        if after is not None:
+            deltas[after[0]] += after[1]
+    return deltas
+
+
+def _rollup_sum(field):
+    return Coalesce(
+        Subquery(
+            SalesPersonDailyStats.objects.filter(employee=OuterRef('employee'))
+            .order_by()
+            .values('employee')
+            .annotate(total=Sum(field))
+            .values('total')
+        ),
+        Value(Decimal(0)),
+        output_field=AMOUNT,
+    )
+
+
+def refresh_salespeople(employee_ids=None):
+    """Sets the SalesPerson totals of the employees, or of everyone, from the rollups with one UPDATE."""
+    salespeople = SalesPerson.objects.all()
+    if employee_ids is not None:
+        salespeople = salespeople.filter(employee_id__in=employee_ids)
+    return salespeople.update(
+        total_sales=_rollup_sum('sales_total'),
+        total_returns=_rollup_sum('returns_total'),
+        net_sales=_rollup_sum('sales_total') - _rollup_sum('returns_total'),
+    )
+
+
+@transaction.atomic
+def apply_deltas(deltas):
+    """Adds {(field, employee id, day): delta} to the rollups and refreshes the sales people.
+
+    Missing rollup rows are inserted first, then every delta is added with
+    one UPDATE, however many days and employees are touched.
+    """
+    deltas = {key: delta for key, delta in deltas.items() if delta}
+    if not deltas:
+        return
+    days = sorted({(employee_id, day) for _, employee_id, day in deltas})
+    SalesPersonDailyStats.objects.bulk_create(
+        [SalesPersonDailyStats(employee_id=employee_id, date=day) for employee_id, day in days],
+        ignore_conflicts=True,
+    )
+
+    updates = {}
+    for field in ('sales_total', 'returns_total'):
+        whens = [
+            When(employee_id=employee_id, date=day, then=Value(delta))
+            for (delta_field, employee_id, day), delta in deltas.items()
+            if delta_field == field
+        ]
+        if whens:
+            updates[field] = F(field) + Case(*whens, default=Value(Decimal(0)), output_field=AMOUNT)
+    matches = Q()
+    for employee_id, day in days:
+        matches |= Q(employee_id=employee_id, date=day)
+    SalesPersonDailyStats.objects.filter(matches).update(**updates)
+    refresh_salespeople({employee_id for employee_id, _ in days})
+
+
+@transaction.atomic
+def rebuild_rollups(start, end):
+    """Recomputes the rollups of the days from start to end from the sales and returns.
+
+    Ranges that do not overlap can be rebuilt at the same time. Returns
+    the number of rollup rows written.
+    """
+    SalesPersonDailyStats.objects.filter(date__range=(start, end)).delete()
+    rows = defaultdict(dict)
+    sales = Sale.objects.filter(date__date__range=(start, end)).exclude(payment_status='cancelled').annotate(
+        day=TruncDate('date')
+    ).order_by().values('sales_person_id', 'day').annotate(total=Sum('total_amount'))
+    for row in sales:
+        rows[(row['sales_person_id'], row['day'])]['sales_total'] = row['total']
+    returns = Return.objects.filter(date__date__range=(start, end)).exclude(status='rejected').annotate(
+        day=TruncDate('date')
+    ).order_by().values('sale__sales_person_id', 'day').annotate(total=Sum('total_amount'))
+    for row in returns:
+        rows[(row['sale__sales_person_id'], row['day'])]['returns_total'] = row['total']
+
+    created = SalesPersonDailyStats.objects.bulk_create([
+        SalesPersonDailyStats(employee_id=employee_id, date=day, **totals)
+        for (employee_id, day), totals in sorted(rows.items())
+        if any(totals.values())
+    ], batch_size=1000)
+    return len(created)
@@ -7,13 +7,24 @@ This module defines the tests for the sales management system.
 from django.test import TestCase, Client
 from django.urls import reverse
 from django.contrib.auth.models import User
+from django.test.utils import CaptureQueriesContext
+from django.core.management import call_command
+from django.db import connection, transaction
 from django.utils import timezone
+from datetime import timedelta
+from io import StringIO
+import json
 from decimal import Decimal
 from .models import (
     Customer, Sale, SaleItem, SaleKit, Payment, Return,
-    ReturnItem, ReturnKit, Discount, Tax, SalesPerson
+    ReturnItem, ReturnKit, Discount, Tax, SalesPerson, DocumentSequence, SequenceBlock, SequenceGap,
+    SalesPersonDailyStats, CustomerLedgerEntry, CustomerBalanceCheckpoint
 )
-from inventory.models import Item, ItemKit, SalePoint, SalePointItem
+from inventory.models import Item, ItemKit, ItemKitItem, ItemUnit, SalePoint, SalePointItem
+from inventory.tests import InventoryFixtures
+from .sequences import SequenceAllocator, allocator, audit_gaps, next_invoice_number
+from .recalc import flush
+from .ledger import balance_aging, balances_as_of, record_entry, statement
 from company.models import Department, Category, Employee, Branch
 
 class SalesTestCase(TestCase):
@@ -359,3 +370,533 @@ class SalesTestCase(TestCase):
         self.assertEqual(self.sales_person.total_sales, Decimal('75.00'))
         self.assertEqual(self.sales_person.total_returns, Decimal('30.00'))
         self.assertEqual(self.sales_person.net_sales, Decimal('45.00'))
+
+
+class BasketLookupTest(InventoryFixtures, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = User.objects.create_user(username='cashier', password='testpass123')
+        self.client.login(username='cashier', password='testpass123')
+        self.items = [self.item] + [self.create_item(f'Basket Item {i}') for i in range(5)]
+        for quantity, item in enumerate(self.items, start=1):
+            self.sale_point.update_stock(quantity * 4, item)
+        ItemUnit.objects.create(
+            item=self.item, unit='box', smallest_units=12, buying_price=120, selling_price=170
+        )
+
+    def create_kit(self, name, components):
+        kit = ItemKit.objects.create(
+            name=name, department=self.department, category=self.category, selling_price=40
+        )
+        for item, quantity in components:
+            ItemKitItem.objects.create(item_kit=kit, item=item, quantity=quantity)
+        return kit
+
+    def lookup(self, items, kits):
+        return self.client.get(reverse('sales:get_basket_info'), {
+            'items': ','.join(str(item.pk) for item in items),
+            'kits': ','.join(str(kit.pk) for kit in kits),
+            'sale_point_id': self.sale_point.pk,
+        })
+
+    def test_items_and_kits_in_one_response(self):
+        kit = self.create_kit('Pair', [(self.items[0], 2), (self.items[1], 3)])
+        data = self.lookup(self.items[:2], [kit]).json()
+
+        item = data['items'][str(self.item.pk)]
+        self.assertEqual(item['price'], 15.0)
+        self.assertEqual(item['stock'], 4)
+        self.assertEqual([unit['unit'] for unit in item['units']], ['piece', 'box'])
+        kit_data = data['kits'][str(kit.pk)]
+        self.assertEqual([c['stock'] for c in kit_data['components']], [4, 8])
+        # min(4 // 2, 8 // 3)
+        self.assertEqual(kit_data['stock'], 2)
+
+    def test_query_count_does_not_grow_with_basket(self):
+        small_kit = self.create_kit('Small', [(self.items[0], 1)])
+        large_kit = self.create_kit('Large', [(item, 1) for item in self.items])
+        self.lookup(self.items[:1], [small_kit])
+
+        with CaptureQueriesContext(connection) as small:
+            self.lookup(self.items[:1], [small_kit])
+        with CaptureQueriesContext(connection) as large:
+            self.lookup(self.items, [small_kit, large_kit])
+        self.assertEqual(len(small.captured_queries), len(large.captured_queries))
+
+    def test_missing_and_invalid_ids(self):
+        data = self.lookup([self.item, Item(pk=999999)], []).json()
+        self.assertEqual(list(data['items']), [str(self.item.pk)])
+        self.assertEqual(data['missing_items'], [999999])
+
+        response = self.client.get(reverse('sales:get_basket_info'), {'items': 'abc'})
+        self.assertEqual(response.status_code, 400)
+
+
+class IdempotentPaymentTest(InventoryFixtures, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = User.objects.create_user(username='cashier', password='testpass123')
+        self.client.login(username='cashier', password='testpass123')
+        customer = Customer.objects.create(name='Walk In', phone='1234567890')
+        self.sale = Sale.objects.create(
+            invoice_number='INV-1', customer=customer, sale_point=self.sale_point,
+            sales_person=self.employee, total_amount=100, payment_method='cash'
+        )
+
+    def pay(self, amount, key):
+        return self.client.post(
+            reverse('sales:payment_add', args=[self.sale.pk]),
+            {'amount': amount, 'payment_method': 'cash'},
+            HTTP_IDEMPOTENCY_KEY=key,
+        )
+
+    def test_retried_payment_is_recorded_once(self):
+        first = self.pay(40, 'pay-1')
+        retry = self.pay(40, 'pay-1')
+
+        self.assertEqual(first.status_code, 302)
+        self.assertEqual(retry.status_code, 302)
+        self.assertEqual(retry['Location'], first['Location'])
+        self.assertEqual(retry['Idempotent-Replayed'], 'true')
+        self.assertEqual(Payment.objects.filter(sale=self.sale).count(), 1)
+
+        self.pay(40, 'pay-2')
+        self.assertEqual(Payment.objects.filter(sale=self.sale).count(), 2)
+
+    def test_reused_key_with_different_data_is_rejected(self):
+        self.pay(40, 'pay-1')
+        response = self.pay(50, 'pay-1')
+        self.assertEqual(response.status_code, 422)
+        self.assertEqual(Payment.objects.filter(sale=self.sale).count(), 1)
+
+
+class CheckoutTest(InventoryFixtures, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = User.objects.create_user(username='cashier', password='testpass123')
+        self.employee.user = self.user
+        self.employee.save()
+        self.client.login(username='cashier', password='testpass123')
+        self.customer = Customer.objects.create(name='Walk In', phone='1234567890')
+        self.salesperson = SalesPerson.objects.create(employee=self.employee, branch=self.branch)
+        self.items = [self.item] + [self.create_item(f'Checkout Item {i}') for i in range(9)]
+        for item in self.items:
+            self.sale_point.update_stock(10, item)
+        self.kit = ItemKit.objects.create(
+            name='Pair', department=self.department, category=self.category, selling_price=25
+        )
+        ItemKitItem.objects.create(item_kit=self.kit, item=self.items[0], quantity=2)
+
+    def checkout(self, items, kits=(), payments=(), **extra):
+        return self.client.post(reverse('sales:checkout_basket'), json.dumps({
+            'sale_point_id': self.sale_point.pk,
+            'customer_id': self.customer.pk,
+            'items': [{'item_id': item.pk, 'quantity': quantity} for item, quantity in items],
+            'kits': [{'kit_id': kit.pk, 'quantity': quantity} for kit, quantity in kits],
+            'payments': list(payments),
+        }), content_type='application/json', **extra)
+
+    def stock(self, item):
+        return SalePointItem.objects.get(sale_point=self.sale_point, item=item).quantity
+
+    def test_basket_is_recorded_as_one_sale(self):
+        response = self.checkout(
+            [(self.items[0], 2), (self.items[1], 1)], [(self.kit, 1)],
+            [{'amount': '50.00', 'payment_method': 'cash'}],
+        )
+        self.assertEqual(response.status_code, 201)
+        sale = Sale.objects.get(pk=response.json()['id'])
+
+        # 3 x 15 + 25 plus 16% tax
+        self.assertEqual(sale.subtotal, Decimal('70.00'))
+        self.assertEqual(sale.total_amount, Decimal('81.20'))
+        self.assertEqual(sale.payment_status, 'partial')
+        self.assertEqual(sale.saleitem_set.count(), 2)
+        self.assertEqual(sale.salekit_set.count(), 1)
+        self.assertEqual(sale.payment_set.get().amount, Decimal('50.00'))
+        self.assertEqual(self.stock(self.items[0]), 6)
+        self.assertEqual(self.stock(self.items[1]), 9)
+        self.salesperson.refresh_from_db()
+        self.assertEqual(self.salesperson.total_sales, Decimal('81.20'))
+
+    def test_query_count_does_not_grow_with_basket(self):
+        self.checkout([(self.items[0], 1)])
+
+        with CaptureQueriesContext(connection) as small:
+            self.checkout([(self.items[0], 1)], payments=[{'amount': '1', 'payment_method': 'cash'}])
+        with CaptureQueriesContext(connection) as large:
+            self.checkout(
+                [(item, 1) for item in self.items],
+                payments=[{'amount': '1', 'payment_method': 'cash'}, {'amount': '2', 'payment_method': 'cash'}],
+            )
+        self.assertEqual(len(small.captured_queries), len(large.captured_queries))
+
+    def test_credit_payments_get_an_entry_each(self):
+        response = self.checkout([(self.items[0], 2)], payments=[
+            {'amount': '10.00', 'payment_method': 'credit'},
+            {'amount': '5.00', 'payment_method': 'cash'},
+            {'amount': '4.00', 'payment_method': 'credit'},
+        ])
+        self.assertEqual(response.status_code, 201)
+        credit = Payment.objects.filter(sale_id=response.json()['id'], payment_method='credit').order_by('pk')
+
+        self.customer.refresh_from_db()
+        self.assertEqual(self.customer.balance, Decimal('-14.00'))
+        self.assertEqual(
+            list(self.customer.ledger_entries.order_by('pk').values_list('source_type', 'source_id', 'amount')),
+            [('payment', credit[0].pk, Decimal('-10.00')), ('payment', credit[1].pk, Decimal('-4.00'))],
+        )
+
+    def test_short_basket_writes_nothing(self):
+        response = self.checkout([(self.items[0], 4), (self.items[1], 11)])
+
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response.json()['shortages'][0]['item_id'], self.items[1].pk)
+        self.assertFalse(Sale.objects.exists())
+        self.assertEqual(self.stock(self.items[0]), 10)
+
+    def test_overpayment_and_unknown_items_are_rejected(self):
+        response = self.checkout([(self.items[0], 1)], payments=[{'amount': '100', 'payment_method': 'cash'}])
+        self.assertEqual(response.status_code, 400)
+        response = self.checkout([(Item(pk=999999), 1)])
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(Sale.objects.exists())
+
+
+class SequenceTest(InventoryFixtures, TestCase):
+    def setUp(self):
+        super().setUp()
+        allocator.clear()
+        self.addCleanup(allocator.clear)
+        self.customer = Customer.objects.create(name='Walk In', phone='1234567890')
+
+    def test_numbers_come_from_a_reserved_block_without_queries(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            first = next_invoice_number(self.sale_point.pk)
+        with CaptureQueriesContext(connection) as queries:
+            numbers = [next_invoice_number(self.sale_point.pk) for _ in range(50)]
+
+        self.assertEqual(len(queries.captured_queries), 0)
+        self.assertEqual(first, f'INV{self.sale_point.pk}-000001')
+        self.assertEqual(numbers[-1], f'INV{self.sale_point.pk}-000051')
+        sequence = DocumentSequence.objects.get(name='invoice', sale_point=self.sale_point)
+        self.assertEqual(sequence.next_value, 101)
+
+    def test_next_block_is_reserved_after_commit(self):
+        DocumentSequence.objects.create(name='invoice', sale_point=self.sale_point, prefix='INV', block_size=4)
+        with self.captureOnCommitCallbacks(execute=True):
+            numbers = [next_invoice_number(self.sale_point.pk) for _ in range(4)]
+        self.assertEqual(SequenceBlock.objects.count(), 2)
+
+        # The transaction taking the next number finds the block in memory
+        with CaptureQueriesContext(connection) as queries:
+            number = next_invoice_number(self.sale_point.pk)
+        self.assertEqual(len(queries.captured_queries), 0)
+        self.assertEqual(numbers[-1], f'INV{self.sale_point.pk}-000004')
+        self.assertEqual(number, f'INV{self.sale_point.pk}-000005')
+
+    def test_processes_get_separate_blocks(self):
+        other = SequenceAllocator()
+        with self.captureOnCommitCallbacks(execute=True):
+            ours = next_invoice_number(self.sale_point.pk)
+            theirs = other.next_number('invoice', self.sale_point.pk)
+
+        self.assertEqual(ours, f'INV{self.sale_point.pk}-000001')
+        self.assertEqual(theirs, f'INV{self.sale_point.pk}-000101')
+        self.assertEqual(SequenceBlock.objects.count(), 2)
+
+    def test_rolled_back_block_is_not_reused(self):
+        try:
+            with transaction.atomic():
+                next_invoice_number(self.sale_point.pk)
+                raise RuntimeError
+        except RuntimeError:
+            pass
+        # Another process reserves the same range after the rollback
+        other = SequenceAllocator()
+        with self.captureOnCommitCallbacks(execute=True):
+            theirs = other.next_number('invoice', self.sale_point.pk)
+            ours = next_invoice_number(self.sale_point.pk)
+
+        self.assertEqual(theirs, f'INV{self.sale_point.pk}-000001')
+        self.assertEqual(ours, f'INV{self.sale_point.pk}-000101')
+
+    def test_unused_numbers_are_recorded_as_gaps(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            numbers = [next_invoice_number(self.sale_point.pk) for _ in range(3)]
+        for number in (numbers[0], numbers[2]):
+            Sale.objects.create(
+                invoice_number=number, customer=self.customer, sale_point=self.sale_point,
+                sales_person=self.employee, payment_method='cash'
+            )
+        SequenceBlock.objects.update(reserved_at=timezone.now() - timedelta(days=2))
+
+        self.assertEqual(audit_gaps(), 98)
+        self.assertTrue(SequenceGap.objects.filter(document_number=numbers[1]).exists())
+        self.assertFalse(SequenceGap.objects.filter(document_number=numbers[0]).exists())
+        # Audited blocks are not looked at again
+        self.assertEqual(audit_gaps(), 0)
+
+
+class RecalcTest(InventoryFixtures, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.customer = Customer.objects.create(name='Walk In', phone='1234567890')
+        self.sale = Sale.objects.create(
+            invoice_number='INV-1', customer=self.customer, sale_point=self.sale_point,
+            sales_person=self.employee, payment_method='cash'
+        )
+        self.salesperson = SalesPerson.objects.create(employee=self.employee, branch=self.branch)
+        self.addCleanup(flush)
+
+    def add_lines(self, count):
+        for _ in range(count):
+            SaleItem.objects.create(sale=self.sale, item=self.item, quantity=2, unit_price=Decimal('5.00'))
+
+    def test_sale_is_recalculated_once_on_commit(self):
+        with self.captureOnCommitCallbacks() as callbacks:
+            self.add_lines(10)
+            Payment.objects.create(sale=self.sale, amount=Decimal('50.00'), payment_method='cash')
+            self.sale.refresh_from_db()
+            self.assertEqual(self.sale.total_amount, 0)
+
+        callbacks[0]()
+        # The other changes find their sale already recalculated
+        with CaptureQueriesContext(connection) as queries:
+            for callback in callbacks[1:]:
+                callback()
+        self.assertEqual(len(queries.captured_queries), 0)
+
+        self.sale.refresh_from_db()
+        self.salesperson.refresh_from_db()
+
+        self.assertEqual(self.sale.subtotal, Decimal('100.00'))
+        self.assertEqual(self.sale.tax_amount, Decimal('16.00'))
+        self.assertEqual(self.sale.total_amount, Decimal('116.00'))
+        self.assertEqual(self.sale.payment_status, 'partial')
+        self.assertEqual(self.salesperson.total_sales, Decimal('116.00'))
+
+    def test_query_count_does_not_grow_with_lines(self):
+        def flush_queries(lines):
+            with self.captureOnCommitCallbacks():
+                self.add_lines(lines)
+            with CaptureQueriesContext(connection) as queries:
+                flush()
+            return len(queries.captured_queries)
+
+        self.assertEqual(flush_queries(1), flush_queries(30))
+
+    def test_returns_are_recalculated_on_commit(self):
+        return_obj = Return.objects.create(
+            sale=self.sale, customer=self.customer, return_number='RET-1', reason='Damaged'
+        )
+        with self.captureOnCommitCallbacks(execute=True):
+            for _ in range(3):
+                ReturnItem.objects.create(return_obj=return_obj, item=self.item, quantity=1, unit_price=Decimal('5.00'))
+            ReturnItem.objects.filter(return_obj=return_obj).first().delete()
+
+        return_obj.refresh_from_db()
+        self.assertEqual(return_obj.total_amount, Decimal('10.00'))
+
+    def test_cancelled_sale_keeps_its_status(self):
+        Sale.objects.filter(pk=self.sale.pk).update(payment_status='cancelled')
+        with self.captureOnCommitCallbacks(execute=True):
+            self.add_lines(1)
+
+        self.sale.refresh_from_db()
+        self.assertEqual(self.sale.total_amount, Decimal('11.60'))
+        self.assertEqual(self.sale.payment_status, 'cancelled')
+
+
+class SalesPersonStatsTest(InventoryFixtures, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.customer = Customer.objects.create(name='Walk In', phone='1234567890')
+        self.salesperson = SalesPerson.objects.create(employee=self.employee, branch=self.branch)
+        self.today = timezone.localdate()
+
+    def create_sale(self, number, total, days_ago=0):
+        return Sale.objects.create(
+            invoice_number=f'INV-{number}', customer=self.customer, sale_point=self.sale_point,
+            sales_person=self.employee, total_amount=total, payment_method='cash',
+            date=timezone.now() - timedelta(days=days_ago),
+        )
+
+    def rollups(self):
+        return {
+            stats.date: (stats.sales_total, stats.returns_total)
+            for stats in SalesPersonDailyStats.objects.filter(employee=self.employee)
+        }
+
+    def test_sales_returns_and_cancellations_move_the_rollups(self):
+        sale = self.create_sale(1, Decimal('100.00'))
+        self.create_sale(2, Decimal('40.00'), days_ago=1)
+        Return.objects.create(
+            sale=sale, customer=self.customer, return_number='RET-1', reason='Damaged',
+            total_amount=Decimal('30.00'),
+        )
+        self.salesperson.refresh_from_db()
+        self.assertEqual(self.rollups(), {
+            self.today: (Decimal('100.00'), Decimal('30.00')),
+            self.today - timedelta(days=1): (Decimal('40.00'), Decimal('0.00')),
+        })
+        self.assertEqual(self.salesperson.total_sales, Decimal('140.00'))
+        self.assertEqual(self.salesperson.total_returns, Decimal('30.00'))
+        self.assertEqual(self.salesperson.net_sales, Decimal('110.00'))
+
+        sale.payment_status = 'cancelled'
+        sale.save()
+        self.salesperson.refresh_from_db()
+        self.assertEqual(self.rollups()[self.today], (Decimal('0.00'), Decimal('30.00')))
+        self.assertEqual(self.salesperson.net_sales, Decimal('10.00'))
+
+    def test_recalculated_totals_move_the_rollups(self):
+        sale = self.create_sale(1, 0)
+        with self.captureOnCommitCallbacks(execute=True):
+            SaleItem.objects.create(sale=sale, item=self.item, quantity=2, unit_price=Decimal('5.00'))
+        with self.captureOnCommitCallbacks(execute=True):
+            SaleItem.objects.create(sale=sale, item=self.item, quantity=1, unit_price=Decimal('5.00'))
+
+        self.salesperson.refresh_from_db()
+        self.assertEqual(self.rollups(), {self.today: (Decimal('17.40'), Decimal('0.00'))})
+        self.assertEqual(self.salesperson.total_sales, Decimal('17.40'))
+
+    def test_query_count_does_not_grow_with_history(self):
+        def edit_queries(sale):
+            sale.total_amount += 1
+            with CaptureQueriesContext(connection) as queries:
+                sale.save()
+            return len(queries.captured_queries)
+
+        first = edit_queries(self.create_sale(1, Decimal('10.00')))
+        for number in range(2, 30):
+            self.create_sale(number, Decimal('10.00'), days_ago=number)
+        self.assertEqual(edit_queries(self.create_sale(30, Decimal('10.00'))), first)
+
+    def test_rebuild_recomputes_the_rollups(self):
+        sale = self.create_sale(1, Decimal('100.00'))
+        self.create_sale(2, Decimal('40.00'), days_ago=40)
+        Return.objects.create(
+            sale=sale, customer=self.customer, return_number='RET-1', reason='Damaged',
+            total_amount=Decimal('30.00'),
+        )
+        expected = self.rollups()
+        SalesPersonDailyStats.objects.all().delete()
+        SalesPersonDailyStats.objects.create(
+            employee=self.employee, date=self.today - timedelta(days=400), sales_total=5
+        )
+
+        out = StringIO()
+        call_command('rebuild_salesperson_stats', '--days', '7', '--workers', '1', stdout=out)
+
+        self.assertIn('Rebuilt 2 daily stats in 6 chunks', out.getvalue())
+        self.assertEqual(self.rollups(), expected)
+        self.salesperson.refresh_from_db()
+        self.assertEqual(self.salesperson.net_sales, Decimal('110.00'))
+
+
+class CustomerLedgerTest(InventoryFixtures, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.customer = Customer.objects.create(name='Walk In', phone='1234567890')
+        self.sale = Sale.objects.create(
+            invoice_number='INV-1', customer=self.customer, sale_point=self.sale_point,
+            sales_person=self.employee, total_amount=100, payment_method='credit'
+        )
+
+    def entry(self, amount, days_ago):
+        CustomerLedgerEntry.objects.filter(pk=record_entry(self.customer.pk, amount)[0].pk).update(
+            created_at=timezone.now() - timedelta(days=days_ago)
+        )
+
+    def test_stale_instances_do_not_lose_updates(self):
+        first = Customer.objects.get(pk=self.customer.pk)
+        second = Customer.objects.get(pk=self.customer.pk)
+        first.update_balance(Decimal('10.00'))
+        second.update_balance(Decimal('5.00'))
+
+        self.customer.refresh_from_db()
+        self.assertEqual(self.customer.balance, Decimal('15.00'))
+        self.assertEqual(second.balance, Decimal('15.00'))
+        self.assertEqual(self.customer.ledger_entries.count(), 2)
+
+    def test_credit_payments_and_returns_are_recorded_once(self):
+        payment = Payment.objects.create(sale=self.sale, amount=Decimal('40.00'), payment_method='credit')
+        payment.notes = 'Corrected'
+        payment.save()
+        return_obj = Return.objects.create(
+            sale=self.sale, customer=self.customer, return_number='RET-1', reason='Damaged',
+            total_amount=Decimal('25.00'), status='approved',
+        )
+        return_obj.complete(self.employee)
+        Return.objects.get(pk=return_obj.pk).complete(self.employee)
+
+        self.customer.refresh_from_db()
+        self.assertEqual(self.customer.balance, Decimal('-15.00'))
+        self.assertEqual(
+            list(self.customer.ledger_entries.order_by('pk').values_list('source_type', 'source_id', 'amount')),
+            [('payment', payment.pk, Decimal('-40.00')), ('return', return_obj.pk, Decimal('25.00'))],
+        )
+        self.assertEqual(Return.objects.get(pk=return_obj.pk).status, 'completed')
+
+    def test_payment_edits_move_the_balance_by_the_difference(self):
+        payment = Payment.objects.create(sale=self.sale, amount=Decimal('40.00'), payment_method='credit')
+        # A stale instance still moves the balance from what is stored
+        Payment.objects.get(pk=payment.pk).save()
+        payment.amount = Decimal('30.00')
+        payment.save()
+        payment.payment_method = 'cash'
+        payment.save()
+        payment.payment_method = 'credit'
+        payment.save()
+
+        self.customer.refresh_from_db()
+        self.assertEqual(self.customer.balance, Decimal('-30.00'))
+        self.assertEqual(
+            list(self.customer.ledger_entries.order_by('pk').values_list('source_id', 'amount')),
+            [(payment.pk, Decimal('-40.00')), (payment.pk, Decimal('10.00')),
+             (payment.pk, Decimal('30.00')), (payment.pk, Decimal('-30.00'))],
+        )
+
+    def test_deleted_payments_are_reversed(self):
+        payment = Payment.objects.create(sale=self.sale, amount=Decimal('40.00'), payment_method='credit')
+        Payment.objects.create(sale=self.sale, amount=Decimal('15.00'), payment_method='cash')
+        payment.delete()
+        self.sale.payment_set.all().delete()
+
+        self.customer.refresh_from_db()
+        self.assertEqual(self.customer.balance, Decimal('0.00'))
+        self.assertEqual(
+            list(self.customer.ledger_entries.order_by('pk').values_list('source_type', 'amount')),
+            [('payment', Decimal('-40.00')), ('payment', Decimal('40.00'))],
+        )
+
+    def test_balances_are_read_from_the_latest_checkpoint(self):
+        self.entry(Decimal('100.00'), days_ago=10)
+        self.entry(Decimal('-30.00'), days_ago=5)
+        self.entry(Decimal('20.00'), days_ago=0)
+        call_command('compact_customer_ledger', '--days', '3', stdout=StringIO())
+        self.assertEqual(CustomerBalanceCheckpoint.objects.count(), 3)
+
+        # Entries covered by the checkpoint are no longer read
+        CustomerLedgerEntry.objects.filter(created_at__lt=timezone.now() - timedelta(days=1)).update(amount=0)
+        with CaptureQueriesContext(connection) as queries:
+            balances = balances_as_of(timezone.now() + timedelta(seconds=1), [self.customer])
+        self.assertEqual(balances, {self.customer.pk: Decimal('90.00')})
+        self.assertEqual(len(queries.captured_queries), 3)
+
+    def test_statement_and_aging(self):
+        self.entry(Decimal('100.00'), days_ago=40)
+        self.entry(Decimal('-30.00'), days_ago=5)
+        self.entry(Decimal('20.00'), days_ago=0)
+        now = timezone.now() + timedelta(seconds=1)
+
+        opening, entries, closing = statement(self.customer, now - timedelta(days=7), now)
+        self.assertEqual(opening, Decimal('100.00'))
+        self.assertEqual([entry.amount for entry in entries], [Decimal('-30.00'), Decimal('20.00')])
+        self.assertEqual(closing, Decimal('90.00'))
+        self.assertEqual(
+            balance_aging(now, [self.customer]),
+            {self.customer.pk: [Decimal('90.00'), Decimal('100.00'), Decimal('0'), Decimal('0')]},
+        )
+
@@ -50,6 +50,8 @@ urlpatterns = [
     path('api/kits/<int:kit_id>/price/', views.get_kit_price, name='get_kit_price'),
     path('api/items/<int:item_id>/stock/', views.get_item_stock, name='get_item_stock'),
     path('api/kits/<int:kit_id>/stock/', views.get_kit_stock, name='get_kit_stock'),
+    path('api/basket/', views.get_basket_info, name='get_basket_info'),
+    path('api/checkout/', views.checkout_basket, name='checkout_basket'),
 
     # Dashboard URL
     path('', views.dashboard, name='dashboard'),
@@ -9,19 +9,24 @@ from django.contrib.auth.decorators import login_required
 from django.contrib import messages
 from django.db import transaction
 from django.http import JsonResponse
+from django.core.exceptions import ValidationError
+from django.views.decorators.http import require_POST
 from django.core.paginator import Paginator
-from django.utils import timezone
 from django.db.models import Sum, F, Q
 from .models import (
     Customer, Sale, SaleItem, SaleKit, Payment, Return,
     ReturnItem, ReturnKit, Discount, Tax, SalesPerson
 )
+from .checkout import checkout, parse_lines, parse_payments
+from .sequences import next_invoice_number, next_return_number
 from .forms import (
     CustomerForm, SaleForm, SaleItemForm, SaleKitForm, PaymentForm,
     ReturnForm, ReturnItemForm, ReturnKitForm, DiscountForm, TaxForm,
     SalesPersonForm
 )
-from inventory.models import Item, ItemKit, SalePoint, SalePointItem
+from inventory.idempotency import idempotent
+from inventory.models import Item, ItemKit, ItemKitItem, ItemUnit, SalePoint, SalePointItem
+from inventory.stock import InsufficientStock, decrement_stock, post_document, sale_point_lines
 from company.models import Employee, Branch
 import json
 
@@ -41,7 +46,7 @@ def customer_create(request):
         if form.is_valid():
             form.save()
             messages.success(request, 'Customer created successfully')
-            return redirect('customer_list')
+            return redirect('sales:customer_list')
     else:
         form = CustomerForm()
     return render(request, 'sales/customer_form.html', {'form': form, 'title': 'Create Customer'})
@@ -54,7 +59,7 @@ def customer_edit(request, pk):
         if form.is_valid():
             form.save()
             messages.success(request, 'Customer updated successfully')
-            return redirect('customer_list')
+            return redirect('sales:customer_list')
     else:
         form = CustomerForm(instance=customer)
     return render(request, 'sales/customer_form.html', {'form': form, 'title': 'Edit Customer'})
@@ -84,10 +89,10 @@ def sale_create(request):
         form = SaleForm(request.POST)
         if form.is_valid():
             sale = form.save(commit=False)
-            sale.invoice_number = generate_invoice_number()
+            sale.invoice_number = next_invoice_number(sale.sale_point_id)
             sale.save()
             messages.success(request, 'Sale created successfully')
-            return redirect('sale_edit', pk=sale.pk)
+            return redirect('sales:sale_edit', pk=sale.pk)
     else:
         form = SaleForm()
     return render(request, 'sales/sale_form.html', {'form': form, 'title': 'Create Sale'})
@@ -101,7 +106,7 @@ def sale_edit(request, pk):
         if form.is_valid():
             form.save()
             messages.success(request, 'Sale updated successfully')
-            return redirect('sale_detail', pk=sale.pk)
+            return redirect('sales:sale_detail', pk=sale.pk)
     else:
         form = SaleForm(instance=sale)
     
@@ -131,6 +136,7 @@ def sale_detail(request, pk):
     })
 
 @login_required
+@idempotent('sale_item_add')
 @transaction.atomic
 def sale_item_add(request, sale_pk):
     sale = get_object_or_404(Sale, pk=sale_pk)
@@ -139,20 +145,14 @@ def sale_item_add(request, sale_pk):
         if form.is_valid():
             item = form.save(commit=False)
             item.sale = sale
-            item.save()
-            
-            # Update stock
-            sale_point = sale.sale_point
-            stock = SalePointItem.objects.get_or_create(
-                sale_point=sale_point,
-                item=item.item,
-                defaults={'quantity': 0}
-            )[0]
-            stock.quantity -= item.quantity
-            stock.save()
-            
-            messages.success(request, 'Item added successfully')
-            return redirect('sale_edit', pk=sale.pk)
+            try:
+                decrement_stock(sale.sale_point, items={item.item_id: item.quantity}, source=sale)
+            except InsufficientStock as e:
+                form.add_error(None, e)
+            else:
+                item.save()
+                messages.success(request, 'Item added successfully')
+                return redirect('sales:sale_edit', pk=sale.pk)
     else:
         form = SaleItemForm()
     return render(request, 'sales/sale_item_form.html', {'form': form, 'sale': sale})
@@ -166,37 +166,30 @@ def sale_kit_add(request, sale_pk):
         if form.is_valid():
             kit = form.save(commit=False)
             kit.sale = sale
-            kit.save()
-            
-            # Update stock for all items in the kit
-            sale_point = sale.sale_point
-            for kit_item in kit.kit.itemkititem_set.all():
-                stock = SalePointItem.objects.get_or_create(
-                    sale_point=sale_point,
-                    item=kit_item.item,
-                    defaults={'quantity': 0}
-                )[0]
-                stock.quantity -= kit_item.quantity * kit.quantity
-                stock.save()
-            
-            messages.success(request, 'Kit added successfully')
-            return redirect('sale_edit', pk=sale.pk)
+            try:
+                decrement_stock(sale.sale_point, kits={kit.kit_id: kit.quantity}, source=sale)
+            except InsufficientStock as e:
+                form.add_error(None, e)
+            else:
+                kit.save()
+                messages.success(request, 'Kit added successfully')
+                return redirect('sales:sale_edit', pk=sale.pk)
     else:
         form = SaleKitForm()
     return render(request, 'sales/sale_kit_form.html', {'form': form, 'sale': sale})
 
 @login_required
+@idempotent('payment_add')
 @transaction.atomic
 def payment_add(request, sale_pk):
     sale = get_object_or_404(Sale, pk=sale_pk)
     if request.method == 'POST':
-        form = PaymentForm(request.POST)
+        # The form checks the amount against the sale's remaining balance
+        form = PaymentForm(request.POST, instance=Payment(sale=sale))
         if form.is_valid():
-            payment = form.save(commit=False)
-            payment.sale = sale
-            payment.save()
+            payment = form.save()
             messages.success(request, 'Payment added successfully')
-            return redirect('sale_edit', pk=sale.pk)
+            return redirect('sales:sale_edit', pk=sale.pk)
     else:
         form = PaymentForm()
     return render(request, 'sales/payment_form.html', {'form': form, 'sale': sale})
@@ -217,10 +210,10 @@ def return_create(request):
         form = ReturnForm(request.POST)
         if form.is_valid():
             return_obj = form.save(commit=False)
-            return_obj.return_number = generate_return_number()
+            return_obj.return_number = next_return_number(return_obj.sale.sale_point_id)
             return_obj.save()
             messages.success(request, 'Return created successfully')
-            return redirect('return_edit', pk=return_obj.pk)
+            return redirect('sales:return_edit', pk=return_obj.pk)
     else:
         form = ReturnForm()
     return render(request, 'sales/return_form.html', {'form': form, 'title': 'Create Return'})
@@ -234,7 +227,7 @@ def return_edit(request, pk):
         if form.is_valid():
             form.save()
             messages.success(request, 'Return updated successfully')
-            return redirect('return_detail', pk=return_obj.pk)
+            return redirect('sales:return_detail', pk=return_obj.pk)
     else:
         form = ReturnForm(instance=return_obj)
     
@@ -271,17 +264,10 @@ def return_item_add(request, return_pk):
             item.save()
             
             # Update stock
-            sale_point = return_obj.sale.sale_point
-            stock = SalePointItem.objects.get_or_create(
-                sale_point=sale_point,
-                item=item.item,
-                defaults={'quantity': 0}
-            )[0]
-            stock.quantity += item.quantity
-            stock.save()
+            return_obj.sale.sale_point.update_stock(item.quantity, item.item, source=return_obj)
             
             messages.success(request, 'Item added successfully')
-            return redirect('return_edit', pk=return_obj.pk)
+            return redirect('sales:return_edit', pk=return_obj.pk)
     else:
         form = ReturnItemForm()
     return render(request, 'sales/return_item_form.html', {'form': form, 'return_obj': return_obj})
@@ -298,18 +284,13 @@ def return_kit_add(request, return_pk):
             kit.save()
             
             # Update stock for all items in the kit
-            sale_point = return_obj.sale.sale_point
-            for kit_item in kit.kit.itemkititem_set.all():
-                stock = SalePointItem.objects.get_or_create(
-                    sale_point=sale_point,
-                    item=kit_item.item,
-                    defaults={'quantity': 0}
-                )[0]
-                stock.quantity += kit_item.quantity * kit.quantity
-                stock.save()
+            post_document(
+                sale_point_lines(return_obj.sale.sale_point, kits={kit.kit_id: kit.quantity}, sign=1),
+                source=return_obj
+            )
             
             messages.success(request, 'Kit added successfully')
-            return redirect('return_edit', pk=return_obj.pk)
+            return redirect('sales:return_edit', pk=return_obj.pk)
     else:
         form = ReturnKitForm()
     return render(request, 'sales/return_kit_form.html', {'form': form, 'return_obj': return_obj})
@@ -327,7 +308,7 @@ def discount_create(request):
         if form.is_valid():
             form.save()
             messages.success(request, 'Discount created successfully')
-            return redirect('discount_list')
+            return redirect('sales:discount_list')
     else:
         form = DiscountForm()
     return render(request, 'sales/discount_form.html', {'form': form, 'title': 'Create Discount'})
@@ -344,7 +325,7 @@ def tax_create(request):
         if form.is_valid():
             form.save()
             messages.success(request, 'Tax created successfully')
-            return redirect('tax_list')
+            return redirect('sales:tax_list')
     else:
         form = TaxForm()
     return render(request, 'sales/tax_form.html', {'form': form, 'title': 'Create Tax'})
@@ -363,40 +344,11 @@ def salesperson_create(request):
             salesperson = form.save(commit=False)
             salesperson.update_stats()
             messages.success(request, 'Sales Person created successfully')
-            return redirect('salesperson_list')
+            return redirect('sales:salesperson_list')
     else:
         form = SalesPersonForm()
     return render(request, 'sales/salesperson_form.html', {'form': form, 'title': 'Create Sales Person'})
 
-# Helper Functions
-def generate_invoice_number():
-    """Generate a unique invoice number"""
-    prefix = 'INV'
-    date = timezone.now().strftime('%Y%m%d')
-    last_invoice = Sale.objects.filter(invoice_number__startswith=f'{prefix}{date}').order_by('-invoice_number').first()
-    
-    if last_invoice:
-        last_number = int(last_invoice.invoice_number[-4:])
-        new_number = last_number + 1
-    else:
-        new_number = 1
-    
-    return f'{prefix}{date}{new_number:04d}'
-
-def generate_return_number():
-    """Generate a unique return number"""
-    prefix = 'RET'
-    date = timezone.now().strftime('%Y%m%d')
-    last_return = Return.objects.filter(return_number__startswith=f'{prefix}{date}').order_by('-return_number').first()
-    
-    if last_return:
-        last_number = int(last_return.return_number[-4:])
-        new_number = last_number + 1
-    else:
-        new_number = 1
-    
-    return f'{prefix}{date}{new_number:04d}'
-
 # API Views
 @login_required
 def get_item_price(request, item_id):
@@ -429,16 +381,174 @@ def get_kit_stock(request, kit_id):
     kit = get_object_or_404(ItemKit, pk=kit_id)
     sale_point_id = request.GET.get('sale_point_id')
     if sale_point_id:
-        stock_info = {}
-        for kit_item in kit.itemkititem_set.all():
-            stock = SalePointItem.objects.filter(
-                item=kit_item.item,
-                sale_point_id=sale_point_id
-            ).first()
-            stock_info[kit_item.item.name] = stock.quantity if stock else 0
+        kit_items = list(kit.itemkititem_set.select_related('item'))
+        stock = dict(SalePointItem.objects.filter(
+            item_id__in=[kit_item.item_id for kit_item in kit_items],
+            sale_point_id=sale_point_id
+        ).values_list('item_id', 'quantity'))
+        stock_info = {
+            kit_item.item.name: stock.get(kit_item.item_id, 0)
+            for kit_item in kit_items
+        }
         return JsonResponse(stock_info)
     return JsonResponse({})
 
+# Most ids a single basket lookup accepts for items and for kits
+BASKET_LOOKUP_LIMIT = 500
+
+def parse_ids(values):
+    """Parse repeated and/or comma separated ids into a list of distinct ints"""
+    ids = []
+    for value in values:
+        for part in value.split(','):
+            if part.strip():
+                ids.append(int(part))
+    return list(dict.fromkeys(ids))
+
+@login_required
+def get_basket_info(request):
+    """Get price, unit and stock data for many items and kits in a sale point
+
+    Takes ?items=1,2,3&kits=4,5&sale_point_id=6 and answers with at most five
+    queries whatever the number of ids.
+    """
+    try:
+        item_ids = parse_ids(request.GET.getlist('items'))
+        kit_ids = parse_ids(request.GET.getlist('kits'))
+        sale_point_id = int(request.GET.get('sale_point_id') or 0) or None
+    except ValueError:
+        return JsonResponse({'error': 'Ids must be whole numbers'}, status=400)
+    if len(item_ids) > BASKET_LOOKUP_LIMIT or len(kit_ids) > BASKET_LOOKUP_LIMIT:
+        return JsonResponse(
+            {'error': f'At most {BASKET_LOOKUP_LIMIT} items and {BASKET_LOOKUP_LIMIT} kits per request'},
+            status=400
+        )
+
+    items = {}
+    if item_ids:
+        for item in Item.objects.filter(pk__in=item_ids).values(
+            'id', 'name', 'bar_code', 'selling_price', 'smallest_unit', 'status'
+        ):
+            items[item['id']] = {
+                'name': item['name'],
+                'bar_code': item['bar_code'],
+                'price': float(item['selling_price']),
+                'smallest_unit': item['smallest_unit'],
+                'status': item['status'],
+                'units': [],
+            }
+        for unit in ItemUnit.objects.filter(item_id__in=items).order_by('smallest_units').values(
+            'id', 'item_id', 'unit', 'smallest_units', 'selling_price'
+        ):
+            items[unit.pop('item_id')]['units'].append(unit)
+
+    kits = {}
+    if kit_ids:
+        for kit in ItemKit.objects.filter(pk__in=kit_ids).values('id', 'name', 'selling_price', 'status'):
+            kits[kit['id']] = {
+                'name': kit['name'],
+                'price': float(kit['selling_price']),
+                'status': kit['status'],
+                'components': [],
+            }
+        for component in ItemKitItem.objects.filter(item_kit_id__in=kits).order_by('pk').values(
+            'item_kit_id', 'item_id', 'item__name', 'quantity'
+        ):
+            kits[component['item_kit_id']]['components'].append({
+                'item_id': component['item_id'],
+                'name': component['item__name'],
+                'quantity': component['quantity'],
+            })
+
+    # One stock query covers the basket items and every kit component
+    stock_ids = set(items)
+    stock_ids.update(
+        component['item_id'] for kit in kits.values() for component in kit['components']
+    )
+    stock = {}
+    if sale_point_id and stock_ids:
+        stock = dict(SalePointItem.objects.filter(
+            sale_point_id=sale_point_id, item_id__in=stock_ids
+        ).values_list('item_id', 'quantity'))
+
+    for item_id, item in items.items():
+        item['stock'] = stock.get(item_id, 0)
+    for kit in kits.values():
+        for component in kit['components']:
+            component['stock'] = stock.get(component['item_id'], 0)
+        # Whole kits the sale point can make from its component stock
+        kit['stock'] = min(
+            (component['stock'] // component['quantity']
+             for component in kit['components'] if component['quantity'] > 0),
+            default=0
+        )
+
+    return JsonResponse({
+        'sale_point_id': sale_point_id,
+        'items': {str(item_id): items[item_id] for item_id in item_ids if item_id in items},
+        'kits': {str(kit_id): kits[kit_id] for kit_id in kit_ids if kit_id in kits},
+        'missing_items': [item_id for item_id in item_ids if item_id not in items],
+        'missing_kits': [kit_id for kit_id in kit_ids if kit_id not in kits],
+    })
+
+# Most item and kit lines a single checkout accepts
+CHECKOUT_LINE_LIMIT = 500
+
+@login_required
+@require_POST
+@idempotent('checkout')
+def checkout_basket(request):
+    """Record a whole basket as one sale with its lines, stock and payments
+
+    Takes a JSON body of sale_point_id, customer_id, items as a list of
+    {item_id, quantity, unit_price}, kits as a list of {kit_id, quantity,
+    unit_price}, payments as a list of {amount, payment_method,
+    reference_number} and optional notes. Unit prices default to the
+    current selling prices.
+    """
+    try:
+        employee = request.user.employee
+    except Employee.DoesNotExist:
+        return JsonResponse({'error': 'Only employees can record sales'}, status=403)
+    try:
+        data = json.loads(request.body)
+        sale_point = SalePoint.objects.get(pk=int(data['sale_point_id']), status='active')
+        customer = Customer.objects.get(pk=int(data['customer_id']))
+    except (ValueError, TypeError, KeyError):
+        return JsonResponse({'error': 'A JSON body with sale_point_id and customer_id is required'}, status=400)
+    except (SalePoint.DoesNotExist, Customer.DoesNotExist):
+        return JsonResponse({'error': 'Unknown sale point or customer'}, status=404)
+
+    try:
+        items = parse_lines(data.get('items'), 'item_id')
+        kits = parse_lines(data.get('kits'), 'kit_id')
+        payments = parse_payments(data.get('payments'))
+        if len(items) + len(kits) > CHECKOUT_LINE_LIMIT:
+            raise ValidationError(f'At most {CHECKOUT_LINE_LIMIT} lines per checkout')
+        sale = checkout(
+            sale_point, customer, employee, next_invoice_number(sale_point.pk),
+            items=items, kits=kits, payments=payments, notes=data.get('notes'),
+        )
+    except InsufficientStock as e:
+        return JsonResponse({
+            'error': ' '.join(e.messages),
+            'shortages': [
+                {'item_id': s.item_id, 'requested': s.requested, 'available': s.available}
+                for s in e.shortages
+            ],
+        }, status=409)
+    except ValidationError as e:
+        return JsonResponse({'error': ' '.join(e.messages)}, status=400)
+
+    return JsonResponse({
+        'id': sale.pk,
+        'invoice_number': sale.invoice_number,
+        'subtotal': str(sale.subtotal),
+        'tax_amount': str(sale.tax_amount),
+        'total_amount': str(sale.total_amount),
+        'payment_status': sale.payment_status,
+    }, status=201)
+
 @login_required
 def dashboard(request):
     return render(request, 'sales/dashboard.html')